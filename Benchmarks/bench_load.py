@@ -0,0 +1,72 @@
+import argparse
+import csv
+import itertools
+import os
+import tempfile
+import time
+from Benchmarks import synthetic
+from Utilities import psql
+from Utilities.processing import HEADERS, extract_journeys
+
+
+def generate_csv(file_path, rows, request_date='2024-01-01'):
+    """
+    Write csv file in the format of write_csv output with journeys of synthetic responses.
+
+    Parameters:
+    - file_path (str) : output file path.
+    - rows (int) : number of rows.
+    - request_date (str) : request date column value.
+    """
+    journeys = (attributes_list
+                for response in synthetic.iter_responses(request_date=request_date)
+                for attributes_list in extract_journeys(response, request_date))
+    with open(file_path, 'w', newline='') as file:
+        csv_writer = csv.writer(file, lineterminator='\n')
+        csv_writer.writerow(HEADERS)
+        csv_writer.writerows(itertools.islice(journeys, rows))
+
+
+def drop_table(table_name):
+    with psql.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+
+
+def run(load_function, table_name, csv_file_path):
+    """
+    Time single load to a fresh table.
+
+    Return:
+    - float : seconds spent.
+    """
+    drop_table(table_name)
+    psql.create_table(table_name=table_name)
+    start_time = time.perf_counter()
+    load_function(table_name=table_name, csv_file_path=csv_file_path, headers=True)
+    seconds = time.perf_counter() - start_time
+    drop_table(table_name)
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare INSERT (load_csv) and COPY (copy_csv) loading.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 50000],
+                        help='csv sizes to benchmark')
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'insert, s':>10} {'copy, s':>10} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as folder:
+        for rows in args.rows:
+            csv_file_path = os.path.join(folder, f"{rows}.csv")
+            generate_csv(csv_file_path, rows)
+
+            insert_seconds = run(psql.load_csv, 'bench_load_insert', csv_file_path)
+            copy_seconds = run(psql.copy_csv, 'bench_load_copy', csv_file_path)
+            print(f"{rows:>8} {insert_seconds:>10.2f} {copy_seconds:>10.2f} {insert_seconds / copy_seconds:>7.1f}x")
+
+    psql.close_pool()
+
+
+if __name__ == "__main__":
+    main()
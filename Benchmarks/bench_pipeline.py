@@ -0,0 +1,151 @@
+import argparse
+import contextlib
+import gc
+import os
+import tempfile
+import time
+import tracemalloc
+from Benchmarks import synthetic
+from Benchmarks.standin import StandInSession
+from Utilities import processing
+from Utilities import psql
+
+# the whole response list is kept in memory by these stages, they are skipped on larger scales
+IN_MEMORY_STAGES = ['read_parse_file', 'process_line_to_csv', 'process_data']
+
+# all the stages in pipeline order
+STAGES = IN_MEMORY_STAGES + ['iter_parse_file_full', 'iter_parse_file', 'write_csv', 'load_csv', 'copy_csv']
+
+# table for the load stages, dropped after every run
+TABLE_NAME = 'bench_pipeline'
+
+
+def measure(function, memory=True):
+    """
+    Run function and measure time and peak memory of the run.
+
+    Time is measured without tracemalloc (it slows python code down several times),
+    memory is measured by the second run with it.
+
+    Parameters:
+    - function (callable) : function without parameters, returns number of rows processed.
+    - memory (bool) : measure peak memory with the second run.
+
+    Return:
+    - tuple : (rows, seconds, peak memory in bytes or None).
+    """
+    gc.collect()
+    start_time = time.perf_counter()
+    rows = function()
+    seconds = time.perf_counter() - start_time
+
+    peak = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            function()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return rows, seconds, peak
+
+
+def get_stages(raw_file, csv_file, csv_rows, request_date, parsed_file, session):
+    """
+    Functions of the stages, every one returns number of rows (journeys) processed.
+
+    Parameters:
+    - raw_file (str) : raw file path.
+    - csv_file (str) : csv file path, written by write_csv stage.
+    - csv_rows (int) : rows in csv file.
+    - request_date (str) : date of request in yyyy-mm-dd format.
+    - parsed_file (list) : parsed responses for the in-memory stages, None if they are skipped.
+    - session (Session or StandInSession) : session for the load stages.
+
+    Return:
+    - dict : stage name -> function.
+    """
+    def count_journeys(parsed_lines):
+        return sum(1 for parsed_line in parsed_lines
+                   for _ in processing.extract_journeys(parsed_line, request_date))
+
+    def load(load_function):
+        if not isinstance(session, StandInSession):
+            psql.create_table(table_name=TABLE_NAME, session=session)
+        load_function(table_name=TABLE_NAME, csv_file_path=csv_file, headers=True, session=session)
+        if not isinstance(session, StandInSession):
+            drop_table(session)
+        return csv_rows
+
+    return {
+        'read_parse_file': lambda: count_journeys(processing.read_parse_file(raw_file)),
+        'process_line_to_csv': lambda: sum(processing.process_line_to_csv(parsed_line, request_date).count('\n')
+                                           for parsed_line in parsed_file),
+        'process_data': lambda: processing.process_data(parsed_file, request_date).count('\n'),
+        'iter_parse_file_full': lambda: count_journeys(processing.iter_parse_file(raw_file, selective=False)),
+        'iter_parse_file': lambda: count_journeys(processing.iter_parse_file(raw_file)),
+        'write_csv': lambda: processing.write_csv(processing.iter_parse_file(raw_file), request_date, csv_file),
+        'load_csv': lambda: load(psql.load_csv),
+        'copy_csv': lambda: load(psql.copy_csv),
+    }
+
+
+def drop_table(session):
+    with psql.connection(session) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {TABLE_NAME}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time parse, transform and load stages on synthetic responses.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100],
+                        help=f"volumes to benchmark, times the daily volume ({synthetic.DAILY_RESPONSES} responses)")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='stages to run')
+    parser.add_argument('--in-memory-limit', type=int, default=10,
+                        help=f"max scale for the stages keeping everything in memory ({', '.join(IN_MEMORY_STAGES)})")
+    parser.add_argument('--database', action='store_true',
+                        help='load to a throwaway database from database.ini, '
+                             'by default a stand-in connection measures the client side of loading only')
+    parser.add_argument('--no-memory', action='store_true', help="don't measure peak memory (twice faster)")
+    parser.add_argument('--folder', default=None, help='folder for generated files, temporary by default')
+    args = parser.parse_args()
+
+    request_date = '2024-01-01'
+    session_context = psql.Session() if args.database else contextlib.nullcontext(StandInSession())
+
+    print(f"{'stage':<20} {'scale':>6} {'responses':>10} {'rows':>10} {'seconds':>9} {'rows/s':>10} "
+          f"{'peak, MB':>9}")
+    with tempfile.TemporaryDirectory(dir=args.folder) as folder, session_context as session:
+        for scale in args.scales:
+            responses = synthetic.DAILY_RESPONSES * scale
+            raw_file = os.path.join(folder, f"{request_date}.txt")
+            csv_file = os.path.join(folder, f"{request_date}.csv")
+            synthetic.generate_raw_file(raw_file, responses, request_date=request_date)
+
+            # load stages need csv file even if write_csv stage isn't run
+            csv_rows = processing.write_csv(processing.iter_parse_file(raw_file), request_date, csv_file)
+
+            in_memory = scale <= args.in_memory_limit
+            parsed_file = processing.read_parse_file(raw_file) if in_memory else None
+            stages = get_stages(raw_file, csv_file, csv_rows, request_date, parsed_file, session)
+
+            for stage in [stage for stage in STAGES if stage in args.stages]:
+                if stage in IN_MEMORY_STAGES and not in_memory:
+                    print(f"{stage:<20} {scale:>5}x {responses:>10} {'skipped (--in-memory-limit)':>30}")
+                    continue
+
+                rows, seconds, peak = measure(stages[stage], memory=not args.no_memory)
+                peak = f"{peak / 1024 / 1024:>9.1f}" if peak is not None else f"{'-':>9}"
+                print(f"{stage:<20} {scale:>5}x {responses:>10} {rows:>10} {seconds:>9.2f} "
+                      f"{rows / seconds if seconds else 0:>10.0f} {peak}")
+
+            # free memory before the next scale
+            parsed_file = stages = None
+
+    if args.database:
+        psql.close_pool()
+
+
+if __name__ == "__main__":
+    main()
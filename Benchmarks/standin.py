@@ -0,0 +1,71 @@
+class StandInCursor:
+    """
+    Cursor which accepts statements and COPY data without a server, so that the client side
+    of loading (reading csv, validation, formatting of COPY stream) can be measured alone.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        self.connection.statements += 1
+        self.rowcount = 1
+
+    def copy_expert(self, sql, file, size=8192):
+        # read the stream by chunks the same way psycopg2 does
+        self.connection.statements += 1
+        self.rowcount = 0
+        while True:
+            chunk = file.read(size)
+            if not chunk:
+                break
+            self.connection.copied_bytes += len(chunk)
+            self.rowcount += chunk.count('\n')
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class StandInConnection:
+    """
+    Connection of StandInCursor, counts statements (round trips) and bytes sent by COPY.
+    """
+
+    def __init__(self):
+        self.statements = 0
+        self.copied_bytes = 0
+
+    def cursor(self):
+        return StandInCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class StandInSession:
+    """
+    Stand-in for psql.Session, pass it as session= to psql functions instead of a database:
+
+        psql.copy_csv(table_name, csv_file_path, session=StandInSession())
+    """
+
+    def __init__(self):
+        self.transaction = False
+        self.failed = False
+        self.conn = StandInConnection()
@@ -0,0 +1,220 @@
+import datetime
+import itertools
+import json
+import random
+from Utilities import compression
+
+# average journey options per response (~60 kB responses, see OBSERVATIONS in README.md)
+JOURNEYS_PER_RESPONSE = 25
+
+# responses of a day: directions x DAYS_FORWARD (directions.txt and config.txt)
+DAILY_RESPONSES = 10 * 45
+
+# 27 product attributes of a long-distance leg, only ECO_CLASS_SEAT without attribute is extracted
+PRODUCT_ATTRIBUTES = [
+    ('ECO_CLASS_SEAT', None),
+    ('ECO_CLASS_SEAT', 'PET'),
+    ('ECO_CLASS_SEAT', 'WHEELCHAIR'),
+    ('ECO_CLASS_SEAT', 'ALLERGY'),
+    ('ECO_CLASS_SEAT', 'FAMILY'),
+    ('ECO_CLASS_SEAT', 'WORKING'),
+    ('ECO_CLASS_SEAT', 'UPSTAIRS'),
+    ('ECO_CLASS_SEAT', 'DOWNSTAIRS'),
+    ('EXTRA_CLASS_SEAT', None),
+    ('EXTRA_CLASS_SEAT', 'PET'),
+    ('EXTRA_CLASS_SEAT', 'WHEELCHAIR'),
+    ('EXTRA_CLASS_SEAT', 'WORKING'),
+    ('RESTAURANT_SEAT', None),
+    ('CABIN_BED', None),
+    ('CABIN_BED', 'PET'),
+    ('CABIN_BED', 'WHEELCHAIR'),
+    ('CABIN_BED', 'SHOWER'),
+    ('CAR_PLACE', None),
+    ('CAR_PLACE', 'HIGH'),
+    ('BICYCLE_PLACE', None),
+    ('PET_PLACE', None),
+    ('WHEELCHAIR_PLACE', None),
+    ('MEAL', None),
+    ('MEAL', 'BREAKFAST'),
+    ('WIFI', None),
+    ('POWER_OUTLET', None),
+    ('QUIET_ZONE', None),
+]
+
+# train types of long-distance and commuter legs
+LONG_DISTANCE_TYPES = ['IC', 'S', 'PYO']
+COMMUTER_TYPES = ['HL']
+
+# errors of journey options which can't be bought
+ERRORS = ['SOLD_OUT', 'DEPARTED', 'NOT_AVAILABLE']
+
+
+def generate_leg(rng, leg_type, departure, arrival, seats):
+    """
+    Generate single leg of a journey option.
+
+    Parameters:
+    - rng (random.Random) : random numbers generator.
+    - leg_type (str) : 'LONG_DISTANCE' or 'COMMUTER'.
+    - departure (str) : departure station acronym.
+    - arrival (str) : arrival station acronym.
+    - seats (int) : eco class seats available.
+
+    Return:
+    - dict : leg in the searchJourney format.
+    """
+    if leg_type == 'COMMUTER':
+        train_type = rng.choice(COMMUTER_TYPES)
+        product_attributes = []
+    else:
+        train_type = rng.choice(LONG_DISTANCE_TYPES)
+        product_attributes = [{'name': name,
+                               'attribute': attribute,
+                               'availability': seats if (name, attribute) == ('ECO_CLASS_SEAT', None)
+                               else rng.randint(0, 40),
+                               '__typename': 'ProductAttribute'}
+                              for name, attribute in PRODUCT_ATTRIBUTES]
+
+    return {
+        'id': f"{rng.getrandbits(64):016x}",
+        'trainNumber': str(rng.randint(1, 999)),
+        'trainType': train_type,
+        'type': leg_type,
+        'commercialLineIdentifier': rng.choice('RZIKT') if leg_type == 'COMMUTER' else None,
+        'departureStation': departure,
+        'arrivalStation': arrival,
+        'productAttributes': product_attributes,
+        '__typename': 'JourneyOptionLeg',
+    }
+
+
+def generate_journey(rng, departure, arrival, departure_time, commuter_share=0.2, error_share=0.05):
+    """
+    Generate single journey option: one long-distance or commuter leg, or a commuter leg
+    with a change to a long-distance one. Some options have an error (no legs and price).
+
+    Parameters:
+    - rng (random.Random) : random numbers generator.
+    - departure (str) : departure station acronym.
+    - arrival (str) : arrival station acronym.
+    - departure_time (datetime.datetime) : departure time in UTC.
+    - commuter_share (float) : share of commuter only journeys.
+    - error_share (float) : share of journeys with error.
+
+    Return:
+    - dict : journey option in the searchJourney format.
+    """
+    arrival_time = departure_time + datetime.timedelta(minutes=rng.randint(60, 480))
+    seats = rng.randint(0, 400)
+    error = rng.choice(ERRORS) if rng.random() < error_share else None
+
+    kind = rng.random()
+    if error:
+        legs = []
+    elif kind < commuter_share:
+        legs = [generate_leg(rng, 'COMMUTER', departure, arrival, seats)]
+    elif kind < commuter_share * 1.5:
+        # change from commuter to long-distance train on the way
+        legs = [generate_leg(rng, 'COMMUTER', departure, 'PSL', seats),
+                generate_leg(rng, 'LONG_DISTANCE', 'PSL', arrival, seats)]
+    else:
+        legs = [generate_leg(rng, 'LONG_DISTANCE', departure, arrival, seats)]
+
+    price = rng.randint(490, 9990) if legs else 0
+    return {
+        'id': f"{rng.getrandbits(128):032x}",
+        'departureTime': departure_time.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+        'departureStation': departure,
+        'arrivalStation': arrival,
+        'arrivalTime': arrival_time.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+        'legs': legs,
+        'totalPrice': price,
+        'discount': None,
+        'error': error,
+        'passengers': [{'type': 'ADULT',
+                        'offers': [{'legId': leg['id'], 'product': 'SEAT', 'price': price // len(legs),
+                                    'discountCategory': None, '__typename': 'JourneyOptionOffer'}
+                                   for leg in legs],
+                        '__typename': 'JourneyOptionPassenger'}],
+        'availability': {'seatAvailability': seats, 'accessibleSeatAvailability': rng.randint(0, 4),
+                         'petSeatAvailability': rng.randint(0, 8), 'cabinAvailability': None,
+                         'petCabinAvailability': None, 'accessibleCabinAvailability': None,
+                         '__typename': 'OptionAvailability'},
+        '__typename': 'JourneyOption',
+    }
+
+
+def generate_response(rng, direction, dep_date, journeys=JOURNEYS_PER_RESPONSE, commuter_share=0.2,
+                      error_share=0.05):
+    """
+    Generate searchJourney response for the direction and departure date, journeys are spread
+    over the day from 4 a.m. local time.
+
+    Parameters:
+    - rng (random.Random) : random numbers generator.
+    - direction (str) : direction in format FROM TO.
+    - dep_date (str) : departure date in yyyy-mm-dd format.
+    - journeys (int) : number of journey options.
+    - commuter_share (float) : share of commuter only journeys.
+    - error_share (float) : share of journeys with error.
+
+    Return:
+    - dict : response.
+    """
+    departure, arrival = direction.split(' ')
+    first_departure = datetime.datetime.fromisoformat(dep_date) + datetime.timedelta(hours=2)
+    step = datetime.timedelta(minutes=20 * 60 // max(journeys, 1))
+    return {'data': {'searchJourney': [generate_journey(rng, departure, arrival, first_departure + step * i,
+                                                        commuter_share, error_share)
+                                       for i in range(journeys)]}}
+
+
+def iter_responses(responses=None, request_date='2024-01-01', journeys=JOURNEYS_PER_RESPONSE,
+                   directions=('HKI TPE',), seed=0):
+    """
+    Generate responses the same way extract requests them: for departure dates from request_date on,
+    round robin over directions.
+
+    Parameters:
+    - responses (int) : number of responses, endless if None.
+    - request_date (str) : date of request in yyyy-mm-dd format.
+    - journeys (int) : journey options per response.
+    - directions (iter) : directions in format FROM TO.
+    - seed (int) : random seed, the same seed gives the same responses.
+
+    Return:
+    - generator : responses (dict).
+    """
+    rng = random.Random(seed)
+    directions = list(directions)
+    start = datetime.date.fromisoformat(request_date)
+
+    for i in itertools.count() if responses is None else range(responses):
+        dep_date = (start + datetime.timedelta(days=i // len(directions) % 45)).isoformat()
+        yield generate_response(rng, directions[i % len(directions)], dep_date, journeys)
+
+
+def generate_raw_file(file_path, responses, request_date='2024-01-01', journeys=JOURNEYS_PER_RESPONSE,
+                      directions=('HKI TPE',), seed=0, codec=''):
+    """
+    Write raw file of single lined responses, the same as extract writes.
+
+    Parameters:
+    - file_path (str) : output file path.
+    - responses (int) : number of responses.
+    - request_date (str) : date of request in yyyy-mm-dd format.
+    - journeys (int) : journey options per response.
+    - directions (iter) : directions in format FROM TO.
+    - seed (int) : random seed, the same seed gives the same file.
+    - codec (str) : 'gzip' or 'zstd' to compress every response, empty for plain text.
+
+    Return:
+    - int : number of journeys without error, i.e. rows the file is transformed to.
+    """
+    rows = 0
+    with open(file_path, 'wb') as file:
+        for response in iter_responses(responses, request_date, journeys, directions, seed):
+            rows += sum(1 for journey in response['data']['searchJourney'] if not journey['error'])
+            line = json.dumps(response, separators=(',', ':')).encode('utf-8') + b'\n'
+            file.write(compression.compress_frame(line, codec))
+    return rows
@@ -0,0 +1,368 @@
+import argparse
+import datetime
+import hashlib
+import os
+import sqlite3
+from contextlib import closing
+from Utilities import parameters
+
+# catalog of raw and csv files, "what's left to do" is an indexed query instead of folder scans
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    direction TEXT NOT NULL,
+    file_date TEXT NOT NULL,
+    extension TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    checksum TEXT NOT NULL,
+    registered_at TEXT NOT NULL,
+    transformed_at TEXT,
+    loaded_at TEXT,
+    merge_load INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS files_transform_todo_idx ON files (extension, transformed_at, file_date);
+CREATE INDEX IF NOT EXISTS files_load_todo_idx ON files (extension, loaded_at, file_date);
+CREATE TABLE IF NOT EXISTS response_hashes (
+    direction TEXT NOT NULL,
+    dep_date TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    request_date TEXT NOT NULL,
+    PRIMARY KEY (direction, dep_date)
+);
+CREATE TABLE IF NOT EXISTS extract_checkpoints (
+    request_date TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    dep_date TEXT NOT NULL,
+    status TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (request_date, direction, dep_date)
+);
+"""
+
+
+def connect(catalog_file):
+    """
+    Open catalog database, create it if needed.
+
+    Parameters:
+    - catalog_file (str) : path to sqlite file.
+
+    Return:
+    - sqlite3.Connection : connection to the catalog.
+    """
+    os.makedirs(os.path.dirname(catalog_file) or '.', exist_ok=True)
+    conn = sqlite3.connect(catalog_file, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(CATALOG_SCHEMA)
+
+    # catalogs of the previous versions have no merge_load column
+    if 'merge_load' not in [row[1] for row in conn.execute('PRAGMA table_info(files)')]:
+        conn.execute('ALTER TABLE files ADD COLUMN merge_load INTEGER NOT NULL DEFAULT 0')
+    return conn
+
+
+def file_checksum(file_path, block_size=1024 * 1024):
+    """
+    Calculate sha1 checksum of the file block by block.
+
+    Parameters:
+    - file_path (str) : path to file.
+    - block_size (int) : read block size.
+
+    Return:
+    - str : hex digest.
+    """
+    checksum = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def split_file_path(file_path):
+    """
+    Split path of the data file destination_folder/direction/yyyy-mm-dd.ext into parts.
+    Compressed raw files (yyyy-mm-dd.txt.gz) have the same extension as plain ones.
+
+    Parameters:
+    - file_path (str) : path to file.
+
+    Return:
+    - tuple : (direction, file date, extension).
+    """
+    file_date, extension = parameters.split_file_name(file_path)
+    return os.path.basename(os.path.dirname(file_path)), file_date.isoformat(), extension
+
+
+def register_file(catalog_file, file_path, done=False):
+    """
+    Add the file to the catalog or update its size and checksum. Paths are kept normalized.
+
+    If the content has changed (e.g. raw file was appended), the file is planned to be
+    transformed and loaded again. The csv file which has been loaded before is marked to be merged
+    by natural key (see needs_merge), its rows which are in the table already aren't loaded twice.
+
+    Parameters:
+    - catalog_file (str) : path to sqlite file.
+    - file_path (str) : path to data file.
+    - done (bool) : a new file has passed all the stages already (e.g. found by sync, see there).
+
+    Return:
+    - bool: True if the file is new or changed, False if it's the same as in the catalog.
+    """
+    file_path = os.path.normpath(file_path)
+    direction, file_date, extension = split_file_path(file_path)
+    size = os.path.getsize(file_path)
+    checksum = file_checksum(file_path)
+
+    with closing(connect(catalog_file)) as conn, conn:
+        known = conn.execute('SELECT checksum FROM files WHERE path = ?', (file_path,)).fetchone()
+        if known and known[0] == checksum:
+            return False
+
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        conn.execute("""INSERT INTO files (path, direction, file_date, extension, size, checksum, registered_at,
+                        transformed_at, loaded_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (path) DO UPDATE SET size = excluded.size, checksum = excluded.checksum,
+                        registered_at = excluded.registered_at, transformed_at = NULL, loaded_at = NULL,
+                        merge_load = merge_load OR loaded_at IS NOT NULL""",
+                     (file_path, direction, file_date, extension, size, checksum, now,
+                      now if done else None, now if done else None))
+    return True
+
+
+def rename_file(catalog_file, old_path, new_path):
+    """
+    Move catalog record to the new path (e.g. after compression), keeping its stages.
+
+    Parameters:
+    - catalog_file (str) : path to sqlite file.
+    - old_path (str) : previous path to data file.
+    - new_path (str) : current path to data file.
+    """
+    new_path = os.path.normpath(new_path)
+    with closing(connect(catalog_file)) as conn, conn:
+        conn.execute('UPDATE files SET path = ?, size = ?, checksum = ? WHERE path = ?',
+                     (new_path, os.path.getsize(new_path), file_checksum(new_path), os.path.normpath(old_path)))
+
+
+def mark_done(catalog_file, file_path, stage):
+    """
+    Record that the file has passed the stage.
+
+    Parameters:
+    - catalog_file (str) : path to sqlite file.
+    - file_path (str) : path to data file.
+    - stage (str) : 'transformed' or 'loaded'.
+    """
+    column = {'transformed': 'transformed_at', 'loaded': 'loaded_at'}[stage]
+    with closing(connect(catalog_file)) as conn, conn:
+        conn.execute(f'UPDATE files SET {column} = ? WHERE path = ?',
+                     (datetime.datetime.now().isoformat(timespec='seconds'), os.path.normpath(file_path)))
+
+
+def get_stages(catalog_file, file_path):
+    """
+    Stages the file has passed.
+
+    Parameters:
+    - catalog_file (str) : path to sqlite file.
+    - file_path (str) : path to data file.
+
+    Return:
+    - dict : {'transformed': time or None, 'loaded': time or None}.
+    - None : the file is not in the catalog.
+    """
+    with closing(connect(catalog_file)) as conn:
+        row = conn.execute('SELECT transformed_at, loaded_at FROM files WHERE path = ?',
+                           (os.path.normpath(file_path),)).fetchone()
+    return {'transformed': row[0], 'loaded': row[1]} if row else None
+
+
+def needs_merge(catalog_file, file_path):
+    """
+    Check that the csv file has changed after it was loaded (e.g. regenerated from the appended raw file),
+    so some of its rows are in the table already and it has to be loaded by upsert, whatever the load method.
+
+    Parameters:
+    - catalog_file (str) : path to sqlite file.
+    - file_path (str) : path to data file.
+
+    Return:
+    - bool: True if the file must be merged by natural key.
+    """
+    with closing(connect(catalog_file)) as conn:
+        row = conn.execute('SELECT merge_load FROM files WHERE path = ?', (os.path.normpath(file_path),)).fetchone()
+    return bool(row and row[0])
+
+
+def remove_file(catalog_file, file_path):
+    """
+    Remove the record of a deleted data file.
+
+    Parameters:
+    - catalog_file (str) : path to sqlite file.
+    - file_path (str) : path to data file.
+    """
+    with closing(connect(catalog_file)) as conn, conn:
+        conn.execute('DELETE FROM files WHERE path = ?', (os.path.normpath(file_path),))
+
+
+def get_files_todo(catalog_file, directions, extension, stage, date=''):
+    """
+    Returns list of files of the given extension which haven't passed the stage yet.
+
+    Parameters:
+    - catalog_file (str) : path to sqlite file.
+    - directions (iter) : list of directions.
+    - extension (str) : extension of needed files, without '.'
+    - stage (str) : 'transformed' or 'loaded'.
+    - date (str) : the earliest file date in yyyy-mm-dd format. Today if empty, as
+      parameters.get_files_todo_from_date() does.
+
+    Return:
+    - list: list of files' full paths, ordered by direction and date.
+    """
+    column = {'transformed': 'transformed_at', 'loaded': 'loaded_at'}[stage]
+    directions = list(directions)
+    date = date or datetime.date.today().isoformat()
+    with closing(connect(catalog_file)) as conn:
+        rows = conn.execute(f"""SELECT path FROM files
+                                WHERE extension = ? AND {column} IS NULL AND file_date >= ?
+                                AND direction IN ({', '.join('?' * len(directions))})
+                                ORDER BY direction, file_date""",
+                            (extension, date, *directions)).fetchall()
+    return [row[0] for row in rows]
+
+
+def get_response_hashes(catalog_file, direction, date_from=''):
+    """
+    Content hashes of the latest stored (changed) responses of the direction by departure date.
+
+    Parameters:
+    - catalog_file (str) : path to sqlite file.
+    - direction (str) : direction in format FROM TO.
+    - date_from (str) : the earliest departure date in yyyy-mm-dd format. All dates if empty.
+
+    Return:
+    - dict : {dep_date: (content hash, request date of the raw file with the response)}.
+    """
+    with closing(connect(catalog_file)) as conn:
+        rows = conn.execute("""SELECT dep_date, content_hash, request_date FROM response_hashes
+                               WHERE direction = ? AND dep_date >= ?""", (direction, date_from)).fetchall()
+    return {dep_date: (content_hash, request_date) for dep_date, content_hash, request_date in rows}
+
+
+def set_response_hashes(catalog_file, direction, hashes):
+    """
+    Record content hashes of the stored responses of the direction, past departure dates are removed.
+
+    Parameters:
+    - catalog_file (str) : path to sqlite file.
+    - direction (str) : direction in format FROM TO.
+    - hashes (dict) : {dep_date: (content hash, request date)}.
+    """
+    with closing(connect(catalog_file)) as conn, conn:
+        conn.executemany("""INSERT INTO response_hashes (direction, dep_date, content_hash, request_date)
+                            VALUES (?, ?, ?, ?)
+                            ON CONFLICT (direction, dep_date) DO UPDATE SET content_hash = excluded.content_hash,
+                            request_date = excluded.request_date""",
+                         [(direction, dep_date, content_hash, request_date)
+                          for dep_date, (content_hash, request_date) in hashes.items()])
+        conn.execute('DELETE FROM response_hashes WHERE direction = ? AND dep_date < ?',
+                     (direction, datetime.date.today().isoformat()))
+
+
+def get_checkpoints(catalog_file, request_date, status=None):
+    """
+    Checkpoint of the extract of the request date: responses written to raw files and failed requests.
+
+    Parameters:
+    - catalog_file (str) : path to sqlite file.
+    - request_date (str) : date of request in yyyy-mm-dd format.
+    - status (str) : 'done' or 'failed', all if None.
+
+    Return:
+    - dict : {(direction, dep_date): status}.
+    """
+    with closing(connect(catalog_file)) as conn:
+        rows = conn.execute("""SELECT direction, dep_date, status FROM extract_checkpoints
+                               WHERE request_date = ? AND status = coalesce(?, status)""",
+                            (request_date, status)).fetchall()
+    return {(direction, dep_date): row_status for direction, dep_date, row_status in rows}
+
+
+def set_checkpoint(catalog_file, request_date, direction, dep_date, status):
+    """
+    Record the outcome of the request, committed at once, so a killed extract can be resumed from it.
+
+    Parameters:
+    - catalog_file (str) : path to sqlite file.
+    - request_date (str) : date of request in yyyy-mm-dd format.
+    - direction (str) : direction in format FROM TO.
+    - dep_date (str) : departure date in yyyy-mm-dd format.
+    - status (str) : 'done' if the response is in the raw file, 'failed' if there is no valid response.
+    """
+    with closing(connect(catalog_file)) as conn, conn:
+        conn.execute("""INSERT INTO extract_checkpoints (request_date, direction, dep_date, status, updated_at)
+                        VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT (request_date, direction, dep_date) DO UPDATE SET status = excluded.status,
+                        updated_at = excluded.updated_at""",
+                     (request_date, direction, dep_date, status, datetime.datetime.now().isoformat(timespec='seconds')))
+
+
+def clear_checkpoints(catalog_file, request_date):
+    """
+    Start a new checkpoint of the request date, checkpoints of the previous dates are removed too.
+
+    Parameters:
+    - catalog_file (str) : path to sqlite file.
+    - request_date (str) : date of request in yyyy-mm-dd format.
+    """
+    with closing(connect(catalog_file)) as conn, conn:
+        conn.execute('DELETE FROM extract_checkpoints WHERE request_date <= ?', (request_date,))
+
+
+def sync(catalog_file, destination_folder, directions, date=''):
+    """
+    Scan direction folders once and register all new or changed data files.
+    Needed only for files which were created without registration (e.g. by extract_load.sh).
+
+    New files of the dates before the date are registered as done: they are the history which has been
+    processed before the catalog (or without it), transforming and loading it again would duplicate the rows.
+
+    Parameters:
+    - catalog_file (str) : path to sqlite file.
+    - destination_folder (str) : root folder.
+    - directions (iter) : list of directions.
+    - date (str) : the earliest file date to be processed, in yyyy-mm-dd format. Today if empty.
+
+    Return:
+    - int : number of new or changed files.
+    """
+    date = date or datetime.date.today().isoformat()
+    changed = 0
+    for direction in directions:
+        folder = os.path.join(destination_folder, direction)
+        if not os.path.isdir(folder):
+            continue
+        for file_name in sorted(os.listdir(folder)):
+            try:
+                file_path = os.path.join(folder, file_name)
+                done = parameters.split_file_name(file_name)[0].isoformat() < date
+                changed += register_file(catalog_file, file_path, done=done)
+            except ValueError:
+                # not a data file
+                continue
+    return changed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Register data files in the catalog.')
+    parser.add_argument('catalog_file', help='path to sqlite file')
+    parser.add_argument('files', nargs='+', help='data files to register')
+    args = parser.parse_args()
+
+    for path in args.files:
+        register_file(args.catalog_file, path)
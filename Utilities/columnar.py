@@ -0,0 +1,160 @@
+import datetime
+import decimal
+import os
+from Utilities.processing import HEADERS, TIMEZONE, extract_journeys
+from Utilities import metrics
+from Utilities.log import log
+
+# pyarrow is optional, it's needed only for the columnar output mode
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def get_schema():
+    """
+    Typed schema of the columnar output, the same field set as HEADERS.
+
+    Return:
+    - pyarrow.Schema : schema.
+    """
+    if pyarrow is None:
+        raise ImportError("pyarrow module is required for the columnar output")
+
+    types = {
+        'journey_id': pyarrow.string(),
+        'departure_time': pyarrow.timestamp('ms', tz='UTC'),
+        'departure_station': pyarrow.string(),
+        'arrival_station': pyarrow.string(),
+        'arrival_time': pyarrow.timestamp('ms', tz='UTC'),
+        'price': pyarrow.decimal128(5, 2),
+        'train_number': pyarrow.string(),
+        'train_type': pyarrow.string(),
+        'eco_seats_available': pyarrow.int16(),
+        'request_date': pyarrow.date32(),
+    }
+    return pyarrow.schema([(column, types[column]) for column in HEADERS])
+
+
+def parse_timestamp(value):
+    # API timestamps are ISO 8601 in UTC, e.g. 2024-01-01T05:17:00.000Z
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+# converters of extracted string attributes to the column types
+CONVERTERS = {
+    'departure_time': parse_timestamp,
+    'arrival_time': parse_timestamp,
+    'price': lambda value: decimal.Decimal(value).quantize(decimal.Decimal('0.01')),
+    'eco_seats_available': int,
+    'request_date': datetime.date.fromisoformat,
+}
+
+
+def write_parquet(parsed_file, request_date, output_file):
+    """
+    Extract journeys from parsed responses into typed columns and write them as a parquet file.
+
+    The file is written to a temporary file in the same folder and renamed to output_file
+    when complete.
+
+    Parameters:
+    - parsed_file (iter) : parsed json-responses, list or lazy iterator (see iter_parse_file).
+    - request_date (str) : date of request in yyyy-mm-dd format.
+    - output_file (str) : output file path.
+
+    Return:
+    - int : number of rows written.
+    - None : writing failed, output_file is untouched.
+    """
+    # hidden temporary file next to the output, unique per process
+    temp_file = os.path.join(os.path.dirname(output_file),
+                             '.{}.{}.tmp'.format(os.path.basename(output_file), os.getpid()))
+    try:
+        columns = {column: [] for column in HEADERS}
+        converters = [(columns[column], CONVERTERS.get(column, str)) for column in HEADERS]
+
+        for parsed_line in parsed_file:
+            for attributes_list in extract_journeys(parsed_line, request_date):
+                for (values, converter), value in zip(converters, attributes_list):
+                    values.append(converter(value))
+
+        table = pyarrow.table(columns, schema=get_schema())
+        pyarrow.parquet.write_table(table, temp_file, compression='zstd')
+
+        # atomic replacement of the previous version of the file
+        os.replace(temp_file, output_file)
+        metrics.increment('bytes_written', os.path.getsize(output_file))
+        return table.num_rows
+    except Exception as e:
+        log(f"Error writing output to {output_file}: {e}", "./logs/processing_log.txt", "ERROR")
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        return None
+
+
+def read_journeys(file_paths, columns=None):
+    """
+    Read parquet files of one or several request dates into a single table, with local departure date.
+
+    Parameters:
+    - file_paths (iter) : paths to parquet files.
+    - columns (list) : columns to read, all by default.
+
+    Return:
+    - pyarrow.Table : journeys with additional dep_date column.
+    """
+    if pyarrow is None:
+        raise ImportError("pyarrow module is required for the columnar output")
+
+    columns = list(columns or HEADERS)
+    if 'departure_time' not in columns:
+        columns.append('departure_time')
+    table = pyarrow.concat_tables([pyarrow.parquet.read_table(path, columns=columns) for path in file_paths])
+
+    # departure date in local time, the same as departure_time::TIMESTAMP::DATE in the db
+    local_departure = pyarrow.compute.local_timestamp(
+        table['departure_time'].cast(pyarrow.timestamp('ms', tz=TIMEZONE)))
+    return table.append_column('dep_date', local_departure.cast(pyarrow.date32()))
+
+
+def price_range_by_day(file_paths):
+    """
+    Min and max price per departure day of the latest request date among the files,
+    the same as <table>_price_range in the db.
+
+    Parameters:
+    - file_paths (iter) : paths to parquet files of one direction.
+
+    Return:
+    - pyarrow.Table : dep_date, price_min, price_max ordered by dep_date.
+    """
+    table = read_journeys(file_paths, columns=['price', 'request_date'])
+    latest = pyarrow.compute.max(table['request_date'])
+    table = table.filter(pyarrow.compute.equal(table['request_date'], latest))
+    return table.group_by('dep_date').aggregate([('price', 'min'), ('price', 'max')]).sort_by('dep_date')
+
+
+def seat_trend(file_paths, dep_date):
+    """
+    How eco class seats availability of the departure day changes over request dates.
+    Commuter trains (no seats info, -1) are excluded.
+
+    Parameters:
+    - file_paths (iter) : paths to parquet files of one direction.
+    - dep_date (str) : departure date in yyyy-mm-dd format.
+
+    Return:
+    - pyarrow.Table : request_date, eco_seats_available_sum, eco_seats_available_min ordered by request_date.
+    """
+    table = read_journeys(file_paths, columns=['eco_seats_available', 'request_date'])
+    mask = pyarrow.compute.and_(
+        pyarrow.compute.equal(table['dep_date'], pyarrow.scalar(datetime.date.fromisoformat(dep_date))),
+        pyarrow.compute.greater_equal(table['eco_seats_available'], 0))
+    return (table.filter(mask)
+            .group_by('request_date')
+            .aggregate([('eco_seats_available', 'sum'), ('eco_seats_available', 'min')])
+            .sort_by('request_date'))
@@ -0,0 +1,160 @@
+import gzip
+import io
+import zlib
+
+# zstandard is optional, gzip from the standard library is always available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# compression codecs and suffixes of compressed raw files (yyyy-mm-dd.txt.gz)
+SUFFIXES = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# gzip level, higher levels are much slower for a few percent of size
+GZIP_LEVEL = 6
+
+# zstd level
+ZSTD_LEVEL = 9
+
+# bytes fed to the decompressor at once while looking for the end of a frame
+FRAME_CHUNK_SIZE = 64 * 1024
+
+
+def get_codec(file_path):
+    """
+    Define compression codec by file suffix.
+
+    Parameters:
+    - file_path (str) : path to file.
+
+    Return:
+    - str : 'gzip', 'zstd' or empty string for uncompressed file.
+    """
+    for codec, suffix in SUFFIXES.items():
+        if file_path.endswith(suffix):
+            return codec
+    return ''
+
+
+def strip_suffix(file_path):
+    """
+    Path without compression suffix, e.g. 2024-01-01.txt.gz -> 2024-01-01.txt.
+
+    Parameters:
+    - file_path (str) : path to file.
+
+    Return:
+    - str : path without compression suffix.
+    """
+    codec = get_codec(file_path)
+    return file_path[:-len(SUFFIXES[codec])] if codec else file_path
+
+
+def compress_frame(data, codec):
+    """
+    Compress data into a self-contained frame (gzip member or zstd frame).
+
+    Frames can be appended to the file one after another, the file stays readable as a whole,
+    so responses are appended to compressed raw file the same way as to the plain one.
+
+    Parameters:
+    - data (bytes) : data to compress.
+    - codec (str) : 'gzip', 'zstd' or empty string for no compression.
+
+    Return:
+    - bytes : compressed frame.
+    """
+    if codec == 'gzip':
+        return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstandard module is required for zstd compression")
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return data
+
+
+def decompress_frame(frame, codec):
+    """
+    Decompress single frame written by compress_frame().
+
+    Parameters:
+    - frame (bytes) : compressed frame (plain data if codec is empty).
+    - codec (str) : 'gzip', 'zstd' or empty string for no compression.
+
+    Return:
+    - bytes : decompressed data.
+    """
+    if codec == 'gzip':
+        return gzip.decompress(frame)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstandard module is required for zstd decompression")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(frame)
+    return frame
+
+
+def iter_frames(data, codec, start=0):
+    """
+    Find the frames appended one after another (gzip members or zstd frames) in compressed data,
+    e.g. memory-mapped raw file. Every frame is decompressed once to find where it ends.
+
+    Parameters:
+    - data (bytes or mmap) : compressed data.
+    - codec (str) : 'gzip' or 'zstd'.
+    - start (int) : offset of the first frame.
+
+    Return:
+    - generator : (offset, length, decompressed data) of every frame. A truncated frame at the end is not
+      yielded (e.g. it's being written).
+    """
+    offset = start
+    while offset < len(data):
+        if codec == 'gzip':
+            # 16 + MAX_WBITS reads a single gzip member, the data after it is left unused
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif zstandard is None:
+            raise ImportError("zstandard module is required for zstd decompression")
+        else:
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+        # feed the frame chunk by chunk until it ends
+        chunks = []
+        position = offset
+        while not decompressor.eof and position < len(data):
+            chunk = data[position:position + FRAME_CHUNK_SIZE]
+            position += len(chunk)
+            chunks.append(decompressor.decompress(chunk))
+        if not decompressor.eof:
+            return
+
+        length = position - offset - len(decompressor.unused_data)
+        yield offset, length, b''.join(chunks)
+        offset += length
+
+
+def open_raw(file_path):
+    """
+    Open raw file for binary reading with streaming decompression, codec is defined by suffix.
+    Plain files are opened as is.
+
+    Parameters:
+    - file_path (str) : path to file.
+
+    Return:
+    - binary file object which can be iterated line by line.
+    """
+    codec = get_codec(file_path)
+    if codec == 'gzip':
+        # reads all the appended members one after another
+        return gzip.open(file_path, 'rb')
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError("zstandard module is required to read " + file_path)
+        reader = zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), read_across_frames=True,
+                                                            closefd=True)
+        return io.BufferedReader(reader)
+    return open(file_path, 'rb')
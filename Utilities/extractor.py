@@ -0,0 +1,500 @@
+import collections
+import contextlib
+import datetime
+import http.client
+import os
+import queue
+import random
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from Utilities import catalog
+from Utilities import compression
+from Utilities import metrics
+from Utilities import processing
+from Utilities import raw_index
+from Utilities.log import log
+
+# API endpoint URL
+API_URL = 'https://www.vr.fi/api/v7'
+
+# payload template with {{}} placeholders for stations and date
+PAYLOAD_FILE = './Resources/payload.json'
+
+# the same log file request.sh writes to
+REQUEST_LOG = './logs/request_logs.txt'
+
+# default number of repeated requests after a failed one, and seconds of backoff before the first repeat
+RETRIES = 3
+BACKOFF = 1.0
+
+# backoff never exceeds BACKOFF_CAP seconds
+BACKOFF_CAP = 30.0
+
+# status codes of transient failures, other 4xx won't change on repeat
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+
+def read_payload_template(payload_file=PAYLOAD_FILE):
+    """
+    Read payload template for the POST request.
+
+    Parameters:
+    - payload_file (str) : path to payload.json with {{}} placeholders.
+
+    Return:
+    - str : payload template.
+    """
+    with open(payload_file, 'r') as file:
+        return file.read().strip()
+
+
+def build_payload(template, departure, arrival, dep_date):
+    """
+    Fill payload template placeholders the same way request.sh does (first occurrence only).
+
+    Parameters:
+    - template (str) : payload template.
+    - departure (str) : departure station acronym.
+    - arrival (str) : arrival station acronym.
+    - dep_date (str) : departure date in yyyy-mm-dd format.
+
+    Return:
+    - bytes : ready to send payload.
+    """
+    payload = template.replace('{{ARRIVAL_STATION}}', arrival, 1)
+    payload = payload.replace('{{DEPARTURE_STATION}}', departure, 1)
+    payload = payload.replace('{{DATE}}', dep_date, 1)
+    return payload.encode('utf-8')
+
+
+class ConnectionPool:
+    """
+    Pool of keep-alive HTTP(S) connections to a single host.
+
+    Connections are created lazily up to the pool size and reused by the worker threads,
+    so the TCP and TLS handshakes are paid once per connection instead of once per request.
+    """
+
+    def __init__(self, url, size, timeout=30):
+        parsed_url = urllib.parse.urlsplit(url)
+        self.scheme = parsed_url.scheme
+        self.host = parsed_url.hostname
+        self.port = parsed_url.port
+        self.path = parsed_url.path or '/'
+        self.timeout = timeout
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def _new_connection(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def acquire(self):
+        """
+        Take an idle connection or create a new one.
+
+        Return:
+        - tuple : (connection, True if it is a fresh connection).
+        """
+        self.slots.acquire()
+        try:
+            return self.idle.get_nowait(), False
+        except queue.Empty:
+            return self._new_connection(), True
+
+    def release(self, conn, reusable=True):
+        """
+        Return connection to the pool, closing it if it can't be reused.
+        """
+        if reusable:
+            self.idle.put(conn)
+        else:
+            conn.close()
+        self.slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class RateLimiter:
+    """
+    Spread requests evenly so that no more than `rate` requests per second are started.
+    Rate 0 (or None) disables the limit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        time.sleep(max(0.0, slot - now))
+
+
+def post(pool, payload):
+    """
+    Make a single POST request through the pool.
+
+    A reused keep-alive connection may have been closed by the server meanwhile,
+    in that case the request is repeated once on a fresh connection.
+
+    Parameters:
+    - pool (ConnectionPool) : connection pool.
+    - payload (bytes) : request body.
+
+    Return:
+    - tuple : (status code, time to connect in seconds, response body).
+    """
+    headers = {'Content-Type': 'application/json', 'Accept': '*/*', 'Connection': 'keep-alive'}
+
+    for attempt in range(2):
+        conn, fresh = pool.acquire()
+        try:
+            time_connect = 0.0
+            if fresh:
+                start = time.monotonic()
+                conn.connect()
+                time_connect = time.monotonic() - start
+
+            conn.request('POST', pool.path, body=payload, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+            pool.release(conn, reusable=not response.will_close)
+            return response.status, time_connect, body
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            pool.release(conn, reusable=False)
+            # stale keep-alive connection, try again on a new one
+            if fresh or attempt:
+                raise
+        except Exception:
+            pool.release(conn, reusable=False)
+            raise
+
+
+def get_search_journey(content):
+    """
+    Validate the response: a json with the searchJourney list, as processing.extract_journeys() expects.
+    API errors (e.g. {"errors": [...]} or an html page of a proxy) are not valid.
+
+    Parameters:
+    - content (bytes) : single lined response.
+
+    Return:
+    - dict : parsed response (see processing.parse_response).
+    - None : not a valid searchJourney response.
+    """
+    parsed_line = processing.parse_response(content)
+    try:
+        if not isinstance(parsed_line['data']['searchJourney'], list):
+            return None
+    except (KeyError, TypeError):
+        return None
+    return parsed_line
+
+
+def backoff_delay(attempt, backoff=BACKOFF, cap=BACKOFF_CAP):
+    """
+    Seconds to wait before the repeat: random in [0, backoff * 2^attempt] ("full jitter"), so the requests
+    failed at the same moment are not repeated at the same moment.
+
+    Parameters:
+    - attempt (int) : number of the failed attempt, from 0.
+    - backoff (float) : max delay after the first attempt.
+    - cap (float) : max delay.
+
+    Return:
+    - float : seconds.
+    """
+    return random.uniform(0, min(cap, backoff * 2 ** attempt))
+
+
+def request_journeys(pool, limiter, template, direction, dep_date, log_file=REQUEST_LOG, retries=RETRIES,
+                     backoff=BACKOFF):
+    """
+    Request journeys for the single direction and departure date, log it like request.sh does.
+    Failed requests and invalid responses (see get_search_journey) are repeated with jittered exponential
+    backoff, unless the status code is a permanent error.
+
+    Parameters:
+    - pool (ConnectionPool) : connection pool.
+    - limiter (RateLimiter) : requests rate limiter.
+    - template (str) : payload template.
+    - direction (str) : direction in format FROM TO.
+    - dep_date (str) : departure date in yyyy-mm-dd format.
+    - log_file (str) : request log file path.
+    - retries (int) : max number of repeats.
+    - backoff (float) : max seconds to wait before the first repeat, doubled for every next one.
+
+    Return:
+    - bytes : single lined valid response content. Empty if request failed.
+    """
+    departure, arrival = direction.split(' ')
+    payload = build_payload(template, departure, arrival, dep_date)
+
+    for attempt in range(retries + 1):
+        limiter.wait()
+        metrics.increment('requests')
+        try:
+            status, time_connect, body = post(pool, payload)
+        except Exception as e:
+            # curl reports 000 as status code when no response was received
+            status, time_connect, body = '000', 0.0, b''
+            metrics.increment('requests_failed')
+            log(f"{departure}, {arrival}, {dep_date}, Error: {e}", log_file, 'ERROR')
+        metrics.increment('bytes_downloaded', len(body))
+
+        parameters = 'Status Code: {}, Time to Connect: {:.6f}, Bytes Downloaded: {}'.format(status, time_connect,
+                                                                                          len(body))
+        log(f"{departure}, {arrival}, {dep_date}, {parameters}", log_file)
+
+        # keep one response per line in the raw file
+        content = body.strip().replace(b'\n', b' ')
+        if status == 200 and get_search_journey(content) is not None:
+            return content
+
+        if status != '000':
+            metrics.increment('responses_invalid')
+        if attempt == retries or (status != '000' and status != 200 and status not in RETRY_STATUSES):
+            break
+        delay = backoff_delay(attempt, backoff)
+        metrics.increment('requests_retried')
+        log(f"{departure}, {arrival}, {dep_date}, Retry {attempt + 1} of {retries} in {delay:.1f} s", log_file,
+            'WARNING')
+        time.sleep(delay)
+
+    log(f"{departure}, {arrival}, {dep_date}, No valid response after {attempt + 1} attempts", log_file, 'ERROR')
+    return b''
+
+
+def get_departure_dates(days_forward, date_from=None):
+    """
+    Dates of departure to request: days_forward days starting from date_from.
+
+    Parameters:
+    - days_forward (int) : number of days.
+    - date_from (datetime.date) : first date, today by default.
+
+    Return:
+    - list : dates in yyyy-mm-dd format.
+    """
+    date_from = date_from or datetime.date.today()
+    return [(date_from + datetime.timedelta(days=i)).isoformat() for i in range(days_forward)]
+
+
+def get_raw_path(destination_folder, direction, request_date, codec=''):
+    """
+    Path to raw file of the direction and date of request.
+
+    Parameters:
+    - destination_folder (str) : root folder.
+    - direction (str) : direction in format FROM TO.
+    - request_date (str) : date of request in yyyy-mm-dd format.
+    - codec (str) : compression codec, empty for plain text.
+
+    Return:
+    - str : destination_folder/direction/yyyy-mm-dd.txt (with compression suffix if any).
+    """
+    return os.path.join(destination_folder, direction, request_date + '.txt' + compression.SUFFIXES.get(codec, ''))
+
+
+def response_hash(content):
+    """
+    Content hash of the journeys in the response (see processing.content_hash).
+
+    Parameters:
+    - content (bytes) : single lined response.
+
+    Return:
+    - str : hex digest.
+    - None : not a valid searchJourney response, it's never treated as unchanged.
+    """
+    parsed_line = get_search_journey(content)
+    if parsed_line is None:
+        return None
+    return processing.content_hash(parsed_line)
+
+
+def stream_responses(pool, limiter, template, directions, dep_dates, window, log_file=REQUEST_LOG):
+    """
+    Request all the directions and departure dates concurrently and yield responses in order
+    (direction by direction, departure dates in order), as soon as they are ready.
+
+    At most window requests are done ahead of the consumer, so a slow consumer holds
+    the requests back instead of piling responses up in memory.
+
+    Parameters:
+    - pool (ConnectionPool) : connection pool, its size is the number of requests in flight.
+    - limiter (RateLimiter) : requests rate limiter.
+    - template (str) : payload template.
+    - directions (iter) : list of directions.
+    - dep_dates (list) : departure dates in yyyy-mm-dd format.
+    - window (int) : max number of responses requested ahead (at least the pool size to keep it busy).
+    - log_file (str) : request log file path.
+
+    Return:
+    - generator : (direction, departure date, single lined response content, empty if request failed).
+    """
+    requests = ((direction, dep_date) for direction in directions for dep_date in dep_dates)
+    pending = collections.deque()
+
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        try:
+            for direction, dep_date in requests:
+                pending.append((direction, dep_date, executor.submit(request_journeys, pool, limiter, template,
+                                                                     direction, dep_date, log_file)))
+                # the window is full, wait for the oldest response
+                if len(pending) >= window:
+                    direction, dep_date, future = pending.popleft()
+                    yield direction, dep_date, future.result()
+
+            while pending:
+                direction, dep_date, future = pending.popleft()
+                yield direction, dep_date, future.result()
+        finally:
+            # the consumer stopped early, requests which haven't started are not needed
+            for _, _, future in pending:
+                future.cancel()
+
+
+def extract(directions, destination_folder, days_forward, url=API_URL, concurrency=8, rate_limit=5.0,
+            payload_file=PAYLOAD_FILE, log_file=REQUEST_LOG, codec='', catalog_file='', dedup=False, schedule=None,
+            retries=RETRIES, backoff=BACKOFF, resume=False, index=True):
+    """
+    Request all the directions for days_forward days concurrently and append responses to
+    destination_folder/<direction>/<today>.txt (.txt.gz, .txt.zst if compressed),
+    in the same order as extract_load.sh does. Only valid responses are written (see request_journeys).
+
+    With the catalog, the outcome of every request is checkpointed as soon as its response is in the raw file
+    (see catalog.set_checkpoint), and a resumed extract requests only the dates which are not done yet.
+
+    Parameters:
+    - directions (iter) : list of directions.
+    - destination_folder (str) : root folder.
+    - days_forward (int) : how many days from today to request.
+    - url (str) : API endpoint (a local stub server for testing).
+    - concurrency (int) : max number of requests in flight (and pooled connections).
+    - rate_limit (float) : max requests per second, 0 for no limit.
+    - payload_file (str) : payload template path.
+    - log_file (str) : request log file path.
+    - codec (str) : 'gzip' or 'zstd' to compress every response as a separate frame, empty for plain text.
+    - catalog_file (str) : catalog file to keep the checkpoint and content hashes of the stored responses in,
+      needed for resume, dedup and schedule.
+    - dedup (bool) : replace a response with the same journeys as the stored one for the direction and
+      departure date by a short "unchanged" marker (see processing.unchanged_marker).
+    - schedule (dict) : {direction: departure dates to request} (see scheduler.get_scheduled_dates), other
+      dates which have been stored before are written as "unchanged" markers without request.
+      Directions which are not in the schedule are requested for all the dates.
+    - retries (int) : max number of repeats of a failed request.
+    - backoff (float) : max seconds to wait before the first repeat, doubled for every next one.
+    - resume (bool) : continue the checkpoint of today's extract, the responses written before are kept.
+      A new checkpoint is started otherwise.
+    - index (bool) : write the sidecar index of every raw file (see raw_index), the departure date, time
+      of request, offset and length of every response, for reading single responses without parsing the file.
+
+    Return:
+    - int : number of responses written.
+    """
+    template = read_payload_template(payload_file)
+    current_date = datetime.date.today().isoformat()
+    dep_dates = get_departure_dates(days_forward)
+
+    pool = ConnectionPool(url, size=concurrency)
+    limiter = RateLimiter(rate_limit)
+    written = 0
+
+    # requests which have been done today already, if resumed
+    done = {}
+    if catalog_file:
+        if resume:
+            done = catalog.get_checkpoints(catalog_file, current_date, 'done')
+        else:
+            catalog.clear_checkpoints(catalog_file, current_date)
+
+    # content hashes of the stored responses are needed to skip both unchanged and not requested ones
+    track_hashes = bool(catalog_file) and (dedup or schedule is not None)
+    known_hashes = {direction: catalog.get_response_hashes(catalog_file, direction) if track_hashes else {}
+                    for direction in directions}
+
+    def is_requested(direction, dep_date):
+        # not scheduled dates are skipped only if there is a stored response to refer to
+        if not track_hashes or schedule is None or direction not in schedule:
+            return True
+        return dep_date in schedule[direction] or dep_date not in known_hashes[direction]
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # schedule everything at once, the pool and the limiter keep the pace
+            futures = {direction: [(dep_date, executor.submit(request_journeys, pool, limiter, template, direction,
+                                                              dep_date, log_file, retries, backoff)
+                                        if is_requested(direction, dep_date) else None)
+                                   for dep_date in dep_dates if (direction, dep_date) not in done]
+                       for direction in directions}
+
+            for direction in directions:
+                # create a folder for destination
+                os.makedirs(os.path.join(destination_folder, direction), exist_ok=True)
+                output_file = get_raw_path(destination_folder, direction, current_date, codec)
+
+                # hashes of the responses stored before, and of the changed ones
+                known = known_hashes[direction]
+                changed = {}
+
+                # the index catches up with the responses written before (e.g. by extract_load.sh or resumed extract)
+                indexed = index and (not os.path.exists(output_file) or raw_index.update_index(output_file) is not None)
+                index_path = raw_index.get_index_path(output_file)
+
+                # write responses in order of departure dates as soon as they are ready
+                with open(output_file, 'ab') as file, \
+                        raw_index.open_index(index_path) if indexed else contextlib.nullcontext() as index_file:
+                    for dep_date, future in futures[direction]:
+                        if future is None:
+                            # not scheduled today, refers to the stored response
+                            content = processing.unchanged_marker(known[dep_date][0], dep_date, known[dep_date][1])
+                            metrics.increment('requests_skipped')
+                        else:
+                            content = future.result()
+                            checksum = response_hash(content) if content and track_hashes else None
+                            if checksum and dedup and known.get(dep_date, ('',))[0] == checksum:
+                                # the same journeys as in the raw file of known request date
+                                content = processing.unchanged_marker(checksum, dep_date, known[dep_date][1])
+                                metrics.increment('responses_unchanged')
+                            elif checksum and known.get(dep_date, ('',))[0] != checksum:
+                                changed[dep_date] = (checksum, current_date)
+
+                        if content:
+                            frame = compression.compress_frame(content + b'\n', codec)
+                            offset = file.tell()
+                            file.write(frame)
+                            metrics.increment('bytes_written', len(frame))
+                            written += 1
+                            if index_file:
+                                raw_index.write_entry(index_file, dep_date,
+                                                      datetime.datetime.now().isoformat(timespec='seconds'),
+                                                      offset, len(frame))
+
+                        # the response is in the file before it's checkpointed, resume never loses it
+                        if catalog_file:
+                            file.flush()
+                            catalog.set_checkpoint(catalog_file, current_date, direction, dep_date,
+                                                   'done' if content else 'failed')
+
+                if changed:
+                    catalog.set_response_hashes(catalog_file, direction, changed)
+    finally:
+        pool.close()
+
+    return written
@@ -1,24 +1,184 @@
+import atexit
 import datetime
+import json
+import os
+import threading
+import time
+from Utilities import parameters
 
-def log(message, logfile):
+# get configs from config.txt
+CONFIGS = parameters.get_configs()
+
+# levels of log records, records below LOG_LEVEL are dropped
+LEVELS = {
+    'DEBUG': 10,
+    'INFO': 20,
+    'WARNING': 30,
+    'ERROR': 40,
+}
+
+# minimal level to write
+LOG_LEVEL = CONFIGS.get('LOG_LEVEL', '"INFO"')[1:-1] or 'INFO'
+
+# record format: "text" for [date time] message lines, "json" for one json object per line
+LOG_FORMAT = CONFIGS.get('LOG_FORMAT', '"text"')[1:-1] or 'text'
+
+# buffered records are written at least every LOG_FLUSH_INTERVAL seconds
+LOG_FLUSH_INTERVAL = float(CONFIGS.get('LOG_FLUSH_INTERVAL', 1))
+
+# write buffered records from a background thread instead of the logging threads
+# (long-running processes start it anyway, see start_flush_thread)
+LOG_BACKGROUND = CONFIGS.get('LOG_BACKGROUND', '0') == '1'
+
+# max number of buffered records per file before they are written
+BUFFER_SIZE = 1000
+
+# open log files and records waiting to be written, by log file path
+_files = {}
+_buffers = {}
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+_writer = None
+
+# timestamp is formatted once per second
+_timestamp = [0, '']
+
+
+def _format_record(message, level):
+    now = time.time()
+    second = int(now)
+    if second != _timestamp[0]:
+        _timestamp[0], _timestamp[1] = second, datetime.datetime.fromtimestamp(second).strftime('%Y-%m-%d %H:%M:%S')
+
+    if LOG_FORMAT == 'json':
+        return json.dumps({'time': _timestamp[1], 'level': level, 'pid': os.getpid(), 'message': str(message)},
+                          ensure_ascii=False) + '\n'
+    return "[{}] {}\n".format(_timestamp[1], message)
+
+
+def _write(logfile):
+    # write all the buffered records of the file with a single call, the lock is held by the caller
+    records = _buffers.get(logfile)
+    if not records:
+        return
+    try:
+        file = _files[logfile]
+        file.write(''.join(records))
+        file.flush()
+    except Exception as e:
+        print(f"Error writing output to {logfile}: {e}")
+    records.clear()
+
+
+def _background_flush():
+    while True:
+        time.sleep(LOG_FLUSH_INTERVAL or 1)
+        flush_logs()
+
+
+def _start_writer():
+    # start the writer (again after fork, threads aren't inherited), the lock is held by the caller
+    global _writer
+
+    if _writer is None:
+        _writer = threading.Thread(target=_background_flush, name='log-writer', daemon=True)
+        _writer.start()
+
+
+def log(message, logfile, level='INFO'):
     """
-    Write log message into file (process_log.txt by default) in format [date time] message.
+    Write log message into file in format [date time] message (or json record, see LOG_FORMAT).
+
+    Records are buffered and the file is kept open, buffer is written when it's full, when an error
+    is logged, every LOG_FLUSH_INTERVAL seconds and at exit. Processes which don't run atexit handlers
+    (pool workers) have to call flush_logs() themselves, long-running ones start_flush_thread().
 
     Parameters:
     - message (str) : message to log.
     - logfile (str) : output file path.
+    - level (str) : 'DEBUG', 'INFO', 'WARNING' or 'ERROR'.
 
     Return:
-    - bool: True if writing is successful, False otherwise.
+    - bool: True if the record is accepted (or dropped by level), False otherwise.
     """
-    current_datetime = datetime.datetime.now()
-    formatted_datetime = current_datetime.strftime('%Y-%m-%d %H:%M:%S')
+    global _last_flush
 
-    try:
-        with open(logfile, 'a') as file:
-            file.write("[{}] {}\n".format(formatted_datetime, message))
+    if LEVELS.get(level, 20) < LEVELS.get(LOG_LEVEL, 20):
         return True
-    except Exception as e:
-        print(f"Error writing output to {logfile}: {e}")
-        return False
 
+    record = _format_record(message, level)
+
+    with _lock:
+        # open the file once, on the first record
+        if logfile not in _files:
+            try:
+                _files[logfile] = open(logfile, 'a')
+                _buffers[logfile] = []
+            except Exception as e:
+                print(f"Error writing output to {logfile}: {e}")
+                return False
+
+        records = _buffers[logfile]
+        records.append(record)
+        if len(records) >= BUFFER_SIZE or LEVELS.get(level, 20) >= LEVELS['ERROR']:
+            _write(logfile)
+
+        if LOG_BACKGROUND:
+            _start_writer()
+        if _writer is not None:
+            return True
+
+        now = time.monotonic()
+        if now - _last_flush >= LOG_FLUSH_INTERVAL:
+            _last_flush = now
+            for path in _buffers:
+                _write(path)
+    return True
+
+
+def flush_logs():
+    """
+    Write all the buffered records to their files.
+    """
+    global _last_flush
+
+    with _lock:
+        for logfile in _buffers:
+            _write(logfile)
+        _last_flush = time.monotonic()
+
+
+def start_flush_thread():
+    """
+    Write buffered records every LOG_FLUSH_INTERVAL seconds from a background thread, whatever LOG_BACKGROUND is.
+    Without it the records are written by the next log() call, so a long-running process (worker, service)
+    would keep its last records while it's idle.
+    """
+    with _lock:
+        _start_writer()
+
+
+def close_logs():
+    """
+    Write all the buffered records and close log files.
+    """
+    flush_logs()
+    with _lock:
+        for file in _files.values():
+            file.close()
+        _files.clear()
+        _buffers.clear()
+
+
+def _reset_after_fork():
+    # the child starts with no buffered records of the parent (they were written before fork)
+    # and its own lock and writer thread
+    global _lock, _writer
+    _lock = threading.Lock()
+    _writer = None
+    for records in _buffers.values():
+        records.clear()
+
+
+atexit.register(close_logs)
+os.register_at_fork(before=flush_logs, after_in_child=_reset_after_fork)
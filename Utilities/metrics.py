@@ -0,0 +1,260 @@
+import cProfile
+import datetime
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from Utilities import parameters
+
+# get configs from config.txt
+CONFIGS = parameters.get_configs()
+
+# folder for prometheus textfiles (node_exporter textfile collector), empty to not write them
+METRICS_TEXTFILE_DIR = CONFIGS.get('METRICS_TEXTFILE_DIR', '""')[1:-1]
+
+# json lines file with run summaries, empty to not write them
+METRICS_SUMMARY_FILE = CONFIGS.get('METRICS_SUMMARY_FILE', '""')[1:-1]
+
+# prefix of exported metrics
+PREFIX = 'trains_elt_'
+
+# counters and their descriptions, every counter is labelled by stage
+COUNTERS = {
+    'stage_seconds': 'Wall time spent in the stage (summed over workers)',
+    'bytes_read': 'Bytes of files read',
+    'bytes_written': 'Bytes of files written',
+    'requests': 'API requests made',
+    'requests_failed': 'API requests without response',
+    'requests_retried': 'API requests repeated after a failure or an invalid response',
+    'requests_skipped': 'Departure dates not requested by the schedule',
+    'bytes_downloaded': 'Bytes of API responses',
+    'responses_invalid': 'API responses with an error status or without searchJourney list',
+    'responses_parsed': 'Responses parsed from raw files',
+    'responses_failed': 'Raw file lines which could not be parsed',
+    'responses_unchanged': 'Responses stored as unchanged markers',
+    'journeys_emitted': 'Journeys extracted from responses',
+    'journeys_skipped': 'Journeys skipped because of error',
+    'rows_loaded': 'Rows loaded to the database',
+    'rows_rejected': 'Rows rejected while loading to the database',
+    'rows_updated': 'Rows of changed journeys updated in place by upsert',
+    'rows_unchanged': 'Rows skipped by upsert because the same journey is stored already',
+    'db_round_trips': 'Statements sent to the database',
+    'tasks_done': 'Work queue tasks completed',
+    'tasks_failed': 'Work queue tasks failed (retried until max attempts)',
+    'tasks_lost': 'Work queue tasks done after their lease had expired and been taken over',
+}
+
+# counters of the process: {(name, stage): value}
+_counters = {}
+_lock = threading.Lock()
+
+# stage the counters are recorded to
+_stage = ['main']
+
+# start of the run
+_started = [time.time()]
+
+
+def increment(name, value=1):
+    """
+    Add value to the counter of the current stage.
+
+    Parameters:
+    - name (str) : counter name, one of COUNTERS.
+    - value (int or float) : value to add.
+    """
+    key = (name, _stage[0])
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+@contextmanager
+def stage(name):
+    """
+    Record counters of the block to the stage and add its wall time to stage_seconds:
+
+        with metrics.stage('load'):
+            ...
+    """
+    previous = _stage[0]
+    _stage[0] = name
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        increment('stage_seconds', time.perf_counter() - start_time)
+        _stage[0] = previous
+
+
+@contextmanager
+def collect():
+    """
+    Record counters of the block separately, e.g. in a pool worker, to return them to the parent
+    process and merge() there. Yields dict which is filled when the block is finished.
+    """
+    global _counters
+    collected = {}
+    saved, _counters = _counters, {}
+    try:
+        yield collected
+    finally:
+        collected.update(_counters)
+        _counters = saved
+
+
+def merge(counters):
+    """
+    Add counters recorded elsewhere (see collect()) to the counters of the process.
+
+    Parameters:
+    - counters (dict) : {(name, stage): value}.
+    """
+    with _lock:
+        for key, value in counters.items():
+            _counters[key] = _counters.get(key, 0) + value
+
+
+def snapshot():
+    """
+    Return:
+    - dict : {stage: {counter name: value}}.
+    """
+    with _lock:
+        result = {}
+        for (name, stage_name), value in sorted(_counters.items()):
+            result.setdefault(stage_name, {})[name] = value
+        return result
+
+
+def write_textfile(job, textfile_dir=None):
+    """
+    Write counters of the run to <textfile_dir>/trains_elt_<job>.prom in prometheus text format.
+    The file is replaced atomically, so the collector never reads it half written.
+
+    Every run replaces the values of the previous one, so they are exported as gauges
+    trains_elt_<counter>_last_run: a counter that starts over every run would look unchanged (or reset)
+    to rate() and increase().
+
+    Parameters:
+    - job (str) : name of the run, e.g. 'transform'.
+    - textfile_dir (str) : folder, METRICS_TEXTFILE_DIR by default.
+
+    Return:
+    - bool: True if written, False otherwise.
+    """
+    textfile_dir = textfile_dir or METRICS_TEXTFILE_DIR
+    if not textfile_dir:
+        return False
+
+    lines = []
+    counters = snapshot()
+    for name, description in COUNTERS.items():
+        metric = f"{PREFIX}{name}_last_run"
+        lines.append(f"# HELP {metric} {description} in the last run.")
+        lines.append(f"# TYPE {metric} gauge")
+        for stage_name, values in counters.items():
+            if name in values:
+                lines.append(f'{metric}{{job="{job}",stage="{stage_name}"}} {values[name]}')
+
+    lines.append(f"# HELP {PREFIX}run_seconds Wall time of the last run.")
+    lines.append(f"# TYPE {PREFIX}run_seconds gauge")
+    lines.append(f'{PREFIX}run_seconds{{job="{job}"}} {time.time() - _started[0]:.3f}')
+    lines.append(f"# HELP {PREFIX}last_run_timestamp_seconds End of the last run.")
+    lines.append(f"# TYPE {PREFIX}last_run_timestamp_seconds gauge")
+    lines.append(f'{PREFIX}last_run_timestamp_seconds{{job="{job}"}} {time.time():.0f}')
+
+    output_file = os.path.join(textfile_dir, f"{PREFIX}{job}.prom")
+    temp_file = os.path.join(textfile_dir, f".{PREFIX}{job}.prom.{os.getpid()}.tmp")
+    try:
+        os.makedirs(textfile_dir, exist_ok=True)
+        with open(temp_file, 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(temp_file, output_file)
+        return True
+    except Exception as e:
+        print(f"Error writing output to {output_file}: {e}")
+        return False
+
+
+def write_summary(job, summary_file=None):
+    """
+    Append json summary of the run (start, end, wall time and counters by stage) to summary_file.
+
+    Parameters:
+    - job (str) : name of the run, e.g. 'transform'.
+    - summary_file (str) : json lines file, METRICS_SUMMARY_FILE by default.
+
+    Return:
+    - bool: True if written, False otherwise.
+    """
+    summary_file = summary_file or METRICS_SUMMARY_FILE
+    if not summary_file:
+        return False
+
+    finished = time.time()
+    summary = {
+        'job': job,
+        'started': datetime.datetime.fromtimestamp(_started[0]).isoformat(timespec='seconds'),
+        'finished': datetime.datetime.fromtimestamp(finished).isoformat(timespec='seconds'),
+        'seconds': round(finished - _started[0], 3),
+        'stages': snapshot(),
+    }
+    try:
+        with open(summary_file, 'a') as file:
+            file.write(json.dumps(summary) + '\n')
+        return True
+    except Exception as e:
+        print(f"Error writing output to {summary_file}: {e}")
+        return False
+
+
+def export(job):
+    """
+    Write both prometheus textfile and json summary of the run, as configured in config.txt.
+
+    Parameters:
+    - job (str) : name of the run, e.g. 'transform'.
+    """
+    write_textfile(job)
+    write_summary(job)
+
+
+@contextmanager
+def profile(output_file=None):
+    """
+    Profile the block with cProfile and dump stats to output_file (readable by pstats, snakeviz,
+    or flameprof/gprof2dot for flame graphs). Does nothing if output_file is empty.
+
+    Parameters:
+    - output_file (str) : .prof file path.
+    """
+    if not output_file:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(output_file)
+
+
+def merge_profiles(profile_files, output_file):
+    """
+    Merge stats dumped by several processes into one file and remove the parts.
+
+    Parameters:
+    - profile_files (list) : .prof files.
+    - output_file (str) : merged .prof file path.
+    """
+    profile_files = [profile_file for profile_file in profile_files if os.path.exists(profile_file)]
+    if not profile_files:
+        return
+    pstats.Stats(*profile_files).dump_stats(output_file)
+    for profile_file in profile_files:
+        if profile_file != output_file:
+            os.remove(profile_file)
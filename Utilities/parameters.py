@@ -1,5 +1,6 @@
 import datetime
 import os
+from Utilities import compression
 
 
 def get_configs():
@@ -34,11 +35,54 @@ def get_directions():
         return []
 
 
+def split_file_name(file_name):
+    """
+    Split data file name yyyy-mm-dd.ext (or compressed yyyy-mm-dd.ext.gz) into date and extension.
+
+    Parameters:
+    - file_name (str) : file name or path.
+
+    Return:
+    - tuple : (datetime.date, extension without compression suffix).
+    """
+    file_date, extension = os.path.basename(compression.strip_suffix(file_name)).split('.', 1)
+    return datetime.date.fromisoformat(file_date), extension
+
+
+def get_request_date(file_path):
+    """
+    Request date of the data file: its name without extension.
+
+    Parameters:
+    - file_path (str) : path to file.
+
+    Return:
+    - str : date in yyyy-mm-dd format.
+    """
+    return split_file_name(file_path)[0].isoformat()
+
+
+def get_output_path(file_path, extension):
+    """
+    Path to the file with the same name but another extension, e.g. raw file -> csv file.
+
+    Parameters:
+    - file_path (str) : path to file, maybe compressed.
+    - extension (str) : new extension, without '.'
+
+    Return:
+    - str : path to output file.
+    """
+    folder = os.path.dirname(file_path)
+    return os.path.join(folder, get_request_date(file_path) + '.' + extension)
+
+
 def get_files_todo_from_date(destination_folder, directions, extension, date=''):
     """
     Returns list of all files named yyyy-mm-dd.xxx in all directions starting from the given date.
 
-    Function compares the name of file with the given date.
+    Function compares the name of file with the given date. Compressed files (yyyy-mm-dd.xxx.gz)
+    are included.
 
     Parameters:
     - destination_folder (str) : root folder.
@@ -58,8 +102,8 @@ def get_files_todo_from_date(destination_folder, directions, extension, date='')
         for file_name in os.listdir(os.path.join(destination_folder, direction)):
             try:
                 # file to process must be named yyyy-mm-dd.txt
-                file_date = datetime.date.fromisoformat(file_name[:-4])
-                if file_date >= date_from and file_name[-3:] == extension:
+                file_date, file_extension = split_file_name(file_name)
+                if file_date >= date_from and file_extension == extension:
                     # add full path to the result
                     path = os.path.join(destination_folder, direction, file_name)
                     files_todo_list.append(path)
@@ -93,7 +137,12 @@ def get_files_todo_unpaired(destination_folder, directions):
             path = os.path.join(destination_folder, direction, file_name)
 
             # check if file with the same name but .csv exists
-            if not os.path.exists(path[:-3] + 'csv'):
+            try:
+                csv_path = get_output_path(path, 'csv')
+            except ValueError:
+                # not a data file
+                continue
+            if not os.path.exists(csv_path):
                 # add path to the result if not
                 files_todo_list.append(path)
 
@@ -0,0 +1,178 @@
+import collections
+import threading
+import time
+from Utilities import psql
+
+# default seconds a cached answer is served without asking the db
+CACHE_TTL = 300
+
+# default max number of cached answers, the least recently used ones are evicted first
+CACHE_SIZE = 1024
+
+
+class TTLCache:
+    """
+    Thread-safe cache with time to live and least recently used eviction.
+    Keys are tuples, the second item is the table name the value is read from (see invalidate()).
+    """
+
+    def __init__(self, max_size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Return:
+        - object : cached value, None if there is no fresh one.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, table_name=None):
+        """
+        Remove cached values of the table, or all of them if table_name is None.
+
+        Return:
+        - int : number of removed values.
+        """
+        with self.lock:
+            keys = [key for key in self.entries if table_name is None or key[1] == table_name]
+            for key in keys:
+                del self.entries[key]
+            return len(keys)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'max_size': self.max_size, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+class PriceCalendar:
+    """
+    Read API over the summary tables: price calendar of a direction and trains of a departure date.
+
+    Answers are cached in memory. Cached answers of a direction are dropped as soon as its summaries are
+    refreshed (psql.refresh_summaries() notifies SUMMARY_CHANNEL, see listen()), the TTL is a fallback
+    for missed notifications. Many clients asking for the same missing answer wait for a single db query.
+
+        calendar = PriceCalendar(directions)
+        calendar.listen()
+        calendar.get_calendar('HKI TPE', '2024-01-01', '2024-01-31')
+    """
+
+    def __init__(self, directions, max_size=CACHE_SIZE, ttl=CACHE_TTL, db_connections=psql.POOL_SIZE):
+        # make direction names compatible to postgres
+        self.tables = {direction: direction.replace(' ', '_').lower() for direction in directions}
+        self.cache = TTLCache(max_size, ttl)
+        # pool raises instead of waiting when all the connections are taken, so the queries wait here
+        self.db_slots = threading.BoundedSemaphore(db_connections)
+        self.loading = {}
+        self.loading_lock = threading.Lock()
+        # invalidations by table, an answer loaded during invalidation is not cached
+        self.versions = collections.defaultdict(int)
+        self.stop_event = threading.Event()
+        self.listener = None
+
+    def _cached(self, key, query, *args):
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+
+        # single query per key, the others wait for it and take its answer from the cache
+        with self.loading_lock:
+            key_lock = self.loading.setdefault(key, threading.Lock())
+        with key_lock:
+            value = self.cache.get(key)
+            if value is None:
+                version = self.versions[key[1]]
+                with self.db_slots:
+                    value = query(key[1], *args)
+                if value is not None and version == self.versions[key[1]]:
+                    self.cache.put(key, value)
+        with self.loading_lock:
+            self.loading.pop(key, None)
+        return value
+
+    def get_calendar(self, direction, date_from=None, date_to=None):
+        """
+        Price calendar of the direction: the cheapest and the most expensive journey of every departure date.
+
+        Parameters:
+        - direction (str) : direction in format FROM TO.
+        - date_from (str) : the first departure date in yyyy-mm-dd format, all dates if None.
+        - date_to (str) : the last departure date in yyyy-mm-dd format, all dates if None.
+
+        Return:
+        - list : {'dep_date', 'min', 'max'} dicts ordered by dep_date.
+        - None : unknown direction or db error.
+        """
+        if direction not in self.tables:
+            return None
+        rows = self._cached(('calendar', self.tables[direction], date_from, date_to), psql.get_price_calendar,
+                            date_from, date_to)
+        if rows is None:
+            return None
+        return [{'dep_date': str(dep_date), 'min': float(min_price), 'max': float(max_price)}
+                for dep_date, min_price, max_price in rows]
+
+    def get_trains(self, direction, dep_date):
+        """
+        Trains of the direction on the departure date from the latest snapshot.
+
+        Parameters:
+        - direction (str) : direction in format FROM TO.
+        - dep_date (str) : departure date in yyyy-mm-dd format.
+
+        Return:
+        - list : {'dep_time', 'arr_date', 'arr_time', 'time_travel', 'eco_seats_available', 'price',
+          'request_date'} dicts ordered by dep_time.
+        - None : unknown direction or db error.
+        """
+        if direction not in self.tables:
+            return None
+        rows = self._cached(('trains', self.tables[direction], dep_date), psql.get_trains, dep_date)
+        if rows is None:
+            return None
+        return [{'dep_time': str(dep_time), 'arr_date': str(arr_date), 'arr_time': str(arr_time),
+                 'time_travel': str(time_travel), 'eco_seats_available': seats, 'price': float(price),
+                 'request_date': str(request_date)}
+                for dep_time, arr_date, arr_time, time_travel, seats, price, request_date in rows]
+
+    def invalidate(self, table_name=None):
+        """
+        Drop cached answers of the table, or all of them if table_name is None (e.g. notifications were missed).
+        """
+        for known_table in ([table_name] if table_name else list(self.tables.values())):
+            self.versions[known_table] += 1
+        self.cache.invalidate(table_name)
+
+    def listen(self):
+        """
+        Start a background thread invalidating the cache on notifications of refreshed summaries.
+        """
+        self.listener = threading.Thread(target=psql.listen, args=(psql.SUMMARY_CHANNEL, self.invalidate,
+                                                                   self.stop_event),
+                                         name='summaries listener', daemon=True)
+        self.listener.start()
+
+    def close(self):
+        self.stop_event.set()
+        if self.listener is not None:
+            self.listener.join()
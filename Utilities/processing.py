@@ -1,7 +1,28 @@
+import csv
 import json
 import datetime
+import hashlib
+import os
+import zoneinfo
+from Utilities import compression
+from Utilities import metrics
 from Utilities.log import log
 
+# faster json backend if installed, standard json otherwise
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# write buffer size for csv output
+CSV_BUFFER_SIZE = 1024 * 1024
+
+# product attributes of a leg (27 of them for long-distance trains), only the eco class seat one is extracted
+PRODUCT_ATTRIBUTES_KEY = b'"productAttributes":['
+ECO_SEAT_NAME = b'"name":"ECO_CLASS_SEAT"'
+ECO_SEAT_ATTRIBUTE = b'"attribute":null'
+
 # Hard coding of headers to the output file
 HEADERS = [
     'journey_id',
@@ -16,31 +37,158 @@ HEADERS = [
     'request_date',
 ]
 
+# local time zone of departures and arrivals, the date and time of departure are in it
+TIMEZONE = 'Europe/Helsinki'
+_timezone = zoneinfo.ZoneInfo(TIMEZONE)
+
+# headers of the unified fact table rows (see extract_facts): direction, HEADERS and the columns computed once
+# at transform time instead of every query
+FACT_HEADERS = ['direction'] + HEADERS + ['dep_date', 'dep_time', 'travel_duration']
+
 
 def parse_json_line(line):
     """
     Parsing single line json into dict.
 
     Parameters:
-    - line (str) : single lined json expression.
+    - line (str or bytes) : single lined json expression.
 
     Return:
     - parsed_line (dict) : parsed json expression successfully.
     - None : string couldn't be parsed for any reason.
     """
     try:
-        parsed_line = json.loads(line)
+        parsed_line = json_loads(line)
         return parsed_line
     except Exception as e:
-        log(e, "./logs/processing_log.txt")
-        log(line + "\ncouldn't be parsed", "./logs/processing_log.txt")
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', errors='replace').rstrip('\n')
+        log(e, "./logs/processing_log.txt", "WARNING")
+        log(line + "\ncouldn't be parsed", "./logs/processing_log.txt", "WARNING")
         return None
 
 
+def _eco_seat_attribute(attributes):
+    # the first {...} item of productAttributes with ECO_CLASS_SEAT name and null attribute, None if not found
+    position = 0
+    while True:
+        position = attributes.find(ECO_SEAT_NAME, position)
+        if position < 0:
+            return None
+        start = attributes.rfind(b'{', 0, position)
+        end = attributes.find(b'}', position)
+        if start < 0 or end < 0:
+            return None
+        if ECO_SEAT_ATTRIBUTE in attributes[start:end]:
+            return attributes[start:end + 1]
+        position = end
+
+
+def prune_response(line):
+    """
+    Cut productAttributes lists of the response down to the single item extract_journeys() needs
+    (ECO_CLASS_SEAT without attribute) before parsing, so the other 26 dictionaries of every leg
+    are never built. Lists in an unexpected shape (nested lists, no such item) are left as they are.
+
+    Parameters:
+    - line (bytes) : single lined json response.
+
+    Return:
+    - bytes : the same response with pruned productAttributes lists.
+    """
+    parts = []
+    position = 0
+    while True:
+        start = line.find(PRODUCT_ATTRIBUTES_KEY, position)
+        if start < 0:
+            break
+        start += len(PRODUCT_ATTRIBUTES_KEY)
+        end = line.find(b']', start)
+        if end < 0:
+            break
+
+        attributes = line[start:end]
+        eco_seat = _eco_seat_attribute(attributes) if b'[' not in attributes else None
+        parts.append(line[position:start])
+        parts.append(attributes if eco_seat is None else eco_seat)
+        position = end
+    parts.append(line[position:])
+    return b''.join(parts)
+
+
+def parse_response(line):
+    """
+    Parse single line json response with only the fields extract_journeys() needs, see prune_response().
+    Rows extracted from it are the same as from parse_json_line(), at a fraction of parsing time and memory.
+
+    Parameters:
+    - line (str or bytes) : single lined json response.
+
+    Return:
+    - parsed_line (dict) : parsed json expression successfully.
+    - None : string couldn't be parsed for any reason.
+    """
+    if isinstance(line, str):
+        line = line.encode('utf-8')
+    try:
+        return json_loads(prune_response(line))
+    except Exception:
+        # pruning has broken something unusual, the whole response is parsed (or its error is logged)
+        return parse_json_line(line)
+
+
+def iter_parse_file(file_path, failures=None, unchanged=None, selective=True):
+    """
+    Lazily parse multiline file with json responses, one response at a time.
+
+    Each line is decoded exactly once. Empty lines are skipped silently.
+    By default only the fields needed for extract_journeys() are parsed (see parse_response).
+    Compressed files (.gz, .zst) are decompressed on the fly.
+    "Unchanged" markers written instead of repeated responses (see is_unchanged_marker) are not yielded.
+
+    Parameters:
+    - file_path (str) : path to file.
+    - failures (list) : if given, numbers of lines which couldn't be parsed are appended to it.
+    - unchanged (list) : if given, markers found in the file are appended to it.
+    - selective (bool) : parse only the fields needed for extract_journeys(), False to parse everything.
+
+    Return:
+    - generator : parsed json responses (dict).
+    """
+    try:
+        with compression.open_raw(file_path) as file:
+            for line_number, line in enumerate(file, start=1):
+                metrics.increment('bytes_read', len(line))
+                if not line.strip():
+                    continue
+
+                parsed_line = parse_response(line) if selective else parse_json_line(line)
+                if parsed_line is None:
+                    metrics.increment('responses_failed')
+                    if failures is not None:
+                        failures.append(line_number)
+                    continue
+
+                if is_unchanged_marker(parsed_line):
+                    metrics.increment('responses_unchanged')
+                    if unchanged is not None:
+                        unchanged.append(parsed_line)
+                    continue
+
+                metrics.increment('responses_parsed')
+                yield parsed_line
+    except FileNotFoundError:
+        log(f"Error: File not found - {file_path}", "./logs/processing_log.txt", "ERROR")
+    except Exception as e:
+        log(f"Error: {e}", "./logs/processing_log.txt", "ERROR")
+
+
 def read_parse_file(file_path):
     """
     Parse multiline file with json responses into list of dictionaries.
 
+    Prefer iter_parse_file() for large files, this function keeps the whole file in memory.
+
     Parameters:
     - file_path (str) : path to file.
 
@@ -48,87 +196,309 @@ def read_parse_file(file_path):
     - parsed_file (list with dictionaries) : list of parsed json strings.
     - None : something wrong with file.
     """
-    try:
-        with open(file_path, 'r') as file:
-            parsed_file = [parse_json_line(line) for line in file if parse_json_line(line)]
-        return parsed_file
-    except FileNotFoundError:
-        log(f"Error: File not found - {file_path}", "./logs/processing_log.txt")
-        return None
-    except Exception as e:
-        log(f"Error: {e}", "./logs/processing_log.txt")
+    if not os.path.isfile(file_path):
+        log(f"Error: File not found - {file_path}", "./logs/processing_log.txt", "ERROR")
         return None
+    return list(iter_parse_file(file_path))
 
 
-def process_line_to_csv(parsed_line, request_date):
+def journey_attributes(journey, request_date):
     """
-    Process (extract attributes from) parsed single json response into csv-formatted string.
+    Extract attributes of single journey of the response, without logging or counting anything.
+
+    Parameters:
+    - journey (dict) : journey of parsed json response (without error)
+    - request_date (str) : date of request in yyyy-mm-dd format.
+
+    Return:
+    - list : extracted attributes (str), in HEADERS order.
+    """
+    if journey['legs'][0]['type'] != 'COMMUTER':
+        # productAttributes is a list with 27 dictionaries, from which
+        # ECO_CLASS_SEAT without attributes is needed to be extracted
+        availability = journey['legs'][0]['productAttributes']
+        eco_seats_available = [item['availability'] for item in availability if
+                               item['name'] == 'ECO_CLASS_SEAT' and item['attribute'] is None]
+    # Commuters have no available seats option
+    else:
+        eco_seats_available = [-1]
+
+    # list of all the extracted parameters + request date
+    return [
+        journey['id'],
+        journey['departureTime'],
+        journey['departureStation'],
+        journey['arrivalStation'],
+        journey['arrivalTime'],
+        str(journey['totalPrice'] / 100),
+        journey['legs'][0]['trainNumber'],
+        journey['legs'][0]['trainType'],
+        str(eco_seats_available[0]),
+        request_date,
+    ]
+
+
+def extract_journeys(parsed_line, request_date):
+    """
+    Extract attributes of every journey from parsed single json response.
 
     Parameters:
     - parsed_line (dict) : parsed json response (single)
+    - request_date (str) : date of request in yyyy-mm-dd format.
 
     Return:
-    - str : csv-formatted extracted attributes.
-    Empty string if no attributes could be extracted.
+    - generator : lists of extracted attributes (str), in HEADERS order.
     """
-    result = ''
+    emitted = 0
     try:
         # each response describes 0 or more trip details
         for journey in parsed_line['data']['searchJourney']:
             # sometimes there are journeys with error, which can ruin the loop. Just skip them
             if journey['error']:
                 # print(journey['error'])
+                metrics.increment('journeys_skipped')
                 continue
 
-            if journey['legs'][0]['type'] != 'COMMUTER':
-                # productAttributes is a list with 27 dictionaries, from which
-                # ECO_CLASS_SEAT without attributes is needed to be extracted
-                availability = journey['legs'][0]['productAttributes']
-                eco_seats_available = [item['availability'] for item in availability if
-                                       item['name'] == 'ECO_CLASS_SEAT' and item['attribute'] is None]
-            # Commuters have no available seats option
-            else:
-                eco_seats_available = [-1]
-
-            # list of all the extracted parameters + request date
-            attributes_list = [
-                journey['id'],
-                journey['departureTime'],
-                journey['departureStation'],
-                journey['arrivalStation'],
-                journey['arrivalTime'],
-                str(journey['totalPrice'] / 100),
-                journey['legs'][0]['trainNumber'],
-                journey['legs'][0]['trainType'],
-                str(eco_seats_available[0]),
-                request_date,
-            ]
-
-            # turning into csv format every attributes_list line by line
-            result += ','.join(attributes_list) + '\n'
+            yield journey_attributes(journey, request_date)
+            emitted += 1
     except Exception as e:
-        log(f"Error: {e}", "./logs/processing_log.txt")
-        log(f"line begins: {parsed_line[:60]}", "./logs/processing_log.txt")
-    return result
+        log(f"Error: {e}", "./logs/processing_log.txt", "WARNING")
+        log(f"line begins: {str(parsed_line)[:60]}", "./logs/processing_log.txt", "WARNING")
+    finally:
+        # counted once per response, not per journey
+        metrics.increment('journeys_emitted', emitted)
+
+
+def fact_columns(departure_time, arrival_time):
+    """
+    Local date and time of departure and travel duration of the journey.
+
+    Parameters:
+    - departure_time (str) : ISO 8601 departure time in UTC, e.g. 2024-01-01T05:17:00.000Z
+    - arrival_time (str) : ISO 8601 arrival time in UTC.
+
+    Return:
+    - list : dep_date (yyyy-mm-dd), dep_time (hh:mm:ss) and travel_duration (hh:mm:ss, hours may exceed 24).
+    """
+    departure = datetime.datetime.fromisoformat(departure_time.replace('Z', '+00:00'))
+    arrival = datetime.datetime.fromisoformat(arrival_time.replace('Z', '+00:00'))
+    local_departure = departure.astimezone(_timezone)
+    minutes, seconds = divmod(int((arrival - departure).total_seconds()), 60)
+    return [local_departure.date().isoformat(), local_departure.time().isoformat('seconds'),
+            '{}:{:02d}:{:02d}'.format(minutes // 60, minutes % 60, seconds)]
+
+
+def extract_facts(parsed_line, request_date, direction):
+    """
+    Extract rows of the unified fact table from parsed single json response: journeys of extract_journeys()
+    with their direction and precomputed date and time columns.
+
+    Parameters:
+    - parsed_line (dict) : parsed json response (single)
+    - request_date (str) : date of request in yyyy-mm-dd format.
+    - direction (str) : direction in format FROM TO.
+
+    Return:
+    - generator : lists of attributes (str), in FACT_HEADERS order.
+    """
+    for attributes_list in extract_journeys(parsed_line, request_date):
+        try:
+            computed = fact_columns(attributes_list[1], attributes_list[4])
+        except (ValueError, TypeError, AttributeError) as e:
+            # left for the db loader to reject with the reason
+            log(f"Error: {e}", "./logs/processing_log.txt", "WARNING")
+            computed = ['', '', '']
+        yield [direction] + attributes_list + computed
+
+
+def extract_rows(parsed_line, request_date, direction=None):
+    """
+    Rows of the per-direction tables (see extract_journeys), or of the unified fact table if direction is given
+    (see extract_facts).
+
+    Return:
+    - generator : lists of attributes (str), in HEADERS or FACT_HEADERS order.
+    """
+    if direction is None:
+        return extract_journeys(parsed_line, request_date)
+    return extract_facts(parsed_line, request_date, direction)
+
+
+def content_hash(parsed_line):
+    """
+    Hash of the journeys' data of the response, i.e. of the rows it turns into (without request date).
+    Equal hashes of the same direction and departure date mean nothing has changed.
+    Hashed in the extract stage, so nothing is counted or logged as extract_journeys() does in transform.
+
+    Parameters:
+    - parsed_line (dict) : parsed json response (single)
+
+    Return:
+    - str : hex digest.
+    """
+    checksum = hashlib.sha1()
+    try:
+        for journey in parsed_line['data']['searchJourney']:
+            if journey['error']:
+                continue
+            checksum.update(','.join(journey_attributes(journey, '')).encode('utf-8') + b'\n')
+    except Exception:
+        # the journeys up to the broken one, the same rows as extract_journeys() gives
+        pass
+    return checksum.hexdigest()
+
+
+def unchanged_marker(checksum, dep_date, since):
+    """
+    Single lined marker stored in the raw file instead of the response which is the same as before.
+
+    Parameters:
+    - checksum (str) : content hash of the response (see content_hash).
+    - dep_date (str) : departure date in yyyy-mm-dd format.
+    - since (str) : request date in yyyy-mm-dd format of the raw file with the full response.
+
+    Return:
+    - bytes : marker line without '\n'.
+    """
+    return json.dumps({'unchanged': checksum, 'departureDate': dep_date, 'since': since}).encode('utf-8')
+
+
+def is_unchanged_marker(parsed_line):
+    return isinstance(parsed_line, dict) and 'unchanged' in parsed_line
+
+
+def write_unchanged(markers, request_date, output_file):
+    """
+    Write departure dates which were unchanged in the raw file to the sidecar file yyyy-mm-dd.unchanged
+    (csv: dep_date, since), so that loading keeps their rows of the earlier snapshot.
+    Markers pointing to the same request date are skipped, the full response is in the same file.
+    The stale sidecar file is removed if there are no such markers.
+
+    Parameters:
+    - markers (list) : parsed markers (see iter_parse_file).
+    - request_date (str) : date of request in yyyy-mm-dd format.
+    - output_file (str) : sidecar file path.
+
+    Return:
+    - int : number of unchanged departure dates written.
+    """
+    rows = sorted({(marker['departureDate'], marker['since']) for marker in markers
+                   if marker['since'] != request_date})
+    if not rows:
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        return 0
+
+    with open(output_file, 'w', newline='') as file:
+        csv_writer = csv.writer(file, lineterminator='\n')
+        csv_writer.writerow(['dep_date', 'since'])
+        csv_writer.writerows(rows)
+    return len(rows)
+
+
+def read_unchanged(file_path):
+    """
+    Read sidecar file of unchanged departure dates (see write_unchanged).
+
+    Parameters:
+    - file_path (str) : sidecar file path.
+
+    Return:
+    - list : (dep_date, since) tuples, empty if there is no file.
+    """
+    if not os.path.exists(file_path):
+        return []
+    with open(file_path, 'r', newline='') as file:
+        csv_reader = csv.reader(file)
+        next(csv_reader, None)
+        return [tuple(row) for row in csv_reader]
+
+
+def process_line_to_csv(parsed_line, request_date, direction=None):
+    """
+    Process (extract attributes from) parsed single json response into csv-formatted string.
+
+    Parameters:
+    - parsed_line (dict) : parsed json response (single)
+    - request_date (str) : date of request in yyyy-mm-dd format.
+    - direction (str) : direction of the response for the unified fact table rows (FACT_HEADERS with
+      dep_date, dep_time and travel_duration computed here), HEADERS rows if None.
+
+    Return:
+    - str : csv-formatted extracted attributes.
+    Empty string if no attributes could be extracted.
+    """
+    # turning into csv format every attributes_list line by line
+    return ''.join(','.join(attributes_list) + '\n'
+                   for attributes_list in extract_rows(parsed_line, request_date, direction))
 
 
 def process_data(parsed_file, request_date, header=True):
     """
     Turn the whole parsed file into csv-formatted string.
 
+    The whole result is kept in memory, use write_csv() to stream rows straight to the file.
+
     Parameters:
-    - parsed_file (list) : parsed file into the list of dictionaries (json-responses).
+    - parsed_file (iter) : parsed json-responses, list or lazy iterator (see iter_parse_file).
 
     Return:
     - str : final csv-formatted data.
     """
-    output_data = ','.join(HEADERS) + '\n' if header else ''
+    output_lines = [','.join(HEADERS)] if header else []
 
     for parsed_line in parsed_file:
-        output_data += process_line_to_csv(parsed_line, request_date)
+        output_lines.extend(','.join(attributes_list)
+                            for attributes_list in extract_journeys(parsed_line, request_date))
+
+    # no '\n' after the last line
+    return '\n'.join(output_lines)
+
+
+def write_csv(parsed_file, request_date, output_file, header=True, direction=None):
+    """
+    Stream journeys from parsed responses to csv file, row by row, through a buffered csv writer.
+
+    Rows are written to a temporary file in the same folder, which is renamed to output_file
+    only when everything is written, so output_file is never left half written.
+
+    Parameters:
+    - parsed_file (iter) : parsed json-responses, list or lazy iterator (see iter_parse_file).
+    - request_date (str) : date of request in yyyy-mm-dd format.
+    - output_file (str) : output file path.
+    - header (bool) : write HEADERS (or FACT_HEADERS) as the first row.
+    - direction (str) : direction of the responses to write rows of the unified fact table (see extract_facts),
+      rows of the per-direction tables if None.
+
+    Return:
+    - int : number of rows written (without header).
+    - None : writing failed, output_file is untouched.
+    """
+    # hidden temporary file next to the output, unique per process
+    temp_file = os.path.join(os.path.dirname(output_file),
+                             '.{}.{}.tmp'.format(os.path.basename(output_file), os.getpid()))
+    try:
+        with open(temp_file, mode='w', newline='', buffering=CSV_BUFFER_SIZE) as file:
+            csv_writer = csv.writer(file, lineterminator='\n')
 
-    # remove the artifact: last '\n' symbol
-    return output_data[:-1]
+            if header:
+                csv_writer.writerow(HEADERS if direction is None else FACT_HEADERS)
+
+            rows = 0
+            for parsed_line in parsed_file:
+                for attributes_list in extract_rows(parsed_line, request_date, direction):
+                    csv_writer.writerow(attributes_list)
+                    rows += 1
+
+        # atomic replacement of the previous version of the file
+        os.replace(temp_file, output_file)
+        metrics.increment('bytes_written', os.path.getsize(output_file))
+        return rows
+    except Exception as e:
+        log(f"Error writing output to {output_file}: {e}", "./logs/processing_log.txt", "ERROR")
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        return None
 
 
 def write_output(output_data, output_file):
@@ -147,6 +517,6 @@ def write_output(output_data, output_file):
             file.write(output_data)
         return True
     except Exception as e:
-        log(f"Error writing output to {output_file}: {e}", "./logs/processing_log.txt")
+        log(f"Error writing output to {output_file}: {e}", "./logs/processing_log.txt", "ERROR")
         return False
 
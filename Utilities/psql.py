@@ -1,14 +1,70 @@
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 import csv
+import datetime
+import functools
+import io
+import itertools
+import select
+from contextlib import contextmanager, nullcontext
 from configparser import ConfigParser
-from Utilities.processing import HEADERS
+from Utilities import metrics
+from Utilities.processing import FACT_HEADERS, HEADERS, TIMEZONE
 from Utilities.log import log
 
+# default max number of connections in the pool (DB_POOL_SIZE in config.txt)
+POOL_SIZE = 4
+
+# connection pool of the process, created on the first use
+_pool = None
+
+# channel notified with the table name when summaries of the table have been refreshed
+SUMMARY_CHANNEL = 'summaries_refreshed'
+
+# natural key of a journey snapshot, the fact table has direction in front of it
+NATURAL_KEY = ['journey_id', 'request_date']
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """
+    Cursor which counts statements sent to the server (db_round_trips metric).
+    """
+
+    def execute(self, query, vars=None):
+        metrics.increment('db_round_trips')
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        metrics.increment('db_round_trips', len(vars_list))
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        metrics.increment('db_round_trips')
+        return super().copy_expert(sql, file, size)
+
+
+@functools.lru_cache(maxsize=None)
+def _read_config(filename, section):
+    # create a parser
+    parser = ConfigParser()
+
+    # read config file
+    parser.read(filename)
+
+    # get section, default to postgresql
+    if not parser.has_section(section):
+        raise Exception('Section {0} not found in the {1} file'.format(section, filename))
+    return tuple(parser.items(section))
+
 
 def config(filename='./database.ini', section='postgresql'):
     """
     Extract database parameters from config file. By default from database.ini for PostgreSQL db.
 
+    The file is parsed once per process, next calls return the cached parameters.
+
     Parameters:
     - filename (str) : configurations file.
     - section (str): section marked [section]
@@ -16,296 +72,1024 @@ def config(filename='./database.ini', section='postgresql'):
     Return:
     - parsed_line (dict) : parsed db configurations.
     """
-    # create a parser
-    parser = ConfigParser()
-    
-    # read config file
-    parser.read(filename)
-
-    # get section, default to postgresql
-    db = {}
-    if parser.has_section(section):
-        params = parser.items(section)
-        for param in params:
-            db[param[0]] = param[1]
-    else:
-        raise Exception('Section {0} not found in the {1} file'.format(section, filename))
-    return db
+    return dict(_read_config(filename, section))
 
 
-def create_table(table_name):
+def get_pool(pool_size=None):
     """
-    Create table with prescribed columns.
+    Get connection pool of the process, create it if needed.
 
     Parameters:
-    - table_name (str) : table name
+    - pool_size (int) : max number of connections, POOL_SIZE by default. Used only on creation.
 
     Return:
-    - bool: True if successful, False otherwise.
+    - psycopg2.pool.ThreadedConnectionPool : connection pool.
     """
-    conn = None
-    try:
+    global _pool
+    if _pool is None:
         # read connection parameters
         params = config()
 
         # connect to the PostgreSQL server
         log('Connecting to the PostgreSQL database...', './logs/db_log.txt')
-        conn = psycopg2.connect(**params)
-
-        # create a cursor
-        cursor = conn.cursor()
-
-        # construct a create table statement
-        create_table_query = """CREATE TABLE IF NOT EXISTS {} (
-                id SERIAL PRIMARY KEY,
-                {} VARCHAR(40),
-                {} TIMESTAMPTZ,
-                {} VARCHAR(3),
-                {} VARCHAR(3),
-                {} TIMESTAMPTZ,
-                {} NUMERIC(5,2),
-                {} VARCHAR(4),
-                {} VARCHAR(3),
-                {} SMALLINT,
-                {} DATE
-            );""".format(table_name, *HEADERS)
-
-        # execute a statement
-        cursor.execute(create_table_query)
-        log(f"{table_name} has been created", './logs/db_log.txt')
-
-        # commit changes
-        conn.commit()
-
-        # close the communication with the PostgreSQL
-        cursor.close()
+        _pool = psycopg2.pool.ThreadedConnectionPool(1, pool_size or POOL_SIZE, cursor_factory=CountingCursor,
+                                                     **params)
+    return _pool
+
+
+def close_pool():
+    """
+    Close all the connections of the pool.
+    """
+    global _pool
+    if _pool is not None:
+        _pool.closeall()
+        _pool = None
+        log('Database connection closed.', './logs/db_log.txt')
+
+
+class Session:
+    """
+    Connection borrowed from the pool and shared by psql functions, e.g. for the whole run:
+
+        with psql.Session() as session:
+            psql.create_table(table_name, session=session)
+
+    By default every function commits its own work as before. With transaction=True nothing
+    is committed until the session ends, and everything is rolled back if any function failed.
+    """
+
+    def __init__(self, transaction=False, pool_size=None):
+        self.transaction = transaction
+        self.pool_size = pool_size
+        self.conn = None
+        self.failed = False
+
+    def __enter__(self):
+        self.conn = get_pool(self.pool_size).getconn()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self.transaction and exc_type is None and not self.failed:
+                self.conn.commit()
+            else:
+                self.conn.rollback()
+        finally:
+            get_pool().putconn(self.conn)
+            self.conn = None
+        return False
+
+
+@contextmanager
+def connection(session=None):
+    """
+    Connection for a single psql function: the one of the session if given, or a pooled one.
+
+    Work is committed on success and rolled back on error, unless the session is a transaction,
+    then only the failure is recorded and the session decides at the end.
+
+    Parameters:
+    - session (Session) : shared session or None.
+
+    Return:
+    - connection : psycopg2 connection.
+    """
+    if session is None:
+        with Session(transaction=True) as own_session:
+            yield own_session.conn
+        return
+
+    try:
+        yield session.conn
+    except Exception:
+        if session.transaction:
+            session.failed = True
+        else:
+            session.conn.rollback()
+        raise
+    if not session.transaction:
+        session.conn.commit()
+
+
+def _execute(query, message, session=None):
+    """
+    Execute single statement and log message on success.
+
+    Parameters:
+    - query (str) : SQL statement.
+    - message (str) : message to log.
+    - session (Session) : shared session or None.
+
+    Return:
+    - bool: True if successful, False otherwise.
+    """
+    try:
+        with connection(session) as conn:
+            # create a cursor
+            cursor = conn.cursor()
+
+            # execute a statement
+            cursor.execute(query)
+            log(message, './logs/db_log.txt')
+
+            # close the cursor, changes are committed when leaving connection()
+            cursor.close()
         return True
     except (Exception, psycopg2.DatabaseError) as error:
-        log(error, './logs/db_log.txt')
+        log(error, './logs/db_log.txt', 'ERROR')
         return False
-    finally:
-        if conn is not None:
-            conn.close()
-            log('Database connection closed.', './logs/db_log.txt')
 
 
-def create_trigger_function():
+def create_table_query(table_name, partition=None):
     """
-    Create trigger function for refreshing both materialized views.
+    Construct create table statement with prescribed columns and indexes for the latest snapshot
+    and calendar queries.
+
+    Parameters:
+    - table_name (str) : table name
+    - partition (str) : None for plain table, 'day' or 'month' for partitioning by request_date
+
+    Return:
+    - str : SQL statements.
+    """
+    if partition:
+        # primary key of partitioned table must contain the partition key
+        id_column = 'id BIGSERIAL,'
+        primary_key = ',\n            PRIMARY KEY (id, request_date)'
+        partition_clause = ' PARTITION BY RANGE (request_date)'
+    else:
+        id_column, primary_key, partition_clause = 'id SERIAL PRIMARY KEY,', '', ''
+
+    return """CREATE TABLE IF NOT EXISTS {} (
+            {}
+            {} VARCHAR(40),
+            {} TIMESTAMPTZ,
+            {} VARCHAR(3),
+            {} VARCHAR(3),
+            {} TIMESTAMPTZ,
+            {} NUMERIC(5,2),
+            {} VARCHAR(4),
+            {} VARCHAR(3),
+            {} SMALLINT,
+            {} DATE NOT NULL{}
+        ){};
+        -- latest snapshot (MAX(request_date)) and journeys of the snapshot by departure time,
+        -- supersedes the single request_date index of the previous version
+        DROP INDEX IF EXISTS {}_request_date_idx;
+        CREATE INDEX IF NOT EXISTS {}_request_date_departure_time_idx ON {} (request_date, departure_time);
+        """.format(table_name, id_column, *HEADERS, primary_key, partition_clause, table_name, table_name,
+                   table_name)
+
+
+def create_table(table_name, partition=None, session=None):
+    """
+    Create table with prescribed columns and indexes.
+
+    Partitioned table is split by request_date ranges, partitions are created by create_partition()
+    before loading data.
+
+    Parameters:
+    - table_name (str) : table name
+    - partition (str) : None for plain table, 'day' or 'month' for partitioning by request_date
+    - session (Session) : shared session, a pooled connection is used if None
 
     Return:
     - bool: True if successful, False otherwise.
     """
-    conn = None
+    return _execute(create_table_query(table_name, partition), f"{table_name} has been created", session)
+
+
+def create_fact_table_query(table_name, partition=None):
+    """
+    Construct create table statement of the unified fact table: journeys of all the directions, with
+    dep_date, dep_time and travel_duration computed at transform time (see processing.extract_facts),
+    and indexes for the latest snapshot and compatibility views of a direction, and of the table
+    <table>_unchanged of departure dates stored as unchanged markers (see store_unchanged).
+
+    Parameters:
+    - table_name (str) : fact table name
+    - partition (str) : None for plain table, 'day' or 'month' for partitioning by request_date
+
+    Return:
+    - str : SQL statements.
+    """
+    if partition:
+        # primary key of partitioned table must contain the partition key
+        primary_key = ',\n            PRIMARY KEY (id, request_date)'
+        partition_clause = ' PARTITION BY RANGE (request_date)'
+    else:
+        primary_key, partition_clause = '', ''
+
+    return f"""CREATE TABLE IF NOT EXISTS {table_name} (
+            id BIGSERIAL{'' if partition else ' PRIMARY KEY'},
+            direction VARCHAR(7) NOT NULL,
+            journey_id VARCHAR(40),
+            departure_time TIMESTAMPTZ,
+            departure_station VARCHAR(3),
+            arrival_station VARCHAR(3),
+            arrival_time TIMESTAMPTZ,
+            price NUMERIC(5,2),
+            train_number VARCHAR(4),
+            train_type VARCHAR(3),
+            eco_seats_available SMALLINT,
+            request_date DATE NOT NULL,
+            dep_date DATE,
+            dep_time TIME,
+            travel_duration INTERVAL{primary_key}
+        ){partition_clause};
+        -- latest snapshot of a direction, and the latest snapshot of every departure date (see compatibility views)
+        CREATE INDEX IF NOT EXISTS {table_name}_direction_request_date_departure_time_idx
+            ON {table_name} (direction, request_date, departure_time);
+        CREATE INDEX IF NOT EXISTS {table_name}_direction_dep_date_request_date_idx
+            ON {table_name} (direction, dep_date, request_date);
+
+        -- departure dates of the snapshots which have no rows, their rows are in the snapshot of "since"
+        CREATE TABLE IF NOT EXISTS {table_name}_unchanged (
+            direction VARCHAR(7) NOT NULL,
+            request_date DATE NOT NULL,
+            dep_date DATE NOT NULL,
+            since DATE NOT NULL,
+            PRIMARY KEY (direction, request_date, dep_date)
+        );
+        """
+
+
+def create_fact_table(table_name, partition=None, session=None):
+    """
+    Create the unified fact table of all the directions (FACT_TABLE in config.txt), instead of a table per
+    direction. Partitions are created by create_partition() before loading data, the same way.
+
+    Parameters:
+    - table_name (str) : fact table name
+    - partition (str) : None for plain table, 'day' or 'month' for partitioning by request_date
+    - session (Session) : shared session, a pooled connection is used if None
+
+    Return:
+    - bool: True if successful, False otherwise.
+    """
+    return _execute(create_fact_table_query(table_name, partition), f"{table_name} has been created", session)
+
+
+def store_unchanged(fact_table, direction, request_date, unchanged, session=None):
+    """
+    Record the departure dates which were unchanged in the snapshot of the direction (stored as markers by
+    the extract) in <fact_table>_unchanged, so the compatibility views take their rows from the snapshot
+    where they were stored the last time. A repeated load of the snapshot replaces them.
+
+    Parameters:
+    - fact_table (str) : fact table name
+    - direction (str) : direction in format FROM TO
+    - request_date (str) : snapshot date in yyyy-mm-dd format
+    - unchanged (list) : (dep_date, since request date) of the unchanged departure dates of the snapshot
+    - session (Session) : shared session, a pooled connection is used if None
+
+    Return:
+    - bool: True if successful, False otherwise.
+    """
+    if not unchanged:
+        return True
     try:
-        # read connection parameters
-        params = config()
+        with connection(session) as conn:
+            # create a cursor
+            cursor = conn.cursor()
+
+            cursor.execute(f"""INSERT INTO {fact_table}_unchanged
+                    SELECT %s, %s, dep_date, since
+                    FROM unnest(%s::DATE[], %s::DATE[]) AS unchanged (dep_date, since)
+                    ON CONFLICT (direction, request_date, dep_date) DO UPDATE SET since = excluded.since""",
+                           (direction, request_date, [dep_date for dep_date, _ in unchanged],
+                            [since for _, since in unchanged]))
+            log(f"{cursor.rowcount} unchanged departure dates of {direction} {request_date} have been stored "
+                f"to {fact_table}_unchanged", './logs/db_log.txt')
+
+            # close the cursor, changes are committed when leaving connection()
+            cursor.close()
+        return True
+    except (Exception, psycopg2.DatabaseError) as error:
+        log(error, './logs/db_log.txt', 'ERROR')
+        return False
 
-        # connect to the PostgreSQL server
-        log('Connecting to the PostgreSQL database...', './logs/db_log.txt')
-        conn = psycopg2.connect(**params)
-
-        # create a cursor
-        cursor = conn.cursor()
-
-        # construct create a materialized view statement
-        create_function_query = """CREATE OR REPLACE FUNCTION refresh_materialized_views()
-              RETURNS TRIGGER AS
-                $$
-                BEGIN
-                  IF TG_ARGV[0] IS NOT NULL THEN
-                    EXECUTE FORMAT('REFRESH MATERIALIZED VIEW %I', CONCAT(TG_ARGV[0], '_current'));
-                    EXECUTE FORMAT('REFRESH MATERIALIZED VIEW %I', CONCAT(TG_ARGV[0], '_price_range'));
-                  END IF;
-                  RETURN NULL;
-                END;
-                $$ LANGUAGE plpgsql;"""
-
-        # execute a statement
-        cursor.execute(create_function_query)
-        log("Function refresh_materialized_views() has been created", './logs/db_log.txt')
-
-        # commit changes
-        conn.commit()
-
-        # close the communication with the PostgreSQL
-        cursor.close()
+
+def create_compatibility_views(fact_table, direction, session=None):
+    """
+    Create views <direction>_current and <direction>_price_range over the fact table, with the same columns
+    as the summary tables of a per-direction table, so the queries of the summaries keep working.
+    Summary tables with these names are dropped.
+
+    <direction>_current has the journeys of the latest snapshot of the direction, and the departure dates
+    stored as unchanged markers in it (see store_unchanged) come from the snapshot where they were stored
+    the last time, as in the summary tables. A departure date without journeys in the latest snapshot
+    (e.g. sold out) has no rows. Nothing has to be refreshed after loading.
+
+    Parameters:
+    - fact_table (str) : fact table name
+    - direction (str) : direction in format FROM TO
+    - session (Session) : shared session, a pooled connection is used if None
+
+    Return:
+    - bool: True if successful, False otherwise.
+    """
+    # make direction name compatible to postgres
+    table_name = direction.replace(' ', '_').lower()
+    direction = direction.replace("'", "''")
+    local_arrival = f"arrival_time AT TIME ZONE '{TIMEZONE}'"
+    return _execute(f"""DO $$
+            BEGIN
+              IF EXISTS (SELECT 1 FROM pg_tables WHERE tablename = '{table_name}_current'
+                         AND schemaname = current_schema()) THEN
+                DROP TABLE {table_name}_current;
+              END IF;
+              IF EXISTS (SELECT 1 FROM pg_tables WHERE tablename = '{table_name}_price_range'
+                         AND schemaname = current_schema()) THEN
+                DROP TABLE {table_name}_price_range;
+              END IF;
+            END;
+            $$;
+
+            CREATE OR REPLACE VIEW {table_name}_current AS
+                SELECT dep_date, dep_time, travel_duration AS time_travel,
+                ({local_arrival})::DATE AS arr_date, ({local_arrival})::TIME AS arr_time,
+                eco_seats_available, price, request_date
+                FROM {fact_table}
+                WHERE direction = '{direction}' AND (
+                    request_date = (SELECT MAX(request_date) FROM {fact_table} WHERE direction = '{direction}')
+                    OR (dep_date, request_date) IN (
+                        SELECT dep_date, since FROM {fact_table}_unchanged
+                        WHERE direction = '{direction}' AND request_date = (
+                            SELECT MAX(request_date) FROM {fact_table} WHERE direction = '{direction}')));
+
+            CREATE OR REPLACE VIEW {table_name}_price_range AS
+                SELECT dep_date, MIN(price) AS min, MAX(price) AS max
+                FROM {table_name}_current
+                GROUP BY dep_date;""",
+                    f"Views {table_name}_current and {table_name}_price_range over {fact_table} have been created",
+                    session)
+
+
+def migrate_to_fact_table(fact_table, direction, partition=None, session=None):
+    """
+    Copy rows of the per-direction table into the fact table, computing dep_date, dep_time and travel_duration.
+    Request dates which the fact table already has for the direction are skipped, so it can be repeated.
+    The per-direction table is kept, it's dropped by hand when the fact table is checked.
+
+    Parameters:
+    - fact_table (str) : fact table name
+    - direction (str) : direction in format FROM TO
+    - partition (str) : 'day' or 'month' if the fact table is partitioned, the partitions are created first
+    - session (Session) : shared session, a pooled connection is used if None
+
+    Return:
+    - bool: True if successful, False otherwise.
+    """
+    # make direction name compatible to postgres
+    table_name = direction.replace(' ', '_').lower()
+    local_departure = f"departure_time AT TIME ZONE '{TIMEZONE}'"
+    try:
+        with connection(session) as conn:
+            # create a cursor
+            cursor = conn.cursor()
+
+            cursor.execute('SELECT to_regclass(%s)', (table_name,))
+            if cursor.fetchone()[0] is None:
+                log(f"{table_name} doesn't exist, nothing to migrate", './logs/db_log.txt')
+                cursor.close()
+                return True
+
+            # partitions for all the request dates to copy
+            if partition:
+                cursor.execute(f"SELECT DISTINCT request_date FROM {table_name} WHERE request_date IS NOT NULL")
+                for query in {partition_query(fact_table, row[0], partition) for row in cursor.fetchall()}:
+                    cursor.execute(query)
+
+            cursor.execute(f"""INSERT INTO {fact_table} ({', '.join(FACT_HEADERS)})
+                    SELECT %s, {', '.join(HEADERS)}, ({local_departure})::DATE, ({local_departure})::TIME,
+                    arrival_time - departure_time
+                    FROM {table_name}
+                    WHERE request_date IS NOT NULL AND request_date NOT IN (
+                        SELECT DISTINCT request_date FROM {fact_table} WHERE direction = %s)""",
+                           (direction, direction))
+            log(f"{table_name} has been migrated to {fact_table}: {cursor.rowcount} rows", './logs/db_log.txt')
+
+            # close the cursor, changes are committed when leaving connection()
+            cursor.close()
         return True
     except (Exception, psycopg2.DatabaseError) as error:
-        log(error, './logs/db_log.txt')
+        log(error, './logs/db_log.txt', 'ERROR')
         return False
-    finally:
-        if conn is not None:
-            conn.close()
-            log('Database connection closed.', './logs/db_log.txt')
 
 
-def create_mat_view_current(table_name, recreate=False):
+def partition_query(table_name, request_date, partition):
     """
-    Create materialized view: table with the most fresh journeys info.
+    Construct create partition statement for the partition which keeps request_date.
 
     Parameters:
-    - table_name (str) : table name for which mat. view will be created
-    - recreate (bool) : recreate the view?
+    - table_name (str) : partitioned table name
+    - request_date (str or datetime.date) : date in yyyy-mm-dd format
+    - partition (str) : 'day' or 'month'
+
+    Return:
+    - str : SQL statement.
+    """
+    if isinstance(request_date, str):
+        request_date = datetime.date.fromisoformat(request_date)
+
+    if partition == 'day':
+        start = request_date
+        end = start + datetime.timedelta(days=1)
+        name = f"{table_name}_p{start:%Y%m%d}"
+    elif partition == 'month':
+        start = request_date.replace(day=1)
+        end = (start + datetime.timedelta(days=31)).replace(day=1)
+        name = f"{table_name}_p{start:%Y%m}"
+    else:
+        raise ValueError(f"Unknown partition period: {partition}")
+
+    return f"""CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table_name}
+            FOR VALUES FROM ('{start}') TO ('{end}');"""
+
+
+def create_partition(table_name, request_date, partition, session=None):
+    """
+    Create partition of the table for request_date if it doesn't exist yet.
+
+    Parameters:
+    - table_name (str) : partitioned table name
+    - request_date (str or datetime.date) : date in yyyy-mm-dd format
+    - partition (str) : 'day' or 'month'
+    - session (Session) : shared session, a pooled connection is used if None
 
     Return:
     - bool: True if successful, False otherwise.
     """
-    conn = None
+    return _execute(partition_query(table_name, request_date, partition),
+                    f"Partition of {table_name} for {request_date} is ready", session)
+
+
+def migrate_to_partitioned(table_name, partition, session=None):
+    """
+    Turn existing plain table into partitioned one, keeping ids and data. Done in a single
+    transaction: the old table is renamed, the new one is created, filled and the old one dropped.
+    Rows without request_date fit no partition, they are kept in the old table <table>_unpartitioned
+    (with a warning) instead. Does nothing if the table is already partitioned.
+
+    Parameters:
+    - table_name (str) : table name
+    - partition (str) : 'day' or 'month'
+    - session (Session) : shared session, a pooled connection is used if None
+
+    Return:
+    - bool: True if successful, False otherwise.
+    """
+    old_table = table_name + '_unpartitioned'
     try:
-        # read connection parameters
-        params = config()
+        with connection(session) as conn:
+            # create a cursor
+            cursor = conn.cursor()
+
+            cursor.execute("""SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)""",
+                           (table_name,))
+            if cursor.fetchone():
+                log(f"{table_name} is already partitioned", './logs/db_log.txt')
+                cursor.close()
+                return True
+
+            # free the names of the table, its primary key, ids sequence and indexes for the new table
+            cursor.execute(f"""ALTER TABLE {table_name} RENAME TO {old_table};
+                    ALTER TABLE {old_table} RENAME CONSTRAINT {table_name}_pkey TO {old_table}_pkey;
+                    ALTER SEQUENCE IF EXISTS {table_name}_id_seq RENAME TO {old_table}_id_seq;
+                    DROP INDEX IF EXISTS {table_name}_request_date_idx;
+                    DROP INDEX IF EXISTS {table_name}_request_date_departure_time_idx;""")
+
+            # new table with the partitions for all the existing request dates
+            cursor.execute(create_table_query(table_name, partition))
+            cursor.execute(f"""SELECT DISTINCT request_date FROM {old_table} WHERE request_date IS NOT NULL""")
+            for request_date in {partition_query(table_name, row[0], partition) for row in cursor.fetchall()}:
+                cursor.execute(request_date)
+
+            # move the data keeping ids, and continue the ids sequence
+            cursor.execute(f"""INSERT INTO {table_name} (id, {', '.join(HEADERS)})
+                    SELECT id, {', '.join(HEADERS)} FROM {old_table} WHERE request_date IS NOT NULL""")
+            rows = cursor.rowcount
+            cursor.execute(f"""SELECT setval(pg_get_serial_sequence('{table_name}', 'id'),
+                    COALESCE((SELECT MAX(id) FROM {table_name}), 0) + 1, false)""")
+            log(f"{table_name} has been migrated to partitioned by {partition}: {rows} rows", './logs/db_log.txt')
+
+            # rows without request date are left in the old table, it's dropped only if there are none
+            cursor.execute(f"""SELECT COUNT(*) FROM {old_table} WHERE request_date IS NULL""")
+            left = cursor.fetchone()[0]
+            if left:
+                cursor.execute(f"""DELETE FROM {old_table} WHERE request_date IS NOT NULL""")
+                log(f"{left} rows of {table_name} without request_date have been kept in {old_table}",
+                    './logs/db_log.txt', 'WARNING')
+            else:
+                cursor.execute(f"""DROP TABLE {old_table}""")
+
+            # close the cursor, changes are committed when leaving connection()
+            cursor.close()
+        return True
+    except (Exception, psycopg2.DatabaseError) as error:
+        log(error, './logs/db_log.txt', 'ERROR')
+        return False
 
-        # connect to the PostgreSQL server
-        log('Connecting to the PostgreSQL database...', './logs/db_log.txt')
-        conn = psycopg2.connect(**params)
 
-        # create a cursor
-        cursor = conn.cursor()
+def create_summary_tables(table_name, session=None):
+    """
+    Create summary tables <table>_current (the most fresh journeys info) and <table>_price_range
+    (the most fresh price range by days), maintained by refresh_summaries() after loading.
+
+    Materialized views and the refresh trigger of the previous versions are dropped if they exist,
+    and the new tables are filled from the latest snapshot of the table.
+
+    Parameters:
+    - table_name (str) : table name for which summary tables will be created
+    - session (Session) : shared session, a pooled connection is used if None
+
+    Return:
+    - bool: True if successful, False otherwise.
+    """
+    create_summary_query = f"""DO $$
+            BEGIN
+              IF EXISTS (SELECT 1 FROM pg_matviews WHERE matviewname = '{table_name}_current') THEN
+                DROP MATERIALIZED VIEW {table_name}_current;
+              END IF;
+              IF EXISTS (SELECT 1 FROM pg_matviews WHERE matviewname = '{table_name}_price_range') THEN
+                DROP MATERIALIZED VIEW {table_name}_price_range;
+              END IF;
+            END;
+            $$;
+            DROP TRIGGER IF EXISTS trigger_{table_name} ON {table_name};
+
+            CREATE TABLE IF NOT EXISTS {table_name}_current (
+                dep_date DATE,
+                dep_time TIME,
+                time_travel INTERVAL,
+                arr_date DATE,
+                arr_time TIME,
+                eco_seats_available SMALLINT,
+                price NUMERIC(5,2),
+                request_date DATE
+            );
+            CREATE INDEX IF NOT EXISTS {table_name}_current_dep_date_idx ON {table_name}_current (dep_date);
+
+            CREATE TABLE IF NOT EXISTS {table_name}_price_range (
+                dep_date DATE PRIMARY KEY,
+                min NUMERIC(5,2),
+                max NUMERIC(5,2)
+            );"""
+
+    return (_execute(create_summary_query, f"Summary tables {table_name}_current and {table_name}_price_range "
+                                           f"have been created", session)
+            and refresh_summaries(table_name, session=session))
+
+
+def refresh_summaries(table_name, request_date=None, unchanged=None, session=None):
+    """
+    Bring <table>_current and <table>_price_range up to date after loading the snapshot of request_date.
+
+    Departure dates which were unchanged in the snapshot (stored as markers by the extract) have no rows
+    of request_date, their rows are taken from the snapshot where they were stored the last time.
 
-        # drop the materialized view if needed
-        if recreate:
-            drop_mat_view_query = f"""DROP MATERIALIZED VIEW {table_name + '_current'}"""
-            cursor.execute(drop_mat_view_query)
-            log(f"Old materialized view {table_name + '_current'} has been dropped", './logs/db_log.txt')
+    Only the rows of that snapshot are read (by (request_date, departure_time) index), so the cost depends on
+    the size of the batch, not on the whole history. Snapshots older than the one in the summary
+    are ignored. Readers see the previous version until the refresh is committed.
 
-        # construct create a materialized view statement
-        create_mat_view_query = f"""CREATE MATERIALIZED VIEW {table_name + '_current'} AS
-                    SELECT departure_time::TIMESTAMP::DATE AS dep_date,
+    Parameters:
+    - table_name (str) : table name
+    - request_date (str) : loaded snapshot date in yyyy-mm-dd format, the latest in the table if None
+    - unchanged (list) : (dep_date, since request date) of the unchanged departure dates of the snapshot
+    - session (Session) : shared session, a pooled connection is used if None
+
+    Return:
+    - bool: True if successful, False otherwise.
+    """
+    summary_columns = """departure_time::TIMESTAMP::DATE AS dep_date,
                     departure_time::TIMESTAMP::TIME AS dep_time,
                     arrival_time-departure_time AS time_travel,
                     arrival_time::TIMESTAMP::DATE AS arr_date,
                     arrival_time::TIMESTAMP::TIME AS arr_time,
-                    eco_seats_available, price
+                    eco_seats_available, price, request_date"""
+    try:
+        with connection(session) as conn:
+            # create a cursor
+            cursor = conn.cursor()
+
+            if request_date is None:
+                cursor.execute(f"SELECT MAX(request_date) FROM {table_name}")
+                request_date = cursor.fetchone()[0]
+
+            # summary keeps the newest snapshot only
+            cursor.execute(f"SELECT MAX(request_date) FROM {table_name}_current")
+            summary_date = cursor.fetchone()[0]
+            if request_date is None or (summary_date is not None and str(summary_date) > str(request_date)):
+                log(f"Summaries of {table_name} are up to date", './logs/db_log.txt')
+                cursor.close()
+                return True
+
+            # replace the snapshot with the rows of the batch
+            cursor.execute(f"""DELETE FROM {table_name}_current""")
+            cursor.execute(f"""INSERT INTO {table_name}_current
+                    SELECT {summary_columns}
                     FROM {table_name}
-                    WHERE request_date = (SELECT MAX(request_date) FROM {table_name})
-                    WITH DATA;"""
+                    WHERE request_date = %s""", (request_date,))
+            rows = cursor.rowcount
+
+            # unchanged departure dates from their earlier snapshots
+            if unchanged:
+                cursor.execute(f"""INSERT INTO {table_name}_current
+                        SELECT {summary_columns}
+                        FROM {table_name}
+                        JOIN unnest(%s::DATE[], %s::DATE[]) AS unchanged (dep_date, since)
+                        ON request_date = unchanged.since
+                        AND departure_time::TIMESTAMP::DATE = unchanged.dep_date""",
+                               ([dep_date for dep_date, _ in unchanged], [since for _, since in unchanged]))
+                rows += cursor.rowcount
+
+            # price range is recomputed from the snapshot only
+            cursor.execute(f"""DELETE FROM {table_name}_price_range""")
+            cursor.execute(f"""INSERT INTO {table_name}_price_range
+                    SELECT dep_date, MIN(price), MAX(price)
+                    FROM {table_name}_current
+                    -- WHERE dep_time BETWEEN '06:00' AND '23:00'
+                    GROUP BY dep_date""")
+
+            # listeners (e.g. caches of price_calendar.py) get it when the refresh is committed
+            cursor.execute("SELECT pg_notify(%s, %s)", (SUMMARY_CHANNEL, table_name))
+            log(f"Summaries of {table_name} have been refreshed from {request_date} snapshot: {rows} rows",
+                './logs/db_log.txt')
+
+            # close the cursor, changes are committed when leaving connection()
+            cursor.close()
+        return True
+    except (Exception, psycopg2.DatabaseError) as error:
+        log(error, './logs/db_log.txt', 'ERROR')
+        return False
 
-        # execute a statement
-        cursor.execute(create_mat_view_query)
-        log(f"Materialized view {table_name + '_current'} has been created", './logs/db_log.txt')
 
-        # commit changes
-        conn.commit()
+def notify_refreshed(table_name, session=None):
+    """
+    Notify listeners of SUMMARY_CHANNEL that the summaries of the direction table have changed, e.g. when the
+    direction is loaded to the fact table, whose compatibility views need no refresh (see refresh_summaries).
 
-        # close the communication with the PostgreSQL
-        cursor.close()
+    Parameters:
+    - table_name (str) : direction table name
+    - session (Session) : shared session, a pooled connection is used if None
+
+    Return:
+    - bool: True if successful, False otherwise.
+    """
+    try:
+        with connection(session) as conn:
+            # create a cursor
+            cursor = conn.cursor()
+
+            # delivered when the transaction is committed
+            cursor.execute("SELECT pg_notify(%s, %s)", (SUMMARY_CHANNEL, table_name))
+
+            # close the cursor, changes are committed when leaving connection()
+            cursor.close()
         return True
     except (Exception, psycopg2.DatabaseError) as error:
-        log(error, './logs/db_log.txt')
+        log(error, './logs/db_log.txt', 'ERROR')
         return False
-    finally:
-        if conn is not None:
-            conn.close()
-            log('Database connection closed.', './logs/db_log.txt')
 
 
-def create_mat_view_price_range(table_name, recreate=False):
+def create_daily_table(table_name, fact=False, session=None):
     """
-    Create materialized view: table with the most fresh price range journeys info.
+    Create rollup table <table>_daily: compact history of the snapshots removed from the table by
+    compact_history(), one row per request date and departure date (and direction for the fact table).
 
     Parameters:
-    - table_name (str) : table name for which mat. view will be created
-    - recreate (bool) : recreate the view?
+    - table_name (str) : direction table name, or fact table name
+    - fact (bool) : the table is the fact table (see create_fact_table)
+    - session (Session) : shared session, a pooled connection is used if None
 
     Return:
     - bool: True if successful, False otherwise.
     """
-    conn = None
+    return _execute(f"""CREATE TABLE IF NOT EXISTS {table_name}_daily (
+                {'direction VARCHAR(7),' if fact else ''}
+                request_date DATE,
+                dep_date DATE,
+                min_price NUMERIC(5,2),
+                max_price NUMERIC(5,2),
+                median_price NUMERIC(5,2),
+                min_seats SMALLINT,
+                train_count INTEGER,
+                PRIMARY KEY ({'direction, ' if fact else ''}request_date, dep_date)
+            );""", f"Rollup table {table_name}_daily has been created", session)
+
+
+def get_partitions(table_name, session=None):
+    """
+    Partitions of the table created by create_partition() with their request date ranges.
+
+    Parameters:
+    - table_name (str) : partitioned table name
+    - session (Session) : shared session, a pooled connection is used if None
+
+    Return:
+    - list : (partition name, first request date, request date after the last) ordered by dates,
+      empty for a plain table.
+    - None : something went wrong.
+    """
     try:
-        # read connection parameters
-        params = config()
+        with connection(session) as conn:
+            # create a cursor
+            cursor = conn.cursor()
+
+            cursor.execute("""SELECT child.relname FROM pg_inherits
+                    JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+                    WHERE pg_inherits.inhparent = to_regclass(%s)""", (table_name,))
+            partitions = []
+            for (name,) in cursor.fetchall():
+                # names are <table>_pYYYYMMDD for days and <table>_pYYYYMM for months
+                suffix = name[len(table_name) + 2:]
+                if len(suffix) == 8:
+                    start = datetime.datetime.strptime(suffix, '%Y%m%d').date()
+                    end = start + datetime.timedelta(days=1)
+                else:
+                    start = datetime.datetime.strptime(suffix, '%Y%m').date()
+                    end = (start + datetime.timedelta(days=31)).replace(day=1)
+                partitions.append((name, start, end))
+
+            # close the cursor
+            cursor.close()
+        return sorted(partitions, key=lambda partition: partition[1])
+    except (Exception, psycopg2.DatabaseError) as error:
+        log(error, './logs/db_log.txt', 'ERROR')
+        return None
 
-        # connect to the PostgreSQL server
-        log('Connecting to the PostgreSQL database...', './logs/db_log.txt')
-        conn = psycopg2.connect(**params)
 
-        # create a cursor
-        cursor = conn.cursor()
+def compact_history(table_name, before, partitions='drop', fact=False, session=None):
+    """
+    Roll the snapshots requested before the date up into <table>_daily (min, max and median price,
+    min eco seats and number of trains by request date and departure date) and remove their rows from the table.
+    Rollup and removal are done in one transaction, the history is never lost or counted twice.
 
-        # drop the materialized view if needed
-        if recreate:
-            drop_mat_view_query = f"""DROP MATERIALIZED VIEW {table_name + '_price_range'}"""
-            cursor.execute(drop_mat_view_query)
-            log(f"Old materialized view {table_name + '_current'} has been dropped", './logs/db_log.txt')
+    Partitions which hold only the old snapshots are dropped (or detached and kept as standalone tables
+    <partition>_detached), the other old rows are deleted.
+
+    Parameters:
+    - table_name (str) : direction table name
+    - before (str or datetime.date) : the first request date to keep, yyyy-mm-dd
+    - partitions (str) : 'drop' or 'detach' old partitions of a partitioned table
+    - fact (bool) : the table is the fact table, rolled up by direction too
+    - session (Session) : shared session, a pooled connection is used if None
+
+    Return:
+    - dict : numbers of 'rolled_up' (request date, departure date) rows and 'removed' rows, and names of
+      dropped or detached 'partitions'.
+    - None : something went wrong, nothing is changed.
+    """
+    if isinstance(before, str):
+        before = datetime.date.fromisoformat(before)
+    # rows of the fact table have the departure date precomputed
+    keys = 'direction, request_date, dep_date' if fact else 'request_date, departure_time::TIMESTAMP::DATE'
+    try:
+        with Session(transaction=True) if session is None else nullcontext(session) as session:
+            if not create_daily_table(table_name, fact=fact, session=session):
+                session.failed = True
+                return None
+            old_partitions = [name for name, _, end in get_partitions(table_name, session=session) or []
+                              if end <= before]
+
+            with connection(session) as conn:
+                # create a cursor
+                cursor = conn.cursor()
+
+                # daily aggregates of the old snapshots, a repeated rollup of the same day replaces it
+                cursor.execute(f"""INSERT INTO {table_name}_daily
+                        SELECT {keys}, MIN(price), MAX(price),
+                        percentile_cont(0.5) WITHIN GROUP (ORDER BY price), MIN(eco_seats_available), COUNT(*)
+                        FROM {table_name}
+                        WHERE request_date < %s
+                        GROUP BY {keys}
+                        ON CONFLICT ({'direction, ' if fact else ''}request_date, dep_date) DO UPDATE
+                        SET min_price = excluded.min_price, max_price = excluded.max_price, median_price = excluded.median_price,
+                        min_seats = excluded.min_seats, train_count = excluded.train_count""", (before,))
+                rolled_up = cursor.rowcount
+
+                # whole partitions go at once, without dead rows to vacuum
+                removed = 0
+                for name in old_partitions:
+                    cursor.execute(f"SELECT COUNT(*) FROM {name}")
+                    removed += cursor.fetchone()[0]
+                    cursor.execute(f"ALTER TABLE {table_name} DETACH PARTITION {name}")
+                    if partitions == 'drop':
+                        cursor.execute(f"DROP TABLE {name}")
+                    else:
+                        # the name is free for the partition if the date is ever loaded again
+                        cursor.execute(f"ALTER TABLE {name} RENAME TO {name}_detached")
+
+                # rows of a plain table, or of a partition which holds new snapshots too
+                cursor.execute(f"DELETE FROM {table_name} WHERE request_date < %s", (before,))
+                removed += cursor.rowcount
+
+                # unchanged departure dates of the removed snapshots
+                if fact:
+                    cursor.execute(f"DELETE FROM {table_name}_unchanged WHERE request_date < %s", (before,))
+
+                log(f"History of {table_name} before {before} has been compacted: {rolled_up} daily rows, "
+                    f"{removed} rows removed ({len(old_partitions)} old partitions: {partitions})",
+                    './logs/db_log.txt')
+
+                # close the cursor, changes are committed when leaving the session
+                cursor.close()
+        return {'rolled_up': rolled_up, 'removed': removed, 'partitions': old_partitions}
+    except (Exception, psycopg2.DatabaseError) as error:
+        log(error, './logs/db_log.txt', 'ERROR')
+        return None
 
-        # construct create a materialized view statement
-        create_mat_view_query = f"""CREATE MATERIALIZED VIEW {table_name + '_price_range'} AS
-                    SELECT departure_time::TIMESTAMP::DATE AS dep_date, MIN(price), MAX(price)
-                    FROM {table_name}
-                    WHERE request_date = (SELECT MAX(request_date) FROM {table_name})
-                    -- AND departure_time::TIMESTAMP::TIME BETWEEN '06:00' AND '23:00'
-                    GROUP BY dep_date
-                    ORDER BY dep_date
-                    WITH DATA;"""
 
-        # execute a statement
-        cursor.execute(create_mat_view_query)
-        log(f"Materialized view {table_name + '_current'} has been created", './logs/db_log.txt')
+def vacuum_table(table_name, session=None):
+    """
+    VACUUM (ANALYZE) the table right away, e.g. after many rows have been deleted, instead of waiting for
+    autovacuum. VACUUM can't run in a transaction, the connection is switched to autocommit for it.
 
-        # commit changes
-        conn.commit()
+    Parameters:
+    - table_name (str) : table name
+    - session (Session) : shared session (not a transaction one), a pooled connection is used if None
 
-        # close the communication with the PostgreSQL
-        cursor.close()
+    Return:
+    - bool: True if successful, False otherwise.
+    """
+    try:
+        with Session() if session is None else nullcontext(session) as session:
+            session.conn.rollback()
+            session.conn.autocommit = True
+            try:
+                cursor = session.conn.cursor()
+                cursor.execute(f"VACUUM (ANALYZE) {table_name}")
+                cursor.close()
+            finally:
+                session.conn.autocommit = False
+        log(f"{table_name} has been vacuumed", './logs/db_log.txt')
         return True
     except (Exception, psycopg2.DatabaseError) as error:
-        log(error, './logs/db_log.txt')
+        log(error, './logs/db_log.txt', 'ERROR')
         return False
-    finally:
-        if conn is not None:
-            conn.close()
-            log('Database connection closed.', './logs/db_log.txt')
 
 
-def create_trigger(table_name):
+def get_change_rates(table_name, history_days=60, direction=None, session=None):
     """
-    Create insert trigger for the table.
+    How often the journeys (prices and seats) of a departure date change, by days until departure.
+
+    Snapshots of every departure date are compared to its previous stored snapshot. Every pair covers
+    the days between the two request dates, so the estimate is the same whether unchanged responses
+    are stored every day or skipped (see DEDUP_RESPONSES).
 
     Parameters:
-    - table_name (str) : table name for which trigger will be created
+    - table_name (str) : direction table name, or the fact table (see FACT_TABLE) if direction is given
+    - history_days (int) : request dates to take into account, counting back from the latest one
+    - direction (str) : direction of the fact table rows, in format FROM TO
+    - session (Session) : shared session, a pooled connection is used if None
 
     Return:
-    - bool: True if successful, False otherwise.
+    - dict : {days until departure: (days observed, changes)}.
+    - None : something went wrong.
     """
-    conn = None
     try:
-        # read connection parameters
-        params = config()
+        with connection(session) as conn:
+            # create a cursor
+            cursor = conn.cursor()
+
+            # rows of the fact table have the departure date precomputed
+            dep_date = 'dep_date' if direction else 'departure_time::TIMESTAMP::DATE'
+            condition = 'direction = %(direction)s' if direction else 'TRUE'
+            cursor.execute(f"""WITH snapshots AS (
+                    SELECT request_date, {dep_date} AS dep_date,
+                    md5(string_agg(concat_ws(',', journey_id, price, eco_seats_available), ';'
+                                   ORDER BY departure_time, journey_id)) AS fingerprint
+                    FROM {table_name}
+                    WHERE {condition}
+                    AND request_date > (SELECT MAX(request_date) FROM {table_name} WHERE {condition}) - %(days)s
+                    GROUP BY 1, 2
+                ), pairs AS (
+                    SELECT dep_date - request_date AS days_until,
+                    request_date - LAG(request_date) OVER w AS days,
+                    fingerprint IS DISTINCT FROM LAG(fingerprint) OVER w AS changed
+                    FROM snapshots
+                    WINDOW w AS (PARTITION BY dep_date ORDER BY request_date)
+                )
+                SELECT days_until, SUM(days), SUM(changed::INT)
+                FROM pairs
+                WHERE days IS NOT NULL AND days_until >= 0
+                GROUP BY days_until""", {'days': history_days, 'direction': direction})
+            rates = {days_until: (int(days), int(changes)) for days_until, days, changes in cursor.fetchall()}
+
+            # close the cursor
+            cursor.close()
+        return rates
+    except (Exception, psycopg2.DatabaseError) as error:
+        log(error, './logs/db_log.txt', 'ERROR')
+        return None
 
-        # connect to the PostgreSQL server
-        log('Connecting to the PostgreSQL database...', './logs/db_log.txt')
-        conn = psycopg2.connect(**params)
 
-        # create a cursor
-        cursor = conn.cursor()
+def get_price_calendar(table_name, date_from=None, date_to=None, session=None):
+    """
+    The cheapest and the most expensive journey of every departure date, from <table>_price_range.
 
-        # construct create a materialized view statement
-        create_trigger_query = f"""CREATE TRIGGER trigger_{table_name}
-                AFTER UPDATE ON {table_name}
-                FOR EACH STATEMENT
-                EXECUTE FUNCTION refresh_materialized_views('{table_name}');"""
+    Parameters:
+    - table_name (str) : direction table name
+    - date_from (str) : the first departure date in yyyy-mm-dd format, all dates if None
+    - date_to (str) : the last departure date in yyyy-mm-dd format, all dates if None
+    - session (Session) : shared session, a pooled connection is used if None
+
+    Return:
+    - list : (dep_date, min price, max price) tuples ordered by dep_date.
+    - None : something went wrong.
+    """
+    try:
+        with connection(session) as conn:
+            # create a cursor
+            cursor = conn.cursor()
+
+            cursor.execute(f"""SELECT dep_date, min, max FROM {table_name}_price_range
+                    WHERE dep_date >= COALESCE(%s::DATE, '-infinity') AND dep_date <= COALESCE(%s::DATE, 'infinity')
+                    ORDER BY dep_date""", (date_from, date_to))
+            rows = cursor.fetchall()
+
+            # close the cursor
+            cursor.close()
+        return rows
+    except (Exception, psycopg2.DatabaseError) as error:
+        log(error, './logs/db_log.txt', 'ERROR')
+        return None
 
-        # execute a statement
-        cursor.execute(create_trigger_query)
-        log(f"Trigger trigger_{table_name} has been created", './logs/db_log.txt')
 
-        # commit changes
-        conn.commit()
+def get_trains(table_name, dep_date, session=None):
+    """
+    Journeys of the departure date from the latest snapshot (<table>_current).
 
-        # close the communication with the PostgreSQL
-        cursor.close()
-        return True
+    Parameters:
+    - table_name (str) : direction table name
+    - dep_date (str) : departure date in yyyy-mm-dd format
+    - session (Session) : shared session, a pooled connection is used if None
+
+    Return:
+    - list : (dep_time, arr_date, arr_time, time_travel, eco_seats_available, price, request_date) tuples
+      ordered by dep_time.
+    - None : something went wrong.
+    """
+    try:
+        with connection(session) as conn:
+            # create a cursor
+            cursor = conn.cursor()
+
+            cursor.execute(f"""SELECT dep_time, arr_date, arr_time, time_travel, eco_seats_available, price,
+                    request_date
+                    FROM {table_name}_current
+                    WHERE dep_date = %s
+                    ORDER BY dep_time""", (dep_date,))
+            rows = cursor.fetchall()
+
+            # close the cursor
+            cursor.close()
+        return rows
     except (Exception, psycopg2.DatabaseError) as error:
-        log(error, './logs/db_log.txt')
-        return False
-    finally:
-        if conn is not None:
-            conn.close()
-            log('Database connection closed.', './logs/db_log.txt')
+        log(error, './logs/db_log.txt', 'ERROR')
+        return None
 
 
-def load_csv(table_name, csv_file_path, headers=True):
+def listen(channel, callback, stop_event, timeout=5.0, retry_delay=10.0):
+    """
+    Call callback(payload) for every notification of the channel until stop_event is set.
+    Runs on its own connection (outside the pool), reconnects if the connection is lost
+    and then calls callback(None), as notifications may have been missed meanwhile.
+
+    Parameters:
+    - channel (str) : channel name, e.g. SUMMARY_CHANNEL
+    - callback (callable) : function of the payload (str or None)
+    - stop_event (threading.Event) : stops listening when set
+    - timeout (float) : seconds to wait for notifications before checking stop_event
+    - retry_delay (float) : seconds before reconnecting
+    """
+    while not stop_event.is_set():
+        conn = None
+        try:
+            conn = psycopg2.connect(**config())
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {channel}")
+            log(f"Listening to {channel}", './logs/db_log.txt')
+
+            while not stop_event.is_set():
+                if select.select([conn], [], [], timeout) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    callback(conn.notifies.pop(0).payload)
+        except (Exception, psycopg2.DatabaseError) as error:
+            log(error, './logs/db_log.txt', 'ERROR')
+            callback(None)
+            stop_event.wait(retry_delay)
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+def load_csv(table_name, csv_file_path, headers=True, columns=HEADERS, session=None):
     """
     Load csv file to the table.
 
@@ -313,63 +1097,361 @@ def load_csv(table_name, csv_file_path, headers=True):
     - table_name (str) : table for data to be loaded
     - csv_file_path (str) : path to csv file
     - headers (bool): True if csv file contains headers
+    - columns (list) : columns of the csv rows, FACT_HEADERS for the fact table
+    - session (Session) : shared session, a pooled connection is used if None
 
     Return:
     - bool: True if successful, False otherwise.
     """
-    conn = None
     try:
-        # read connection parameters
-        params = config()
-
-        # connect to the PostgreSQL server
-        log('Connecting to the PostgreSQL database...', './logs/db_log.txt')
-        conn = psycopg2.connect(**params)
-
-        # create a cursor
-        cursor = conn.cursor()
+        with connection(session) as conn:
+            # create a cursor
+            cursor = conn.cursor()
 
-        with open(csv_file_path, 'r') as csv_file:
-            # Create a CSV reader
-            csv_reader = csv.reader(csv_file)
+            with open(csv_file_path, 'r') as csv_file:
+                # Create a CSV reader
+                csv_reader = csv.reader(csv_file)
 
-            # Skip the header if it exists
-            if headers:
-                next(csv_reader, None)
+                # Skip the header if it exists
+                if headers:
+                    next(csv_reader, None)
 
-            # Iterate through each row in the CSV file
-            for row in csv_reader:
                 # Construct the INSERT statement
-                insert_query = f"""INSERT INTO {table_name} ({', '.join(HEADERS)})
-                VALUES ({', '.join(['%s'] * len(HEADERS))});
+                insert_query = f"""INSERT INTO {table_name} ({', '.join(columns)})
+                VALUES ({', '.join(['%s'] * len(columns))});
                 """
 
-                # Execute the INSERT statement with the row data
-                cursor.execute(insert_query, row)
+                # Iterate through each row in the CSV file
+                rows = 0
+                for row in csv_reader:
+                    # Execute the INSERT statement with the row data
+                    cursor.execute(insert_query, row)
+                    rows += 1
 
-            # fake update function doing nothing
-            update_query = f"""UPDATE {table_name}
-            SET train_type = train_type
-            WHERE id = 1"""
+            log(f"{csv_file_path} were added to {table_name}", './logs/db_log.txt')
+            metrics.increment('rows_loaded', rows)
 
-            # Execute the fake UPDATE statement
-            cursor.execute(update_query)
+            # close the cursor, changes are committed when leaving connection()
+            cursor.close()
+        return True
+    except (Exception, psycopg2.DatabaseError) as error:
+        log(error, './logs/db_log.txt', 'ERROR')
+        return False
+
+
+class CsvRowsStream:
+    """
+    Read-only file-like object serving rows as csv text, so that cursor.copy_expert()
+    can stream them into the table without keeping the whole file in memory.
+    """
+
+    def __init__(self, rows, batch_size=1000):
+        self.rows = iter(rows)
+        self.batch_size = batch_size
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator='\n')
+        self.data = ''
+        self.eof = False
+
+    def read(self, size=-1):
+        # format rows by batches until there is enough data for the chunk
+        while not self.eof and (size is None or size < 0 or len(self.data) < size):
+            batch = list(itertools.islice(self.rows, self.batch_size))
+            if not batch:
+                self.eof = True
+                break
+            self.buffer.seek(0)
+            self.buffer.truncate()
+            self.writer.writerows(batch)
+            self.data += self.buffer.getvalue()
+
+        if size is None or size < 0:
+            size = len(self.data)
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def validate_row(row, columns=HEADERS):
+    """
+    Check that csv row fits the table columns (see create_table and create_fact_table).
+
+    Parameters:
+    - row (list) : csv row in columns order.
+    - columns (list) : HEADERS, or FACT_HEADERS for the fact table.
+
+    Return:
+    - str : reason why the row is rejected.
+    - None : row is valid.
+    """
+    if len(row) != len(columns):
+        return f"expected {len(columns)} columns, got {len(row)}"
+
+    values = dict(zip(columns, row))
+    try:
+        for column, max_length in (('journey_id', 40), ('departure_station', 3), ('arrival_station', 3),
+                                   ('train_number', 4), ('train_type', 3)):
+            if len(values[column]) > max_length:
+                return f"{column} is longer than {max_length}"
+        datetime.datetime.fromisoformat(values['departure_time'].replace('Z', '+00:00'))
+        datetime.datetime.fromisoformat(values['arrival_time'].replace('Z', '+00:00'))
+        datetime.date.fromisoformat(values['request_date'])
+        # NUMERIC(5,2) and SMALLINT ranges
+        if not abs(float(values['price'])) < 1000:
+            return "price is out of NUMERIC(5,2) range"
+        if not -32768 <= int(values['eco_seats_available']) <= 32767:
+            return "eco_seats_available is out of SMALLINT range"
+        # columns computed at transform time
+        if 'dep_date' in values:
+            datetime.date.fromisoformat(values['dep_date'])
+            datetime.time.fromisoformat(values['dep_time'])
+    except ValueError as e:
+        return str(e)
+    return None
+
+
+def _valid_rows(rows, rejected, first_line=1, columns=HEADERS):
+    # valid rows are yielded, bad ones go to the reject list with the reason in the last column
+    for line_number, row in enumerate(rows, start=first_line):
+        reason = validate_row(row, columns)
+        if reason:
+            rejected.append(row + [f"line {line_number}: {reason}"])
+        else:
+            yield row
+
+
+def _write_rejects(rejected, reject_file, source):
+    # rejected rows are counted, and written to the reject file if any
+    metrics.increment('rows_rejected', len(rejected))
+    if reject_file:
+        with open(reject_file, 'w', newline='') as file:
+            csv.writer(file, lineterminator='\n').writerows(rejected)
+    log(f"{len(rejected)} rows of {source} were rejected to {reject_file}", './logs/db_log.txt')
+
+
+def copy_rows(table_name, rows, reject_file=None, source='rows', first_line=1, columns=HEADERS, session=None):
+    """
+    Load rows to the table with a single COPY ... FROM STDIN, streaming them as they come
+    (e.g. straight from the parsed responses, without csv file).
+
+    Rows which don't fit the table columns are written to the reject file (with the reason in
+    the last column) instead of aborting the whole load.
+
+    Parameters:
+    - table_name (str) : table for data to be loaded
+    - rows (iter) : rows in columns order, lists of str
+    - reject_file (str) : path for rejected rows, they are only counted if None
+    - source (str) : name of the rows for the log, e.g. csv file path
+    - first_line (int) : line number of the first row in the source, for the reject reasons
+    - columns (list) : HEADERS, or FACT_HEADERS for the fact table
+    - session (Session) : shared session, a pooled connection is used if None
 
-        log(f"{csv_file_path} were added to {table_name}", './logs/db_log.txt')
+    Return:
+    - int : number of rows loaded.
+    - None : loading failed.
+    """
+    try:
+        with connection(session) as conn:
+            # create a cursor
+            cursor = conn.cursor()
 
-        # commit changes
-        conn.commit()
+            # stream the valid rows to the table
+            rejected = []
+            copy_query = f"""COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"""
+            cursor.copy_expert(copy_query, CsvRowsStream(_valid_rows(rows, rejected, first_line, columns)))
+            loaded_rows = cursor.rowcount
 
-        # close the communication with the PostgreSQL
-        cursor.close()
+            log(f"{source} were added to {table_name}: {loaded_rows} rows", './logs/db_log.txt')
+            metrics.increment('rows_loaded', loaded_rows)
+
+            # close the cursor, changes are committed when leaving connection()
+            cursor.close()
+
+        if rejected:
+            _write_rejects(rejected, reject_file, source)
+        return loaded_rows
+    except (Exception, psycopg2.DatabaseError) as error:
+        log(error, './logs/db_log.txt', 'ERROR')
+        return None
+
+
+def natural_key_query(table_name, key=NATURAL_KEY):
+    """
+    Construct statements which remove duplicated journeys of the same request date (the latest loaded row is
+    kept) and add unique index on the natural key, needed by upsert_rows().
+    On a partitioned table the index is created on every partition.
+
+    Parameters:
+    - table_name (str) : table name
+    - key (list) : key columns, NATURAL_KEY (with direction in front for the fact table)
+
+    Return:
+    - str : SQL statements.
+    """
+    return f"""DELETE FROM {table_name} AS duplicate USING {table_name} AS kept
+            WHERE {' AND '.join(f'duplicate.{column} = kept.{column}' for column in key)}
+            AND duplicate.id < kept.id;
+        CREATE UNIQUE INDEX IF NOT EXISTS {table_name}_{'_'.join(key)}_key
+            ON {table_name} ({', '.join(key)});"""
+
+
+def create_natural_key(table_name, key=NATURAL_KEY, session=None):
+    """
+    Remove duplicated rows and add unique natural key (journey_id, request_date) to the table if it has none yet.
+    Done by upsert_rows() on the first use, or ahead by create_tables.py --natural-key.
+
+    Once the key exists, COPY of already loaded rows fails on it instead of duplicating them,
+    so the table should be loaded by upsert.
+
+    Parameters:
+    - table_name (str) : table name
+    - key (list) : key columns, NATURAL_KEY (with direction in front for the fact table)
+    - session (Session) : shared session, a pooled connection is used if None
+
+    Return:
+    - bool: True if successful, False otherwise.
+    """
+    try:
+        with connection(session) as conn:
+            # create a cursor
+            cursor = conn.cursor()
+
+            cursor.execute('SELECT to_regclass(%s)', (f"{table_name}_{'_'.join(key)}_key",))
+            if cursor.fetchone()[0] is None:
+                cursor.execute(natural_key_query(table_name, key))
+                log(f"Natural key of {table_name} has been created", './logs/db_log.txt')
+
+            # close the cursor, changes are committed when leaving connection()
+            cursor.close()
         return True
     except (Exception, psycopg2.DatabaseError) as error:
-        log(error, './logs/db_log.txt')
+        log(error, './logs/db_log.txt', 'ERROR')
         return False
-    except Exception as e:
-        log(f"Error: {e}", './logs/db_log.txt')
+
+
+def upsert_rows(table_name, rows, reject_file=None, source='rows', first_line=1, columns=HEADERS, session=None):
+    """
+    Merge rows into the table by natural key (journey_id, request_date, and direction for the fact table):
+    rows are copied to a staging table with a single COPY and merged by INSERT ... ON CONFLICT DO UPDATE.
+    New journeys are inserted, changed ones are updated in place, and the same ones are left untouched,
+    so loading the same rows again writes nothing.
+
+    The staging table is temporary: private to the connection (concurrent loaders don't meet), not WAL-logged,
+    and dropped on commit. Repeated journeys of the rows are merged once, the last one wins.
+    Rows which don't fit the table columns are written to the reject file as copy_rows() does.
+
+    Parameters:
+    - table_name (str) : table for data to be merged
+    - rows (iter) : rows in columns order, lists of str
+    - reject_file (str) : path for rejected rows, they are only counted if None
+    - source (str) : name of the rows for the log, e.g. csv file path
+    - first_line (int) : line number of the first row in the source, for the reject reasons
+    - columns (list) : HEADERS, or FACT_HEADERS for the fact table
+    - session (Session) : shared session, a pooled connection is used if None
+
+    Return:
+    - dict : numbers of 'inserted', 'updated' and 'unchanged' rows.
+    - None : loading failed.
+    """
+    staging_table = f"{table_name}_staging"
+    column_list = ', '.join(columns)
+    key = (['direction'] if 'direction' in columns else []) + NATURAL_KEY
+    key_list = ', '.join(key)
+    try:
+        if not create_natural_key(table_name, key, session=session):
+            return None
+
+        with connection(session) as conn:
+            # create a cursor
+            cursor = conn.cursor()
+
+            # empty staging table with the columns of the table
+            cursor.execute(f"""CREATE TEMP TABLE IF NOT EXISTS {staging_table} ON COMMIT DROP AS
+                    SELECT {column_list} FROM {table_name} WITH NO DATA;
+                    TRUNCATE {staging_table};""")
+
+            # stream the valid rows to the staging table
+            rejected = []
+            copy_query = f"""COPY {staging_table} ({column_list}) FROM STDIN WITH (FORMAT csv)"""
+            cursor.copy_expert(copy_query, CsvRowsStream(_valid_rows(rows, rejected, first_line, columns)))
+
+            # merge, rows which are the same as the stored ones are not written at all
+            # (all parts of the statement see the table as it was before, so existing keys are the updated ones)
+            cursor.execute(f"""WITH source AS (
+                    SELECT DISTINCT ON ({key_list}) {column_list} FROM {staging_table}
+                    ORDER BY {key_list}, ctid DESC
+                ), existing AS (
+                    SELECT {key_list} FROM {table_name} JOIN source USING ({key_list})
+                ), merged AS (
+                    INSERT INTO {table_name} AS stored ({column_list})
+                    SELECT {column_list} FROM source
+                    ON CONFLICT ({key_list}) DO UPDATE
+                    SET {', '.join(f'{column} = excluded.{column}' for column in columns)}
+                    WHERE ({', '.join(f'stored.{column}' for column in columns)})
+                        IS DISTINCT FROM ({', '.join(f'excluded.{column}' for column in columns)})
+                    RETURNING {key_list}
+                )
+                SELECT count(*) FILTER (WHERE existing.journey_id IS NULL),
+                    count(*) FILTER (WHERE existing.journey_id IS NOT NULL), (SELECT count(*) FROM source)
+                FROM merged LEFT JOIN existing USING ({key_list})""")
+            inserted, updated, merged = cursor.fetchone()
+            counts = {'inserted': inserted, 'updated': updated, 'unchanged': merged - inserted - updated}
+            cursor.execute(f"TRUNCATE {staging_table}")
+
+            log(f"{source} were merged to {table_name}: {counts['inserted']} rows inserted, {counts['updated']} "
+                f"updated, {counts['unchanged']} unchanged", './logs/db_log.txt')
+            metrics.increment('rows_loaded', inserted)
+            metrics.increment('rows_updated', updated)
+            metrics.increment('rows_unchanged', counts['unchanged'])
+
+            # close the cursor, changes are committed when leaving connection()
+            cursor.close()
+
+        if rejected:
+            _write_rejects(rejected, reject_file, source)
+        return counts
+    except (Exception, psycopg2.DatabaseError) as error:
+        log(error, './logs/db_log.txt', 'ERROR')
+        return None
+
+
+def copy_csv(table_name, csv_file_path, headers=True, reject_file=None, upsert=False, columns=HEADERS,
+             session=None):
+    """
+    Load csv file to the table with a single COPY ... FROM STDIN instead of row by row INSERTs,
+    or merge it by natural key if upsert (see upsert_rows), then reloading the file changes nothing.
+
+    Rows which don't fit the table columns are written to the reject file (with the reason in
+    the last column) instead of aborting the whole file.
+
+    Parameters:
+    - table_name (str) : table for data to be loaded
+    - csv_file_path (str) : path to csv file
+    - headers (bool): True if csv file contains headers
+    - reject_file (str) : path for rejected rows, csv_file_path + '.rejects' by default
+    - upsert (bool) : merge by natural key instead of appending
+    - columns (list) : columns of the csv rows, FACT_HEADERS for the fact table
+    - session (Session) : shared session, a pooled connection is used if None
+
+    Return:
+    - bool: True if successful, False otherwise.
+    """
+    load_rows = upsert_rows if upsert else copy_rows
+    reject_file = reject_file or csv_file_path + '.rejects'
+    try:
+        with open(csv_file_path, 'r', newline='') as csv_file:
+            # Create a CSV reader
+            csv_reader = csv.reader(csv_file)
+
+            # Skip the header if it exists
+            if headers:
+                next(csv_reader, None)
+
+            loaded_rows = load_rows(table_name, csv_reader, reject_file=reject_file, source=csv_file_path,
+                                    first_line=2 if headers else 1, columns=columns, session=session)
+        return loaded_rows is not None
+    except (Exception, psycopg2.DatabaseError) as error:
+        log(error, './logs/db_log.txt', 'ERROR')
         return False
-    finally:
-        if conn is not None:
-            conn.close()
-            log('Database connection closed.', './logs/db_log.txt')
@@ -0,0 +1,257 @@
+import csv
+import mmap
+import os
+from Utilities import compression
+from Utilities import metrics
+from Utilities import parameters
+from Utilities import processing
+from Utilities.log import log
+
+# suffix of the sidecar index of raw file: yyyy-mm-dd.txt.idx (yyyy-mm-dd.txt.gz.idx for compressed one)
+INDEX_SUFFIX = '.idx'
+
+# headers of the index: departure date and time of request of every response, and where its line
+# (gzip member or zstd frame of compressed file) is in the raw file
+INDEX_HEADERS = ['dep_date', 'requested_at', 'offset', 'length']
+
+
+def get_index_path(raw_file):
+    """
+    Path to the sidecar index of the raw file.
+
+    Parameters:
+    - raw_file (str) : path to raw file.
+
+    Return:
+    - str : raw file path with .idx suffix.
+    """
+    return raw_file + INDEX_SUFFIX
+
+
+def open_index(index_file, new=False):
+    """
+    Open the index for appending entries (see write_entry), the headers are written to an empty one.
+
+    Parameters:
+    - index_file (str) : path to index file.
+    - new (bool) : start the index from scratch instead of appending.
+
+    Return:
+    - text file object.
+    """
+    index = open(index_file, 'w' if new else 'a', newline='')
+    if index.tell() == 0:
+        csv.writer(index, lineterminator='\n').writerow(INDEX_HEADERS)
+    return index
+
+
+def write_entry(index, dep_date, requested_at, offset, length):
+    """
+    Append the entry of the response to the open index. It's written after the response, so the index
+    never points beyond the raw file.
+
+    Parameters:
+    - index (file object) : index opened by open_index().
+    - dep_date (str) : departure date of the response in yyyy-mm-dd format.
+    - requested_at (str) : time of request in ISO format.
+    - offset (int) : offset of the response (its frame if compressed) in the raw file.
+    - length (int) : length of the response line with '\n' (of its frame if compressed).
+    """
+    csv.writer(index, lineterminator='\n').writerow([dep_date, requested_at, offset, length])
+
+
+def read_index(raw_file):
+    """
+    Read the sidecar index of the raw file.
+
+    Parameters:
+    - raw_file (str) : path to raw file.
+
+    Return:
+    - dict : {(dep_date, requested_at): (offset, length)} in order of the raw file, empty if there is no index.
+      A response requested again at the same time (the one-off indexer only knows the request date) replaces
+      the previous one.
+    """
+    index_file = get_index_path(raw_file)
+    if not os.path.exists(index_file):
+        return {}
+
+    with open(index_file, 'r', newline='') as file:
+        csv_reader = csv.reader(file)
+        next(csv_reader, None)
+        return {(dep_date, requested_at): (int(offset), int(length))
+                for dep_date, requested_at, offset, length in csv_reader}
+
+
+def get_dep_date(line):
+    """
+    Departure date of the response when the extract hasn't recorded it: the one of "unchanged" marker,
+    or the local departure date of its first journey.
+
+    Parameters:
+    - line (bytes) : single lined response.
+
+    Return:
+    - str : departure date in yyyy-mm-dd format, empty if the response has no journeys or can't be parsed.
+    """
+    parsed_line = processing.parse_response(line)
+    if processing.is_unchanged_marker(parsed_line):
+        return parsed_line['departureDate']
+    try:
+        journey = parsed_line['data']['searchJourney'][0]
+        return processing.fact_columns(journey['departureTime'], journey['arrivalTime'])[0]
+    except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+        return ''
+
+
+def scan_responses(data, codec, start=0):
+    """
+    Find the responses of the raw file from the offset on: lines of plain file, or frames of compressed one.
+    A line without '\n' at the end is not complete yet and is left for the next scan.
+
+    Parameters:
+    - data (bytes or mmap) : content of the raw file.
+    - codec (str) : 'gzip', 'zstd' or empty string for plain text.
+    - start (int) : offset to scan from, the end of the indexed part.
+
+    Return:
+    - generator : (offset, length, line) of every non-empty response.
+    """
+    if codec:
+        for offset, length, line in compression.iter_frames(data, codec, start):
+            # the whole file compressed at once (e.g. archived one) has no separate frames to point to
+            if line.count(b'\n') > 1:
+                raise ValueError(f"frame at {offset} holds more than one response, the file can't be indexed")
+            if line.strip():
+                yield offset, length, line
+        return
+
+    offset = start
+    while offset < len(data):
+        end = data.find(b'\n', offset)
+        if end < 0:
+            return
+        line = data[offset:end + 1]
+        if line.strip():
+            yield offset, end + 1 - offset, line
+        offset = end + 1
+
+
+def update_index(raw_file):
+    """
+    Index the responses of the raw file which aren't in its index yet (all of them for a file without index),
+    i.e. the one-off indexer of files written without index and the catch-up of appended ones.
+    Departure dates are taken from the responses (see get_dep_date), time of request is the request date
+    of the file. The index which points beyond the raw file (e.g. the file has been replaced) is rebuilt.
+
+    Parameters:
+    - raw_file (str) : path to raw file.
+
+    Return:
+    - int : number of indexed responses.
+    - None : something went wrong, the index is left as it was.
+    """
+    index_file = get_index_path(raw_file)
+    if not os.path.isfile(raw_file):
+        log(f"Error: File not found - {raw_file}", "./logs/processing_log.txt", "ERROR")
+        return None
+    try:
+        size = os.path.getsize(raw_file)
+        end = max((offset + length for offset, length in read_index(raw_file).values()), default=0)
+        if end > size:
+            log(f"{index_file} doesn't match {raw_file}, it's rebuilt", "./logs/processing_log.txt", "WARNING")
+            end = 0
+        if end == size:
+            return 0
+
+        request_date = parameters.get_request_date(raw_file)
+        with open(raw_file, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            entries = [(get_dep_date(line), request_date, offset, length)
+                       for offset, length, line in scan_responses(data, compression.get_codec(raw_file), end)]
+
+        with open_index(index_file, new=end == 0) as index:
+            for entry in entries:
+                write_entry(index, *entry)
+        return len(entries)
+    except Exception as e:
+        log(f"Error: {raw_file} couldn't be indexed - {e}", "./logs/processing_log.txt", "ERROR")
+        return None
+
+
+def iter_responses(raw_file, dep_dates=None, failures=None, unchanged=None, selective=True):
+    """
+    Parse only the responses of the departure dates from the raw file: the file is memory-mapped and
+    the responses are found by its index (brought up to date first, see update_index), so the rest of
+    the file is never read or decompressed. Yields the same as processing.iter_parse_file() for them.
+
+    Parameters:
+    - raw_file (str) : path to raw file.
+    - dep_dates (iter) : departure dates in yyyy-mm-dd format, all the responses if None.
+    - failures (list) : if given, offsets of responses which couldn't be parsed are appended to it.
+    - unchanged (list) : if given, "unchanged" markers of the departure dates are appended to it.
+    - selective (bool) : parse only the fields needed for extract_journeys(), False to parse everything.
+
+    Return:
+    - generator : parsed json responses (dict) in order of the raw file.
+    """
+    if update_index(raw_file) is None:
+        return
+    dep_dates = None if dep_dates is None else set(dep_dates)
+    entries = sorted((offset, length) for (dep_date, _), (offset, length) in read_index(raw_file).items()
+                     if dep_dates is None or dep_date in dep_dates)
+    if not entries:
+        return
+
+    codec = compression.get_codec(raw_file)
+    try:
+        with open(raw_file, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset, length in entries:
+                metrics.increment('bytes_read', length)
+                line = compression.decompress_frame(data[offset:offset + length], codec)
+                parsed_line = processing.parse_response(line) if selective else processing.parse_json_line(line)
+                if parsed_line is None:
+                    metrics.increment('responses_failed')
+                    if failures is not None:
+                        failures.append(offset)
+                    continue
+
+                if processing.is_unchanged_marker(parsed_line):
+                    metrics.increment('responses_unchanged')
+                    if unchanged is not None:
+                        unchanged.append(parsed_line)
+                    continue
+
+                metrics.increment('responses_parsed')
+                yield parsed_line
+    except Exception as e:
+        log(f"Error: {e}", "./logs/processing_log.txt", "ERROR")
+
+
+def get_response(raw_file, dep_date, requested_at=None):
+    """
+    Single response of the departure date from the raw file (see iter_responses).
+
+    Parameters:
+    - raw_file (str) : path to raw file.
+    - dep_date (str) : departure date in yyyy-mm-dd format.
+    - requested_at (str) : time of request as in the index, the latest response of the date if None.
+
+    Return:
+    - dict : parsed json response, "unchanged" marker as it is.
+    - None : there is no such response or it couldn't be parsed.
+    """
+    if update_index(raw_file) is None:
+        return None
+    entries = [(offset, length) for (entry_date, entry_time), (offset, length) in read_index(raw_file).items()
+               if entry_date == dep_date and requested_at in (None, entry_time)]
+    if not entries:
+        return None
+
+    offset, length = max(entries)
+    try:
+        with open(raw_file, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            line = compression.decompress_frame(data[offset:offset + length], compression.get_codec(raw_file))
+        return processing.parse_json_line(line)
+    except Exception as e:
+        log(f"Error: {e}", "./logs/processing_log.txt", "ERROR")
+        return None
@@ -20,8 +20,8 @@ url="https://www.vr.fi/api/v7"
 # JSON payload
 payload=$(sed "s/{{ARRIVAL_STATION}}/"$arrival"/1; s/{{DEPARTURE_STATION}}/"$departure"/1; s/{{DATE}}/"$dep_date"/1" "./Resources/payload.json")
 
-# Make the POST request
-response=$(curl -s -w "Status Code: %{http_code}, Time to Connect: %{time_connect}, Bytes Downloaded: %{size_download}\n" -X POST -H "Content-Type: application/json" -d "$payload" "$url")
+# Make the POST request, transient errors (timeouts, 408, 429, 5xx) are repeated with growing delays
+response=$(curl -s --retry 3 --retry-max-time 60 -w "Status Code: %{http_code}, Time to Connect: %{time_connect}, Bytes Downloaded: %{size_download}\n" -X POST -H "Content-Type: application/json" -d "$payload" "$url")
 
 # Extract content and status code from the response
 content=$(echo "$response" | sed -n '1p')
@@ -30,5 +30,10 @@ parameters=$(echo "$response" | sed -n '2p')
 # Log the request
 echo "[$(date +"%Y-%m-%d %H:%M:%S")] $departure, $arrival, $dep_date, $parameters" >> "$log_file"
 
-# Return the content
+# Return the content only if it's a valid response (an error body would break the raw file)
+status=$(echo "$parameters" | sed -n 's/^Status Code: \([0-9]*\).*/\1/p')
+if [ "$status" != "200" ] || ! echo "$content" | grep -Eq '"searchJourney": ?\['; then
+    echo "[$(date +"%Y-%m-%d %H:%M:%S")] $departure, $arrival, $dep_date, Error: invalid response" >> "$log_file"
+    exit 1
+fi
 echo "$content"
\ No newline at end of file
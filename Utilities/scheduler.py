@@ -0,0 +1,180 @@
+import datetime
+import heapq
+import json
+import os
+
+# refresh intervals in days a departure date can be planned with
+INTERVALS = [1, 2, 3, 5, 7]
+
+
+def get_change_probabilities(rates, days_forward):
+    """
+    Daily probability of change of a departure date by days until departure, from the history.
+
+    Counts are smoothed (one change per two days is added), so buckets with a short history
+    are neither "never changes" nor "always changes". Buckets without history (e.g. the last day
+    of the horizon, which has no previous snapshot) take the counts of the nearest bucket.
+
+    Parameters:
+    - rates (dict) : {days until departure: (days observed, changes)}, see psql.get_change_rates().
+    - days_forward (int) : planning horizon in days.
+
+    Return:
+    - list : probabilities for 0..days_forward-1 days until departure.
+    """
+    probabilities = []
+    for days_until in range(days_forward):
+        if rates and days_until not in rates:
+            days_until = min(rates, key=lambda known: abs(known - days_until))
+        days, changes = rates.get(days_until, (0, 0))
+        probabilities.append(min(1.0, (changes + 1) / (days + 2)))
+    return probabilities
+
+
+def stale_share(probability, interval):
+    """
+    Expected share of time the stored data of a departure date is outdated if it's requested
+    every interval days and changes with the probability every day.
+
+    Parameters:
+    - probability (float) : daily probability of change.
+    - interval (int) : refresh interval in days.
+
+    Return:
+    - float : share from 0 to 1.
+    """
+    return 1 - sum((1 - probability) ** age for age in range(interval)) / interval
+
+
+def plan_intervals(probabilities, budget):
+    """
+    Choose refresh interval of every (direction, days until departure) bucket, so that the expected
+    staleness is the least while the requests per day fit the budget.
+
+    Greedy: everything starts with the longest interval, then the bucket with the largest decrease
+    of staleness per additional request gets the next shorter interval, until the budget is spent.
+
+    Parameters:
+    - probabilities (dict) : {direction: daily probabilities of change by days until departure}.
+    - budget (float) : requests per day for all the directions.
+
+    Return:
+    - dict : {direction: intervals in days by days until departure}.
+    """
+    plan = {direction: [INTERVALS[-1]] * len(values) for direction, values in probabilities.items()}
+    requests = sum(len(values) / INTERVALS[-1] for values in probabilities.values())
+
+    def next_step(direction, days_until):
+        # staleness decrease per additional request of the next shorter interval
+        interval = plan[direction][days_until]
+        index = INTERVALS.index(interval)
+        if index == 0:
+            return None
+        shorter = INTERVALS[index - 1]
+        probability = probabilities[direction][days_until]
+        gain = stale_share(probability, interval) - stale_share(probability, shorter)
+        cost = 1 / shorter - 1 / interval
+        return -gain / cost, cost, direction, days_until, shorter
+
+    steps = [step for direction, values in probabilities.items() for days_until in range(len(values))
+             if (step := next_step(direction, days_until))]
+    heapq.heapify(steps)
+
+    while steps:
+        _, cost, direction, days_until, shorter = heapq.heappop(steps)
+        if requests + cost > budget + 1e-9:
+            continue
+        plan[direction][days_until] = shorter
+        requests += cost
+        step = next_step(direction, days_until)
+        if step:
+            heapq.heappush(steps, step)
+
+    return plan
+
+
+def get_scheduled_dates(intervals, date_from=None):
+    """
+    Departure dates to request today: every days_until-th bucket which is divisible by its interval,
+    so a departure date is requested every interval days while it moves through the bucket.
+
+    Parameters:
+    - intervals (list) : refresh intervals by days until departure.
+    - date_from (datetime.date) : date of request, today by default.
+
+    Return:
+    - list : dates in yyyy-mm-dd format.
+    """
+    date_from = date_from or datetime.date.today()
+    return [(date_from + datetime.timedelta(days=days_until)).isoformat()
+            for days_until, interval in enumerate(intervals) if days_until % interval == 0]
+
+
+def report(plan, probabilities):
+    """
+    Summary of the plan compared to requesting everything every day.
+
+    Parameters:
+    - plan (dict) : {direction: intervals by days until departure}.
+    - probabilities (dict) : {direction: daily probabilities of change by days until departure}.
+
+    Return:
+    - list : report lines.
+    """
+    lines = [f"{'direction':<10} {'requests/day':>13} {'planned':>8} {'saved':>7} {'staleness':>10} "
+             f"{'intervals (days until departure: interval)':<40}"]
+    total_full, total_planned = 0, 0
+    for direction, intervals in plan.items():
+        full = len(intervals)
+        planned = sum(1 / interval for interval in intervals)
+        staleness = sum(stale_share(probability, interval)
+                        for probability, interval in zip(probabilities[direction], intervals)) / len(intervals)
+        total_full += full
+        total_planned += planned
+
+        # ranges of days until departure with the same interval
+        ranges = []
+        for days_until, interval in enumerate(intervals):
+            if ranges and ranges[-1][2] == interval:
+                ranges[-1][1] = days_until
+            else:
+                ranges.append([days_until, days_until, interval])
+        ranges = ', '.join(f"{start}-{end}: {interval}" for start, end, interval in ranges)
+
+        lines.append(f"{direction:<10} {full:>13} {planned:>8.1f} {1 - planned / full:>7.0%} {staleness:>10.1%} "
+                     f"{ranges}")
+
+    if total_full:
+        lines.append(f"{'total':<10} {total_full:>13} {total_planned:>8.1f} {1 - total_planned / total_full:>7.0%}")
+    return lines
+
+
+def save_plan(plan, schedule_file, budget):
+    """
+    Write the plan to json file for extract.py --schedule.
+
+    Parameters:
+    - plan (dict) : {direction: intervals by days until departure}.
+    - schedule_file (str) : output file path.
+    - budget (float) : requests per day the plan was made for.
+    """
+    os.makedirs(os.path.dirname(schedule_file) or '.', exist_ok=True)
+    with open(schedule_file, 'w') as file:
+        json.dump({'created': datetime.date.today().isoformat(), 'budget': budget, 'intervals': plan}, file,
+                  indent=1)
+
+
+def load_plan(schedule_file):
+    """
+    Read the plan written by save_plan().
+
+    Parameters:
+    - schedule_file (str) : plan file path.
+
+    Return:
+    - dict : {direction: intervals by days until departure}, empty if there is no file.
+    """
+    if not os.path.exists(schedule_file):
+        return {}
+    with open(schedule_file, 'r') as file:
+        return json.load(file)['intervals']
@@ -0,0 +1,165 @@
+import contextlib
+import datetime
+import itertools
+import os
+import queue
+import threading
+from Utilities import compression
+from Utilities import extractor
+from Utilities import metrics
+from Utilities import processing
+from Utilities import psql
+from Utilities.log import log
+
+# default max number of parsed responses waiting for the db writer
+QUEUE_SIZE = 64
+
+
+def load_direction(direction, contents, request_date, archive_file='', codec='', queue_size=QUEUE_SIZE,
+                   partition='', reject_file=None, upsert=False, fact_table=''):
+    """
+    Stream responses of the direction to its table: the calling thread parses responses and extracts journeys,
+    a writer thread sends them to the db with a single COPY. Parsed responses wait for the writer in a bounded
+    queue, so a slow db holds the parsing (and the requests) back.
+
+    Rows and summary tables are committed in one transaction at the end, readers see either the previous
+    or the new snapshot.
+
+    Parameters:
+    - direction (str) : direction in format FROM TO.
+    - contents (iter) : single lined responses of the direction (bytes), empty ones are skipped.
+    - request_date (str) : date of request in yyyy-mm-dd format.
+    - archive_file (str) : raw file to append the responses to, as extract.py does. Not archived if empty.
+    - codec (str) : 'gzip' or 'zstd' to compress the archived responses, empty for plain text.
+    - queue_size (int) : max number of parsed responses waiting for the writer.
+    - partition (str) : 'day' or 'month' if the table is partitioned, the partition is created first.
+    - reject_file (str) : path for rejected rows, they are only counted if None.
+    - upsert (bool) : merge rows by natural key (see psql.upsert_rows) instead of appending them.
+    - fact_table (str) : unified fact table of all the directions (see FACT_TABLE), the direction table if empty.
+
+    Return:
+    - int : number of rows loaded (merged if upsert).
+    - None : loading failed, nothing is committed.
+    """
+    # make direction name compatible to postgres
+    table_name = direction.replace(' ', '_').lower()
+    target_table = fact_table or table_name
+    columns = processing.FACT_HEADERS if fact_table else processing.HEADERS
+    rows_queue = queue.Queue(maxsize=queue_size)
+    loaded = [None]
+    finished = threading.Event()
+
+    def iter_rows():
+        # rows of the batches put to the queue, until None is put
+        for batch in iter(rows_queue.get, None):
+            yield from batch
+        finished.set()
+
+    def write():
+        load_rows = psql.upsert_rows if upsert else psql.copy_rows
+        loaded[0] = load_rows(target_table, iter_rows(), reject_file=reject_file,
+                              source=f"{direction} {request_date} responses", columns=columns, session=session)
+        if isinstance(loaded[0], dict):
+            loaded[0] = sum(loaded[0].values())
+        # the load has failed halfway, let the parsing finish instead of blocking it
+        if not finished.is_set():
+            for _ in iter(rows_queue.get, None):
+                pass
+
+    with psql.Session(transaction=True) as session:
+        if partition:
+            psql.create_partition(table_name=target_table, request_date=request_date, partition=partition,
+                                  session=session)
+
+        writer = threading.Thread(target=write, name=f"copy {table_name}")
+        writer.start()
+        try:
+            with open(archive_file, 'ab') if archive_file else contextlib.nullcontext() as archive:
+                for content in contents:
+                    if not content:
+                        continue
+
+                    # raw response is kept as a side output
+                    if archive:
+                        frame = compression.compress_frame(content + b'\n', codec)
+                        archive.write(frame)
+                        metrics.increment('bytes_written', len(frame))
+
+                    parsed_line = processing.parse_response(content)
+                    if parsed_line is None:
+                        metrics.increment('responses_failed')
+                        continue
+                    metrics.increment('responses_parsed')
+                    rows_queue.put(list(processing.extract_rows(parsed_line, request_date,
+                                                                direction if fact_table else None)))
+        finally:
+            rows_queue.put(None)
+            writer.join()
+
+        # views over the fact table are always up to date, only their readers are notified
+        if fact_table:
+            refreshed = psql.notify_refreshed(table_name=table_name, session=session)
+        else:
+            refreshed = psql.refresh_summaries(table_name=table_name, request_date=request_date, session=session)
+        if loaded[0] is None or not refreshed:
+            session.failed = True
+            return None
+    return loaded[0]
+
+
+def stream(directions, destination_folder, days_forward, url=extractor.API_URL, concurrency=8, rate_limit=5.0,
+           window=None, queue_size=QUEUE_SIZE, archive=True, codec='', partition='', upsert=False, fact_table=''):
+    """
+    Request all the directions for days_forward days and load the journeys straight to the db,
+    without raw and csv files in between (raw files are written as a side output if archive is on).
+
+    Parameters:
+    - directions (iter) : list of directions.
+    - destination_folder (str) : root folder of raw files and rejected rows.
+    - days_forward (int) : how many days from today to request.
+    - url (str) : API endpoint (a local stub server for testing).
+    - concurrency (int) : max number of requests in flight (and pooled connections).
+    - rate_limit (float) : max requests per second, 0 for no limit.
+    - window (int) : max number of responses requested ahead of the parsing, 4 x concurrency by default.
+    - queue_size (int) : max number of parsed responses waiting for the db writer.
+    - archive (bool) : append responses to destination_folder/<direction>/<today>.txt as extract.py does.
+    - codec (str) : 'gzip' or 'zstd' to compress the archived responses, empty for plain text.
+    - partition (str) : 'day' or 'month' if the tables are partitioned.
+    - upsert (bool) : merge rows by natural key instead of appending them.
+    - fact_table (str) : unified fact table of all the directions, direction tables if empty.
+
+    Return:
+    - dict : {direction: rows loaded, None if failed}.
+    """
+    template = extractor.read_payload_template()
+    request_date = datetime.date.today().isoformat()
+    dep_dates = extractor.get_departure_dates(days_forward)
+
+    pool = extractor.ConnectionPool(url, size=concurrency)
+    limiter = extractor.RateLimiter(rate_limit)
+    results = {}
+    try:
+        responses = extractor.stream_responses(pool, limiter, template, directions, dep_dates,
+                                               window=window or 4 * concurrency)
+        # responses come direction by direction, every direction is a separate load
+        for direction, direction_responses in itertools.groupby(responses, key=lambda response: response[0]):
+            os.makedirs(os.path.join(destination_folder, direction), exist_ok=True)
+            archive_file = extractor.get_raw_path(destination_folder, direction, request_date, codec) if archive \
+                else ''
+            results[direction] = load_direction(direction,
+                                                (content for _, _, content in direction_responses),
+                                                request_date,
+                                                archive_file=archive_file,
+                                                codec=codec,
+                                                queue_size=queue_size,
+                                                partition=partition,
+                                                upsert=upsert,
+                                                fact_table=fact_table,
+                                                reject_file=os.path.join(destination_folder, direction,
+                                                                         request_date + '.rejects'))
+            log(f"{direction}: {results[direction]} rows of {request_date} have been streamed to db",
+                './logs/db_log.txt')
+    finally:
+        pool.close()
+
+    return results
@@ -0,0 +1,431 @@
+import datetime
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+from Utilities import psql
+from Utilities.log import log
+
+# default lease of a claimed task in seconds, it's claimed again by another worker when expired
+LEASE_SECONDS = 300
+
+# default attempts of a task before it's marked failed
+MAX_ATTEMPTS = 3
+
+# delay before the first retry in seconds, doubled with every attempt
+RETRY_DELAY = 30
+
+# tasks of all the workers: 'extract' (direction, departure date), 'transform' (raw file) and 'load' (csv file).
+# A task with blocked_by waits until no task of that kind with the same group_key is pending or running.
+POSTGRES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS work_queue (
+    id BIGSERIAL PRIMARY KEY,
+    kind VARCHAR(10) NOT NULL,
+    payload TEXT NOT NULL,
+    group_key TEXT NOT NULL DEFAULT '',
+    blocked_by VARCHAR(10) NOT NULL DEFAULT '',
+    status VARCHAR(10) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker TEXT,
+    lease_until TIMESTAMPTZ,
+    available_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    error TEXT,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    UNIQUE (kind, payload)
+);
+CREATE INDEX IF NOT EXISTS work_queue_claim_idx ON work_queue (status, available_at);
+CREATE INDEX IF NOT EXISTS work_queue_group_idx ON work_queue (group_key, kind, status);
+"""
+
+# the same for the local stand-in, times are unix timestamps
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS work_queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    group_key TEXT NOT NULL DEFAULT '',
+    blocked_by TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker TEXT,
+    lease_until REAL,
+    available_at REAL NOT NULL,
+    error TEXT,
+    updated_at REAL NOT NULL,
+    UNIQUE (kind, payload)
+);
+CREATE INDEX IF NOT EXISTS work_queue_claim_idx ON work_queue (status, available_at);
+CREATE INDEX IF NOT EXISTS work_queue_group_idx ON work_queue (group_key, kind, status);
+"""
+
+
+def task(kind, payload, group_key='', blocked_by=''):
+    """
+    Task to enqueue.
+
+    Parameters:
+    - kind (str) : 'extract', 'transform' or 'load'.
+    - payload (dict) : what to do, e.g. {'path': csv file path}. The same kind and payload is the same task.
+    - group_key (str) : group of the task, e.g. direction and request date.
+    - blocked_by (str) : kind of tasks of the same group to wait for.
+
+    Return:
+    - tuple : task to pass to enqueue() or complete().
+    """
+    return kind, json.dumps(payload, sort_keys=True), group_key, blocked_by
+
+
+def _claimed(rows):
+    # claimed rows to task dicts, attempts is the fencing token of the lease
+    return [{'id': task_id, 'kind': kind, 'payload': json.loads(payload), 'attempts': attempts}
+            for task_id, kind, payload, attempts in rows]
+
+
+class PostgresQueue:
+    """
+    Work queue in the table of the database from database.ini, shared by workers on any number of servers.
+
+    Workers claim tasks with FOR UPDATE SKIP LOCKED, so they never wait for each other and never get the same
+    task while its lease is valid. Completion is accepted only from the current holder of the lease, and can be
+    committed in one transaction with the work itself (see complete()), so a load is never done twice.
+    """
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+    def create(self, session=None):
+        """
+        Create the queue table if needed.
+
+        Return:
+        - bool: True if successful, False otherwise.
+        """
+        return psql._execute(POSTGRES_SCHEMA, 'Table work_queue has been created', session)
+
+    def enqueue(self, tasks, session=None):
+        """
+        Add tasks to the queue. Tasks which are queued already stay as they are, finished (done or failed)
+        ones are queued again.
+
+        Parameters:
+        - tasks (list) : tasks made by task().
+        - session (Session) : shared session, a pooled connection is used if None
+
+        Return:
+        - int : number of tasks queued.
+        """
+        with psql.connection(session) as conn, conn.cursor() as cursor:
+            return self._enqueue(cursor, tasks)
+
+    def _enqueue(self, cursor, tasks):
+        cursor.executemany("""INSERT INTO work_queue (kind, payload, group_key, blocked_by, max_attempts)
+                              VALUES (%s, %s, %s, %s, %s)
+                              ON CONFLICT (kind, payload) DO UPDATE SET status = 'pending', attempts = 0,
+                              worker = NULL, lease_until = NULL, available_at = now(), error = NULL,
+                              updated_at = now()
+                              WHERE work_queue.status IN ('done', 'failed')""",
+                           [(*queued_task, self.max_attempts) for queued_task in tasks])
+        return cursor.rowcount
+
+    def claim(self, worker, kinds, limit=1, lease_seconds=LEASE_SECONDS):
+        """
+        Take up to limit pending tasks (or tasks with expired lease) of the kinds, oldest first.
+
+        Parameters:
+        - worker (str) : worker id.
+        - kinds (list) : kinds of tasks to take.
+        - limit (int) : max number of tasks.
+        - lease_seconds (int) : lease of the tasks.
+
+        Return:
+        - list : tasks {'id', 'kind', 'payload', 'attempts'}.
+        """
+        with psql.connection() as conn, conn.cursor() as cursor:
+            # workers which died on the last attempt don't block the queue forever
+            cursor.execute("""UPDATE work_queue SET status = 'failed', error = 'lease expired', lease_until = NULL,
+                              updated_at = now()
+                              WHERE status = 'running' AND lease_until < now() AND attempts >= max_attempts""")
+
+            cursor.execute("""WITH claimed AS (
+                                  SELECT id FROM work_queue t
+                                  WHERE kind = ANY(%s)
+                                  AND ((status = 'pending' AND available_at <= now())
+                                       OR (status = 'running' AND lease_until < now()))
+                                  AND NOT EXISTS (SELECT 1 FROM work_queue b
+                                                  WHERE t.blocked_by <> '' AND b.group_key = t.group_key
+                                                  AND b.kind = t.blocked_by AND b.status IN ('pending', 'running'))
+                                  ORDER BY id
+                                  LIMIT %s
+                                  FOR UPDATE SKIP LOCKED)
+                              UPDATE work_queue SET status = 'running', attempts = attempts + 1, worker = %s,
+                              lease_until = now() + %s * INTERVAL '1 second', updated_at = now()
+                              FROM claimed WHERE work_queue.id = claimed.id
+                              RETURNING work_queue.id, kind, payload, attempts""",
+                           (list(kinds), limit, worker, lease_seconds))
+            return sorted(_claimed(cursor.fetchall()), key=lambda claimed_task: claimed_task['id'])
+
+    def complete(self, claimed_task, worker, next_tasks=(), session=None):
+        """
+        Mark the task done and queue the tasks following it, if the worker still holds the lease.
+
+        With a transaction session the result of the task (e.g. loaded rows) is committed together with
+        the completion, the caller should roll it back if the lease has been lost.
+
+        Parameters:
+        - claimed_task (dict) : task returned by claim().
+        - worker (str) : worker id.
+        - next_tasks (list) : tasks made by task() to queue.
+        - session (Session) : shared session, a pooled connection is used if None
+
+        Return:
+        - bool: True if completed, False if the lease has been lost (the task is someone else's now).
+        """
+        with psql.connection(session) as conn, conn.cursor() as cursor:
+            cursor.execute("""UPDATE work_queue SET status = 'done', lease_until = NULL, error = NULL,
+                              updated_at = now()
+                              WHERE id = %s AND worker = %s AND attempts = %s AND status = 'running'""",
+                           (claimed_task['id'], worker, claimed_task['attempts']))
+            if cursor.rowcount != 1:
+                return False
+            if next_tasks:
+                self._enqueue(cursor, next_tasks)
+        return True
+
+    def fail(self, claimed_task, worker, error):
+        """
+        Put the task back to the queue with a growing delay, or mark it failed after max attempts.
+
+        Parameters:
+        - claimed_task (dict) : task returned by claim().
+        - worker (str) : worker id.
+        - error (str) : reason of failure.
+
+        Return:
+        - bool: True if recorded, False if the lease has been lost.
+        """
+        delay = self.retry_delay * 2 ** (claimed_task['attempts'] - 1)
+        with psql.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""UPDATE work_queue
+                              SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END,
+                              available_at = now() + %s * INTERVAL '1 second', lease_until = NULL, error = %s,
+                              updated_at = now()
+                              WHERE id = %s AND worker = %s AND attempts = %s AND status = 'running'""",
+                           (delay, error, claimed_task['id'], worker, claimed_task['attempts']))
+            return cursor.rowcount == 1
+
+    def stats(self):
+        """
+        Return:
+        - dict : {(kind, status): number of tasks}.
+        """
+        with psql.connection() as conn, conn.cursor() as cursor:
+            cursor.execute('SELECT kind, status, COUNT(*) FROM work_queue GROUP BY kind, status')
+            return {(kind, status): count for kind, status, count in cursor.fetchall()}
+
+    def failures(self):
+        """
+        Return:
+        - list : (kind, payload, error) of the failed tasks.
+        """
+        with psql.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT kind, payload, error FROM work_queue WHERE status = 'failed' ORDER BY id")
+            return cursor.fetchall()
+
+    def purge(self, days):
+        """
+        Remove tasks which have been done more than days ago.
+
+        Return:
+        - int : number of removed tasks.
+        """
+        with psql.connection() as conn, conn.cursor() as cursor:
+            cursor.execute("""DELETE FROM work_queue
+                              WHERE status = 'done' AND updated_at < now() - %s * INTERVAL '1 day'""", (days,))
+            return cursor.rowcount
+
+
+class SqliteQueue:
+    """
+    Local stand-in of PostgresQueue in a sqlite file, for workers of a single server (or a shared disk
+    with working locks). Claims are serialized by the write lock of the file (BEGIN IMMEDIATE).
+
+    The work of a task and its completion are not in one transaction, so a task whose lease expired
+    in the middle of the work may be done twice. Keep the lease longer than the longest task.
+    """
+
+    def __init__(self, queue_file, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+        self.queue_file = queue_file
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+    def connect(self):
+        # autocommit mode, transactions are started explicitly
+        os.makedirs(os.path.dirname(self.queue_file) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.queue_file, timeout=60, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def create(self, session=None):
+        try:
+            with closing(self.connect()) as conn:
+                conn.executescript(SQLITE_SCHEMA)
+            return True
+        except sqlite3.Error as error:
+            log(error, './logs/worker_log.txt', 'ERROR')
+            return False
+
+    def enqueue(self, tasks, session=None, conn=None):
+        now = time.time()
+        rows = [(*queued_task, self.max_attempts, now, now) for queued_task in tasks]
+        query = """INSERT INTO work_queue (kind, payload, group_key, blocked_by, max_attempts, available_at,
+                   updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (kind, payload) DO UPDATE SET status = 'pending', attempts = 0, worker = NULL,
+                   lease_until = NULL, available_at = excluded.available_at, error = NULL,
+                   updated_at = excluded.updated_at
+                   WHERE work_queue.status IN ('done', 'failed')"""
+        if conn is not None:
+            return conn.executemany(query, rows).rowcount
+        with closing(self.connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            queued = conn.executemany(query, rows).rowcount
+            conn.execute('COMMIT')
+        return queued
+
+    def claim(self, worker, kinds, limit=1, lease_seconds=LEASE_SECONDS):
+        kinds = list(kinds)
+        now = time.time()
+        with closing(self.connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute("""UPDATE work_queue SET status = 'failed', error = 'lease expired', lease_until = NULL,
+                            updated_at = ?
+                            WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts""",
+                         (now, now))
+            ids = [row[0] for row in conn.execute(
+                f"""SELECT id FROM work_queue t
+                    WHERE kind IN ({', '.join('?' * len(kinds))})
+                    AND ((status = 'pending' AND available_at <= ?) OR (status = 'running' AND lease_until < ?))
+                    AND NOT EXISTS (SELECT 1 FROM work_queue b
+                                    WHERE t.blocked_by <> '' AND b.group_key = t.group_key
+                                    AND b.kind = t.blocked_by AND b.status IN ('pending', 'running'))
+                    ORDER BY id
+                    LIMIT ?""", (*kinds, now, now, limit))]
+            conn.executemany("""UPDATE work_queue SET status = 'running', attempts = attempts + 1, worker = ?,
+                                lease_until = ?, updated_at = ?
+                                WHERE id = ?""", [(worker, now + lease_seconds, now, task_id) for task_id in ids])
+            rows = conn.execute(f"""SELECT id, kind, payload, attempts FROM work_queue
+                                    WHERE id IN ({', '.join('?' * len(ids))}) ORDER BY id""", ids).fetchall()
+            conn.execute('COMMIT')
+        return _claimed(rows)
+
+    def complete(self, claimed_task, worker, next_tasks=(), session=None):
+        with closing(self.connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            completed = conn.execute("""UPDATE work_queue SET status = 'done', lease_until = NULL, error = NULL,
+                                        updated_at = ?
+                                        WHERE id = ? AND worker = ? AND attempts = ? AND status = 'running'""",
+                                     (time.time(), claimed_task['id'], worker,
+                                      claimed_task['attempts'])).rowcount == 1
+            if completed and next_tasks:
+                self.enqueue(next_tasks, conn=conn)
+            conn.execute('COMMIT')
+        return completed
+
+    def fail(self, claimed_task, worker, error):
+        now = time.time()
+        delay = self.retry_delay * 2 ** (claimed_task['attempts'] - 1)
+        with closing(self.connect()) as conn:
+            return conn.execute("""UPDATE work_queue
+                                   SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END,
+                                   available_at = ?, lease_until = NULL, error = ?, updated_at = ?
+                                   WHERE id = ? AND worker = ? AND attempts = ? AND status = 'running'""",
+                                (now + delay, error, now, claimed_task['id'], worker,
+                                 claimed_task['attempts'])).rowcount == 1
+
+    def stats(self):
+        with closing(self.connect()) as conn:
+            rows = conn.execute('SELECT kind, status, COUNT(*) FROM work_queue GROUP BY kind, status').fetchall()
+        return {(kind, status): count for kind, status, count in rows}
+
+    def failures(self):
+        with closing(self.connect()) as conn:
+            return conn.execute("SELECT kind, payload, error FROM work_queue WHERE status = 'failed' "
+                                "ORDER BY id").fetchall()
+
+    def purge(self, days):
+        with closing(self.connect()) as conn:
+            return conn.execute("DELETE FROM work_queue WHERE status = 'done' AND updated_at < ?",
+                                (time.time() - days * 86400,)).rowcount
+
+
+def get_queue(backend, queue_file='', max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY):
+    """
+    Work queue of the backend.
+
+    Parameters:
+    - backend (str) : 'postgres' (database from database.ini) or 'sqlite' (local stand-in).
+    - queue_file (str) : sqlite file of the stand-in.
+    - max_attempts (int) : attempts of a task before it's marked failed.
+    - retry_delay (float) : delay before the first retry in seconds, doubled with every attempt.
+
+    Return:
+    - PostgresQueue or SqliteQueue : the queue.
+    """
+    if backend == 'postgres':
+        return PostgresQueue(max_attempts, retry_delay)
+    if backend == 'sqlite':
+        return SqliteQueue(queue_file, max_attempts, retry_delay)
+    raise ValueError(f"Unknown queue backend {backend}")
+
+
+def is_pending(stats, kinds):
+    """
+    Whether there are tasks of the kinds left to do (pending, or running by someone).
+
+    Parameters:
+    - stats (dict) : {(kind, status): number of tasks}, see stats().
+    - kinds (list) : kinds of tasks.
+
+    Return:
+    - bool: True if there are.
+    """
+    return any(count for (kind, status), count in stats.items()
+               if kind in kinds and status in ('pending', 'running'))
+
+
+def group_key(direction, request_date):
+    """
+    Group of the tasks of the raw file: direction and date of request.
+
+    Return:
+    - str : 'FROM TO/yyyy-mm-dd'.
+    """
+    return f"{direction}/{request_date}"
+
+
+def get_extract_tasks(directions, dep_dates, request_date=None):
+    """
+    Tasks for a day of extract: one per direction and departure date, and the transform of every direction's
+    raw file, which waits until all the departure dates of the direction are requested (or failed).
+
+    Parameters:
+    - directions (iter) : list of directions.
+    - dep_dates (list) : departure dates in yyyy-mm-dd format.
+    - request_date (str) : date of request in yyyy-mm-dd format, today by default.
+
+    Return:
+    - list : tasks made by task().
+    """
+    request_date = request_date or datetime.date.today().isoformat()
+    tasks = []
+    for direction in directions:
+        group = group_key(direction, request_date)
+        tasks.extend(task('extract', {'direction': direction, 'request_date': request_date, 'dep_date': dep_date},
+                          group) for dep_date in dep_dates)
+        tasks.append(task('transform', {'direction': direction, 'request_date': request_date}, group,
+                          blocked_by='extract'))
+    return tasks
@@ -0,0 +1,142 @@
+import argparse
+import datetime
+import json
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from Utilities import parameters
+from Utilities import price_calendar
+from Utilities import psql
+from Utilities.log import log, start_flush_thread
+
+# get configs from config.txt
+CONFIGS = parameters.get_configs()
+
+# get directions from directions.txt
+DIRECTIONS = parameters.get_directions()
+
+# the log file of the service
+SERVICE_LOG = './logs/calendar_service_log.txt'
+
+
+def get_date(query, name):
+    """
+    Date parameter of the query string.
+
+    Return:
+    - str : date in yyyy-mm-dd format, None if not given.
+    """
+    value = query.get(name, [None])[0]
+    if value is not None:
+        # raises ValueError if it's not a date
+        datetime.date.fromisoformat(value)
+    return value
+
+
+class CalendarServer(ThreadingHTTPServer):
+    # many clients connect at once, the default backlog of 5 makes them wait for SYN retries
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def make_handler(calendar):
+    """
+    Request handler class answering from the calendar:
+
+        GET /directions
+        GET /calendar?direction=HKI TPE&from=yyyy-mm-dd&to=yyyy-mm-dd (from and to are optional)
+        GET /trains?direction=HKI TPE&date=yyyy-mm-dd
+        GET /stats (cache statistics)
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_json(self, status, body):
+            content = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            url = urllib.parse.urlsplit(self.path)
+            query = urllib.parse.parse_qs(url.query)
+            direction = query.get('direction', [''])[0]
+
+            try:
+                if url.path == '/directions':
+                    return self.send_json(200, {'directions': DIRECTIONS})
+                if url.path == '/stats':
+                    return self.send_json(200, calendar.cache.stats())
+                if url.path not in ('/calendar', '/trains'):
+                    return self.send_json(404, {'error': f"unknown path {url.path}"})
+                if direction not in DIRECTIONS:
+                    return self.send_json(404, {'error': f"unknown direction '{direction}'"})
+
+                if url.path == '/calendar':
+                    date_from, date_to = get_date(query, 'from'), get_date(query, 'to')
+                    days = calendar.get_calendar(direction, date_from, date_to)
+                    body = {'direction': direction, 'from': date_from, 'to': date_to, 'days': days}
+                    result = days
+                else:
+                    dep_date = get_date(query, 'date')
+                    if dep_date is None:
+                        return self.send_json(400, {'error': 'date is required'})
+                    trains = calendar.get_trains(direction, dep_date)
+                    body = {'direction': direction, 'date': dep_date, 'trains': trains}
+                    result = trains
+            except ValueError as e:
+                return self.send_json(400, {'error': str(e)})
+
+            if result is None:
+                return self.send_json(503, {'error': 'database is not available'})
+            return self.send_json(200, body)
+
+        def log_message(self, format, *args):
+            # requests are not logged one by one, errors are
+            pass
+
+        def log_error(self, format, *args):
+            log(format % args, SERVICE_LOG, 'ERROR')
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP service of price calendars and trains by day, cached in '
+                                                 'memory and refreshed when load_to_db.py loads a direction.')
+    parser.add_argument('--host', default=CONFIGS.get('CALENDAR_HOST', '"127.0.0.1"')[1:-1], help='address to bind')
+    parser.add_argument('--port', type=int, default=int(CONFIGS.get('CALENDAR_PORT', 8080)), help='port to bind')
+    parser.add_argument('--ttl', type=float, default=float(CONFIGS.get('CALENDAR_CACHE_TTL',
+                                                                       price_calendar.CACHE_TTL)),
+                        help='seconds a cached answer is served without asking the db')
+    parser.add_argument('--cache-size', type=int, default=int(CONFIGS.get('CALENDAR_CACHE_SIZE',
+                                                                          price_calendar.CACHE_SIZE)),
+                        help='max number of cached answers')
+    args = parser.parse_args()
+
+    # the queries wait for a free pooled connection instead of failing
+    pool_size = int(CONFIGS.get('DB_POOL_SIZE', psql.POOL_SIZE))
+    psql.get_pool(pool_size)
+    calendar = price_calendar.PriceCalendar(DIRECTIONS, max_size=args.cache_size, ttl=args.ttl,
+                                            db_connections=pool_size)
+    calendar.listen()
+
+    server = CalendarServer((args.host, args.port), make_handler(calendar))
+    log(f"Serving price calendars on {args.host}:{args.port}", SERVICE_LOG)
+    # records are written while the service waits for requests too
+    start_flush_thread()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        calendar.close()
+        psql.close_pool()
+        log('Service stopped', SERVICE_LOG)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import argparse
+import datetime
+import hashlib
+import os
+from Utilities import catalog
+from Utilities import compression
+from Utilities import parameters
+from Utilities import raw_index
+from Utilities.log import log
+
+# get configs from config.txt
+CONFIGS = parameters.get_configs()
+
+# get destination (root) folder from configs
+DESTINATION_FOLDER = CONFIGS['DESTINATION_FOLDER'][1:-1]
+
+# get catalog file from configs, empty if the catalog is not in use
+CATALOG_FILE = CONFIGS.get('CATALOG_FILE', '""')[1:-1]
+
+# get directions from directions.txt
+DIRECTIONS = parameters.get_directions()
+
+
+def stream_checksum(file, block_size=1024 * 1024):
+    # sha1 of the (decompressed) content of opened binary file
+    checksum = hashlib.sha1()
+    for block in iter(lambda: file.read(block_size), b''):
+        checksum.update(block)
+    return checksum.hexdigest()
+
+
+def compress_file(file_path, codec):
+    """
+    Compress plain raw file line by line (one frame per response, the same way extract writes),
+    check that the compressed file reads back the same and remove the plain one.
+    The index of the plain file (see raw_index) is moved to the frames of the compressed one.
+
+    Parameters:
+    - file_path (str) : path to plain raw file.
+    - codec (str) : 'gzip' or 'zstd'.
+
+    Return:
+    - str : path to compressed file.
+    - None : compression failed, plain file is untouched.
+    """
+    output_file = file_path + compression.SUFFIXES[codec]
+    # hidden temporary file with the same suffix
+    temp_file = os.path.join(os.path.dirname(output_file), '.' + os.path.basename(output_file))
+    index_file = raw_index.get_index_path(file_path)
+    temp_index = raw_index.get_index_path(temp_file)
+    # indexed responses by their offset in the plain file
+    entries = {offset: key for key, (offset, _) in raw_index.read_index(file_path).items()}
+    try:
+        with open(file_path, 'rb') as source, open(temp_file, 'wb') as target, \
+                raw_index.open_index(temp_index, new=True) as index:
+            offset = 0
+            for line in source:
+                frame = compression.compress_frame(line, codec)
+                if offset in entries:
+                    raw_index.write_entry(index, *entries[offset], target.tell(), len(frame))
+                target.write(frame)
+                offset += len(line)
+
+        # compare decompressed content with the original
+        with open(file_path, 'rb') as source, compression.open_raw(temp_file) as target:
+            if stream_checksum(source) != stream_checksum(target):
+                raise ValueError("decompressed content differs from the original")
+
+        os.replace(temp_file, output_file)
+        os.remove(file_path)
+        if entries:
+            os.replace(temp_index, raw_index.get_index_path(output_file))
+        else:
+            os.remove(temp_index)
+        if os.path.exists(index_file):
+            os.remove(index_file)
+        return output_file
+    except Exception as e:
+        log(f"Error compressing {file_path}: {e}", "./logs/processing_log.txt", "ERROR")
+        for path in (temp_file, temp_index):
+            if os.path.exists(path):
+                os.remove(path)
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compress historical plain raw files.')
+    parser.add_argument('--codec', choices=['gzip', 'zstd'],
+                        default=CONFIGS.get('RAW_COMPRESSION', '""')[1:-1] or 'gzip',
+                        help='compression codec')
+    parser.add_argument('--before', default='',
+                        help='compress files of request dates before this date (yyyy-mm-dd), today by default')
+    args = parser.parse_args()
+
+    # today's files may still be appended by extract
+    date_before = datetime.date.fromisoformat(args.before) if args.before else datetime.date.today()
+
+    saved = 0
+    for direction in DIRECTIONS:
+        folder = os.path.join(DESTINATION_FOLDER, direction)
+        # direction which hasn't been extracted yet
+        if not os.path.isdir(folder):
+            continue
+        for file_name in sorted(os.listdir(folder)):
+            # only plain raw files yyyy-mm-dd.txt
+            try:
+                file_date, extension = parameters.split_file_name(file_name)
+            except ValueError:
+                continue
+            if extension != 'txt' or compression.get_codec(file_name) or file_date >= date_before:
+                continue
+
+            file_path = os.path.join(folder, file_name)
+            size = os.path.getsize(file_path)
+            output_file = compress_file(file_path, args.codec)
+            if output_file:
+                saved += size - os.path.getsize(output_file)
+                log(f"{file_path} has been compressed to {output_file}", "./logs/processing_log.txt")
+
+                # keep the stages of the file in the catalog
+                if CATALOG_FILE:
+                    catalog.rename_file(CATALOG_FILE, file_path, output_file)
+
+    log(f"Compression of raw files saved {saved / 1024 / 1024:.1f} MB", "./logs/processing_log.txt")
+
+
+if __name__ == "__main__":
+    main()
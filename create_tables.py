@@ -1,32 +1,94 @@
+import argparse
 from Utilities import psql
 from Utilities import parameters
 
 # get configs from config.txt
 CONFIGS = parameters.get_configs()
 
+# get partitioning of direction tables from configs: 'day', 'month' or empty
+PARTITION_BY = CONFIGS.get('PARTITION_BY', '""')[1:-1]
+
+# get unified fact table of all the directions from configs, empty if every direction has its own table
+FACT_TABLE = CONFIGS.get('FACT_TABLE', '""')[1:-1]
+
 # get directions from directions.txt
 DIRECTIONS = parameters.get_directions()
 
 
-def main():
-    # create mat. views refresh function
-    psql.create_trigger_function()
-
+def create_direction_tables(args, session):
+    """
+    Create table, summary tables and rollup table of every direction.
+    """
     for direction in DIRECTIONS:
         # make direction name compatible to postgres
         table_name = direction.replace(' ', '_').lower()
 
         # create table for specific direction data
-        psql.create_table(table_name=table_name)
+        psql.create_table(table_name=table_name, partition=PARTITION_BY, session=session)
+
+        # create summary tables for keeping the most recent requested journeys' data and price range by days
+        # (replaces materialized views of the previous versions, they depend on the table and block migration)
+        psql.create_summary_tables(table_name=table_name, session=session)
+
+        # create rollup table for the history compacted by retention.py
+        psql.create_daily_table(table_name=table_name, session=session)
+
+        # move existing data to the partitioned table if asked
+        if PARTITION_BY and args.migrate:
+            psql.migrate_to_partitioned(table_name=table_name, partition=PARTITION_BY, session=session)
+
+        # unique natural key for upsert loads
+        if args.natural_key:
+            psql.create_natural_key(table_name=table_name, session=session)
+
 
-        # create materialized view for keeping the most recent requested journeys' data
-        psql.create_mat_view_current(table_name=table_name)
+def create_fact_tables(args, session):
+    """
+    Create the unified fact table of all the directions and views with the names of the summary tables
+    of every direction over it (see FACT_TABLE in config.txt).
+    """
+    # create one table for data of all the directions, with departure date, time and duration precomputed
+    psql.create_fact_table(table_name=FACT_TABLE, partition=PARTITION_BY, session=session)
+
+    for direction in DIRECTIONS:
+        # copy the rows of the existing direction table if asked, before its summary tables are replaced
+        if args.migrate:
+            psql.migrate_to_fact_table(fact_table=FACT_TABLE, direction=direction, partition=PARTITION_BY,
+                                       session=session)
+
+        # create views for the most recent requested journeys' data and price range by days of the direction
+        psql.create_compatibility_views(fact_table=FACT_TABLE, direction=direction, session=session)
+
+    # create rollup table for the history compacted by retention.py
+    psql.create_daily_table(table_name=FACT_TABLE, fact=True, session=session)
+
+    # unique natural key for upsert loads, journeys of different directions never meet
+    if args.natural_key:
+        psql.create_natural_key(table_name=FACT_TABLE, key=['direction'] + psql.NATURAL_KEY, session=session)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create tables and summary tables for all the directions.')
+    parser.add_argument('--transaction', action='store_true',
+                        help='create everything in a single transaction: all or nothing')
+    parser.add_argument('--natural-key', action='store_true',
+                        help='remove duplicated journeys of the same request date and add unique key '
+                             '(journey_id, request_date) for upsert loads (done by the first upsert otherwise)')
+    parser.add_argument('--migrate', action='store_true',
+                        help='turn existing plain tables into partitioned by PARTITION_BY from config.txt, or copy '
+                             'their rows into FACT_TABLE if it is set (the direction tables are kept)')
+    args = parser.parse_args()
 
-        # create materialized view for keeping the most recent price range by days
-        psql.create_mat_view_price_range(table_name=table_name)
+    # all the DDL of the run shares one pooled connection, each statement is committed separately
+    # unless a single transaction is asked for
+    with psql.Session(transaction=args.transaction,
+                      pool_size=int(CONFIGS.get('DB_POOL_SIZE', psql.POOL_SIZE))) as session:
+        if FACT_TABLE:
+            create_fact_tables(args, session)
+        else:
+            create_direction_tables(args, session)
 
-        # create insert trigger for mat. views refresh function
-        psql.create_trigger(table_name=table_name)
+    psql.close_pool()
 
 
 if __name__ == "__main__":
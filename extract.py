@@ -0,0 +1,105 @@
+import argparse
+import datetime
+import os
+from Utilities import catalog
+from Utilities import extractor
+from Utilities import metrics
+from Utilities import parameters
+from Utilities import scheduler
+from Utilities.log import log
+
+# get configs from config.txt
+CONFIGS = parameters.get_configs()
+
+# get destination (root) folder from configs
+DESTINATION_FOLDER = CONFIGS['DESTINATION_FOLDER'][1:-1]
+
+# get catalog file from configs, empty if the catalog is not in use
+CATALOG_FILE = CONFIGS.get('CATALOG_FILE', '""')[1:-1]
+
+# get plan of schedule.py from configs
+SCHEDULE_FILE = CONFIGS.get('SCHEDULE_FILE', '"./data/schedule.json"')[1:-1]
+
+# get directions from directions.txt
+DIRECTIONS = parameters.get_directions()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent extract of raw responses (replaces extract_load.sh).')
+    parser.add_argument('--days', type=int, default=int(CONFIGS.get('DAYS_FORWARD', 45)),
+                        help='days forward from today to request')
+    parser.add_argument('--concurrency', type=int, default=int(CONFIGS.get('CONCURRENCY', 8)),
+                        help='max number of requests in flight')
+    parser.add_argument('--rate', type=float, default=float(CONFIGS.get('REQUESTS_PER_SECOND', 5)),
+                        help='max requests per second, 0 for no limit')
+    parser.add_argument('--url', default=extractor.API_URL, help='API endpoint')
+    parser.add_argument('--compression', choices=['', 'gzip', 'zstd'],
+                        default=CONFIGS.get('RAW_COMPRESSION', '""')[1:-1],
+                        help='compress raw responses')
+    parser.add_argument('--dedup', action=argparse.BooleanOptionalAction,
+                        default=CONFIGS.get('DEDUP_RESPONSES', '0') == '1',
+                        help='store unchanged responses as short markers (needs CATALOG_FILE for content hashes)')
+    parser.add_argument('--schedule', action='store_true',
+                        help='request only departure dates planned for today by schedule.py '
+                             '(needs CATALOG_FILE to refer to the stored responses of the others)')
+    parser.add_argument('--retries', type=int, default=int(CONFIGS.get('REQUEST_RETRIES', extractor.RETRIES)),
+                        help='max repeats of a failed request or invalid response')
+    parser.add_argument('--backoff', type=float, default=float(CONFIGS.get('RETRY_BACKOFF', extractor.BACKOFF)),
+                        help='max seconds to wait before the first repeat, doubled for every next one')
+    parser.add_argument('--index', action=argparse.BooleanOptionalAction,
+                        default=CONFIGS.get('RAW_INDEX', '1') == '1',
+                        help='write sidecar index <date>.txt.idx of response offsets by departure date '
+                             '(see index_raw.py)')
+    parser.add_argument('--resume', action='store_true',
+                        help="request only departure dates which today's checkpoint has not done yet "
+                             "(needs CATALOG_FILE), e.g. after a killed or partially failed extract")
+    parser.add_argument('--profile', metavar='FILE', default='',
+                        help='profile the extract with cProfile and write stats to FILE (.prof)')
+    args = parser.parse_args()
+    if args.resume and not CATALOG_FILE:
+        parser.error('--resume needs CATALOG_FILE in config.txt to keep the checkpoint in')
+
+    # departure dates planned for today by direction
+    schedule = None
+    if args.schedule:
+        plan = scheduler.load_plan(SCHEDULE_FILE)
+        # dates beyond the planned horizon are requested every day
+        schedule = {direction: set(scheduler.get_scheduled_dates((intervals + [1] * args.days)[:args.days]))
+                    for direction, intervals in plan.items()}
+
+    with metrics.stage('extract'), metrics.profile(args.profile):
+        written = extractor.extract(directions=DIRECTIONS,
+                                    destination_folder=DESTINATION_FOLDER,
+                                    days_forward=args.days,
+                                    url=args.url,
+                                    concurrency=args.concurrency,
+                                    rate_limit=args.rate,
+                                    codec=args.compression,
+                                    catalog_file=CATALOG_FILE,
+                                    dedup=args.dedup,
+                                    schedule=schedule,
+                                    retries=args.retries,
+                                    backoff=args.backoff,
+                                    resume=args.resume,
+                                    index=args.index)
+
+    # make record to the logfile
+    log(f"{written} responses of {len(DIRECTIONS) * args.days} have been recorded", extractor.REQUEST_LOG)
+
+    # register raw files in the catalog to be transformed
+    if CATALOG_FILE:
+        current_date = datetime.date.today().isoformat()
+        failed = catalog.get_checkpoints(CATALOG_FILE, current_date, 'failed')
+        if failed:
+            log(f"{len(failed)} requests have failed, run extract.py --resume to repeat only them",
+                extractor.REQUEST_LOG, 'WARNING')
+        for direction in DIRECTIONS:
+            file_path = extractor.get_raw_path(DESTINATION_FOLDER, direction, current_date, args.compression)
+            if os.path.exists(file_path):
+                catalog.register_file(CATALOG_FILE, file_path)
+
+    metrics.export('extract')
+
+
+if __name__ == "__main__":
+    main()
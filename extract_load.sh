@@ -61,3 +61,14 @@ do
     	./Utilities/request.sh $item $future_date >> "$DESTINATION_FOLDER/$item/$current_date.txt"
     done
 done < "$file_directions_path"
+
+
+# Register raw files of the day in the catalog (if it's in use) to be transformed
+if [ -n "$CATALOG_FILE" ]; then
+	while IFS= read -r item
+	do
+		if [ -f "$DESTINATION_FOLDER/$item/$current_date.txt" ]; then
+			python3 -m Utilities.catalog "$CATALOG_FILE" "$DESTINATION_FOLDER/$item/$current_date.txt"
+		fi
+	done < "$file_directions_path"
+fi
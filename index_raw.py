@@ -0,0 +1,90 @@
+import argparse
+import csv
+import datetime
+import os
+import sys
+from Utilities import parameters
+from Utilities import processing
+from Utilities import raw_index
+from Utilities.log import log
+
+# get configs from config.txt
+CONFIGS = parameters.get_configs()
+
+# get destination (root) folder from configs
+DESTINATION_FOLDER = CONFIGS['DESTINATION_FOLDER'][1:-1]
+
+# get directions from directions.txt
+DIRECTIONS = parameters.get_directions()
+
+
+def get_raw_files(directions, request_date=None):
+    """
+    Raw files (plain or compressed) of the directions.
+
+    Parameters:
+    - directions (iter) : list of directions.
+    - request_date (datetime.date) : date of request, all the dates if None.
+
+    Return:
+    - list : paths to raw files.
+    """
+    raw_files = []
+    for direction in directions:
+        folder = os.path.join(DESTINATION_FOLDER, direction)
+        if not os.path.isdir(folder):
+            continue
+        for file_name in sorted(os.listdir(folder)):
+            try:
+                file_date, extension = parameters.split_file_name(file_name)
+            except ValueError:
+                # not a data file
+                continue
+            if extension == 'txt' and request_date in (None, file_date):
+                raw_files.append(os.path.join(folder, file_name))
+    return raw_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index raw files by departure date (for the files extracted '
+                                                 'without index), or print journeys of a single departure date '
+                                                 'from the raw file without parsing the rest of it.')
+    parser.add_argument('--date', default='', help='request date of raw files (yyyy-mm-dd), all dates by default')
+    parser.add_argument('--direction', choices=DIRECTIONS, default=None,
+                        help='direction of raw files, all the directions by default')
+    parser.add_argument('--dep-date', default='',
+                        help='print csv rows of the journeys of this departure date (yyyy-mm-dd) instead of '
+                             'indexing, needs --date')
+    parser.add_argument('--rebuild', action='store_true', help='index the files from scratch')
+    args = parser.parse_args()
+    if args.dep_date and not args.date:
+        parser.error('--dep-date needs --date')
+
+    request_date = datetime.date.fromisoformat(args.date) if args.date else None
+    raw_files = get_raw_files([args.direction] if args.direction else DIRECTIONS, request_date)
+
+    # spot reprocessing: rows of the departure date as transform.py writes them
+    if args.dep_date:
+        csv_writer = csv.writer(sys.stdout, lineterminator='\n')
+        csv_writer.writerow(processing.HEADERS)
+        for file_path in raw_files:
+            markers = []
+            for parsed_line in raw_index.iter_responses(file_path, [args.dep_date], unchanged=markers):
+                csv_writer.writerows(processing.extract_journeys(parsed_line, args.date))
+            for marker in markers:
+                print(f"{file_path}: {args.dep_date} is unchanged since {marker['since']}", file=sys.stderr)
+        return
+
+    for file_path in raw_files:
+        index_file = raw_index.get_index_path(file_path)
+        if args.rebuild and os.path.exists(index_file):
+            os.remove(index_file)
+
+        indexed = raw_index.update_index(file_path)
+        # make record to the logfile
+        if indexed:
+            log(f"{file_path}: {indexed} responses have been indexed to {index_file}", "./logs/processing_log.txt")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,10 @@
+import argparse
+import os
+from Utilities import catalog
+from Utilities import metrics
 from Utilities import psql
 from Utilities import parameters
+from Utilities import processing
 from Utilities.log import log
 
 # get configs from config.txt
@@ -8,27 +13,110 @@ CONFIGS = parameters.get_configs()
 # get destination (root) folder from configs
 DESTINATION_FOLDER = CONFIGS['DESTINATION_FOLDER'][1:-1]
 
+# get catalog file from configs, empty if the catalog is not in use
+CATALOG_FILE = CONFIGS.get('CATALOG_FILE', '""')[1:-1]
+
+# get partitioning of direction tables from configs: 'day', 'month' or empty
+PARTITION_BY = CONFIGS.get('PARTITION_BY', '""')[1:-1]
+
+# get load method from configs: 'copy' appends rows, 'upsert' merges them by (journey_id, request_date)
+LOAD_METHOD = CONFIGS.get('LOAD_METHOD', '"copy"')[1:-1] or 'copy'
+
+# get unified fact table of all the directions from configs, empty if every direction has its own table
+FACT_TABLE = CONFIGS.get('FACT_TABLE', '""')[1:-1]
+
 # get directions from directions.txt
 DIRECTIONS = parameters.get_directions()
 
 
 def main():
-    # get 'todolist' of the files from specific date to load to db (from today by default)
-    files_to_load = parameters.get_files_todo_from_date(destination_folder=DESTINATION_FOLDER,
-                                                        directions=DIRECTIONS,
-                                                        date='',
-                                                        extension='csv')
+    parser = argparse.ArgumentParser(description='Load transformed csv files to db.')
+    parser.add_argument('--method', choices=['copy', 'upsert', 'insert'], default=LOAD_METHOD,
+                        help='bulk COPY (bad rows go to .rejects file), COPY to staging table merged by '
+                             '(journey_id, request_date) so reloads change nothing, or row by row INSERT')
+    parser.add_argument('--sync', action='store_true',
+                        help='scan direction folders and register new or changed files in the catalog first')
+    parser.add_argument('--date', default='',
+                        help='the earliest request date of files to load (yyyy-mm-dd), today by default '
+                             '(older files found by the scan are registered as loaded before)')
+    parser.add_argument('--profile', metavar='FILE', default='',
+                        help='profile loading with cProfile and write stats to FILE (.prof)')
+    args = parser.parse_args()
+
+    if CATALOG_FILE:
+        # not loaded csv files from the catalog, so the same file is never loaded twice
+        if args.sync or not os.path.exists(CATALOG_FILE):
+            catalog.sync(CATALOG_FILE, DESTINATION_FOLDER, DIRECTIONS, date=args.date)
+        files_to_load = catalog.get_files_todo(CATALOG_FILE, directions=DIRECTIONS, extension='csv', stage='loaded',
+                                               date=args.date)
+    else:
+        # get 'todolist' of the files from specific date to load to db (from today by default)
+        files_to_load = parameters.get_files_todo_from_date(destination_folder=DESTINATION_FOLDER,
+                                                            directions=DIRECTIONS,
+                                                            date=args.date,
+                                                            extension='csv')
 
     # make record of planned to process files to log file
     for file_path in files_to_load:
         log(file_path + ' planned to be loaded to db', './logs/db_log.txt')
 
-    for file_path in files_to_load:
-        # obtaining direction name from file path (./ folder of the file) and make it compatible to postgres
-        table_name = file_path.split('/')[-2].replace(' ', '_').lower()
+    # all the files of the run are loaded through one pooled connection, each file is committed separately
+    with psql.Session(pool_size=int(CONFIGS.get('DB_POOL_SIZE', psql.POOL_SIZE))) as session, \
+            metrics.profile(args.profile):
+        # the latest loaded snapshot of each table
+        loaded_files = {}
+
+        with metrics.stage('load'):
+            for file_path in files_to_load:
+                # obtaining direction name from file path (./ folder of the file) and make it compatible to postgres
+                table_name = file_path.split('/')[-2].replace(' ', '_').lower()
+
+                # rows of all the directions go to the fact table if it's in use
+                target_table = FACT_TABLE or table_name
+                columns = processing.FACT_HEADERS if FACT_TABLE else processing.HEADERS
+
+                # partition for the request date must exist before loading
+                if PARTITION_BY:
+                    psql.create_partition(table_name=target_table, request_date=file_path[-14:-4],
+                                          partition=PARTITION_BY, session=session)
+
+                # csv file changed after it was loaded has some of its rows in the table already
+                merge = bool(CATALOG_FILE) and catalog.needs_merge(CATALOG_FILE, file_path)
+
+                # load csv file to the appropriate table
+                if args.method in ('copy', 'upsert') or merge:
+                    loaded = psql.copy_csv(table_name=target_table, csv_file_path=file_path, headers=True,
+                                           upsert=args.method == 'upsert' or merge, columns=columns,
+                                           session=session)
+                else:
+                    loaded = psql.load_csv(table_name=target_table, csv_file_path=file_path, headers=True,
+                                           columns=columns, session=session)
+
+                # file_name without extension is request date
+                if loaded:
+                    metrics.increment('bytes_read', os.path.getsize(file_path))
+                    loaded_files[table_name] = max(loaded_files.get(table_name, file_path), file_path)
+                    if FACT_TABLE:
+                        unchanged = processing.read_unchanged(parameters.get_output_path(file_path, 'unchanged'))
+                        psql.store_unchanged(fact_table=FACT_TABLE, direction=file_path.split('/')[-2],
+                                             request_date=file_path[-14:-4], unchanged=unchanged, session=session)
+                    if CATALOG_FILE:
+                        catalog.mark_done(CATALOG_FILE, file_path, 'loaded')
+
+        # refresh summary tables once per run, from the loaded snapshot only
+        # (and the earlier ones for departure dates which were unchanged in it)
+        # views over the fact table are always up to date, only their readers are notified
+        with metrics.stage('refresh'):
+            for table_name, file_path in loaded_files.items():
+                if FACT_TABLE:
+                    psql.notify_refreshed(table_name=table_name, session=session)
+                    continue
+                unchanged = processing.read_unchanged(parameters.get_output_path(file_path, 'unchanged'))
+                psql.refresh_summaries(table_name=table_name, request_date=file_path[-14:-4], unchanged=unchanged,
+                                       session=session)
 
-        # load csv file to the appropriate table
-        psql.load_csv(table_name=table_name, csv_file_path=file_path, headers=True)
+    psql.close_pool()
+    metrics.export('load')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+import argparse
+import datetime
+import os
+from Utilities import catalog
+from Utilities import extractor
+from Utilities import metrics
+from Utilities import parameters
+from Utilities import psql
+from Utilities import streaming
+from Utilities.log import log
+
+# get configs from config.txt
+CONFIGS = parameters.get_configs()
+
+# get destination (root) folder from configs
+DESTINATION_FOLDER = CONFIGS['DESTINATION_FOLDER'][1:-1]
+
+# get catalog file from configs, empty if the catalog is not in use
+CATALOG_FILE = CONFIGS.get('CATALOG_FILE', '""')[1:-1]
+
+# get partitioning of direction tables from configs: 'day', 'month' or empty
+PARTITION_BY = CONFIGS.get('PARTITION_BY', '""')[1:-1]
+
+# get load method from configs: 'copy' appends rows, 'upsert' merges them by (journey_id, request_date)
+LOAD_METHOD = CONFIGS.get('LOAD_METHOD', '"copy"')[1:-1] or 'copy'
+
+# get unified fact table of all the directions from configs, empty if every direction has its own table
+FACT_TABLE = CONFIGS.get('FACT_TABLE', '""')[1:-1]
+
+# get directions from directions.txt
+DIRECTIONS = parameters.get_directions()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract, transform and load in one process: responses are parsed '
+                                                 'and loaded to db as they come, without csv files '
+                                                 '(replaces extract.py -> transform.py -> load_to_db.py).')
+    parser.add_argument('--days', type=int, default=int(CONFIGS.get('DAYS_FORWARD', 45)),
+                        help='days forward from today to request')
+    parser.add_argument('--concurrency', type=int, default=int(CONFIGS.get('CONCURRENCY', 8)),
+                        help='max number of requests in flight')
+    parser.add_argument('--rate', type=float, default=float(CONFIGS.get('REQUESTS_PER_SECOND', 5)),
+                        help='max requests per second, 0 for no limit')
+    parser.add_argument('--url', default=extractor.API_URL, help='API endpoint')
+    parser.add_argument('--window', type=int, default=None,
+                        help='max responses requested ahead of parsing (4 x concurrency by default)')
+    parser.add_argument('--queue-size', type=int, default=streaming.QUEUE_SIZE,
+                        help='max parsed responses waiting for the db writer')
+    parser.add_argument('--archive', action=argparse.BooleanOptionalAction,
+                        default=CONFIGS.get('STREAM_ARCHIVE', '1') == '1',
+                        help='keep raw responses in the raw files as extract.py does')
+    parser.add_argument('--compression', choices=['', 'gzip', 'zstd'],
+                        default=CONFIGS.get('RAW_COMPRESSION', '""')[1:-1],
+                        help='compress archived raw responses')
+    parser.add_argument('--method', choices=['copy', 'upsert'], default=LOAD_METHOD,
+                        help='append rows, or merge them by (journey_id, request_date) so reruns change nothing')
+    parser.add_argument('--profile', metavar='FILE', default='',
+                        help='profile the run with cProfile and write stats to FILE (.prof)')
+    args = parser.parse_args()
+
+    # every direction is loaded by a pooled connection in its own transaction
+    psql.get_pool(int(CONFIGS.get('DB_POOL_SIZE', psql.POOL_SIZE)))
+    with metrics.stage('stream'), metrics.profile(args.profile):
+        results = streaming.stream(directions=DIRECTIONS,
+                                   destination_folder=DESTINATION_FOLDER,
+                                   days_forward=args.days,
+                                   url=args.url,
+                                   concurrency=args.concurrency,
+                                   rate_limit=args.rate,
+                                   window=args.window,
+                                   queue_size=args.queue_size,
+                                   archive=args.archive,
+                                   codec=args.compression,
+                                   partition=PARTITION_BY,
+                                   upsert=args.method == 'upsert',
+                                   fact_table=FACT_TABLE)
+    psql.close_pool()
+
+    # make record to the logfile
+    loaded = [direction for direction, rows in results.items() if rows is not None]
+    log(f"{len(loaded)} directions of {len(DIRECTIONS)} have been streamed to db", './logs/db_log.txt')
+
+    # archived raw files are loaded already, the ones of failed directions are left for transform.py
+    if CATALOG_FILE and args.archive:
+        current_date = datetime.date.today().isoformat()
+        for direction in DIRECTIONS:
+            file_path = extractor.get_raw_path(DESTINATION_FOLDER, direction, current_date, args.compression)
+            if os.path.exists(file_path):
+                catalog.register_file(CATALOG_FILE, file_path)
+                if direction in loaded:
+                    catalog.mark_done(CATALOG_FILE, file_path, 'transformed')
+
+    metrics.export('pipeline')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import argparse
+import datetime
+import gzip
+import os
+import shutil
+from Utilities import catalog
+from Utilities import compression
+from Utilities import parameters
+from Utilities import psql
+from Utilities import raw_index
+from Utilities.log import log
+
+# get configs from config.txt
+CONFIGS = parameters.get_configs()
+
+# get destination (root) folder from configs
+DESTINATION_FOLDER = CONFIGS['DESTINATION_FOLDER'][1:-1]
+
+# get catalog file from configs, empty if the catalog is not in use
+CATALOG_FILE = CONFIGS.get('CATALOG_FILE', '""')[1:-1]
+
+# get archive folder of old data files from configs, old files are deleted if empty
+ARCHIVE_FOLDER = CONFIGS.get('ARCHIVE_FOLDER', '""')[1:-1]
+
+# summaries of unchanged departure dates refer to snapshots up to DAYS_FORWARD days old, they are always kept
+DAYS_FORWARD = int(CONFIGS.get('DAYS_FORWARD', 45))
+
+# get unified fact table of all the directions from configs, empty if every direction has its own table
+FACT_TABLE = CONFIGS.get('FACT_TABLE', '""')[1:-1]
+
+# get directions from directions.txt
+DIRECTIONS = parameters.get_directions()
+
+
+def is_processed(file_path):
+    """
+    Check that the data file has passed its stages: raw file is transformed, csv file is loaded.
+    Without the catalog every old file is taken as processed, sidecar files (.unchanged, .rejects) always are.
+
+    Return:
+    - bool: True if the file can be archived.
+    """
+    if not CATALOG_FILE:
+        return True
+    extension = parameters.split_file_name(file_path)[1]
+    stages = catalog.get_stages(CATALOG_FILE, file_path)
+    if extension == 'txt':
+        return stages is not None and stages['transformed'] is not None
+    if extension == 'csv':
+        return stages is not None and stages['loaded'] is not None
+    return True
+
+
+def archive_file(file_path, archive_folder):
+    """
+    Move the data file to archive_folder/<direction>/, plain files are gzip-compressed on the way
+    (compressed raw files stay readable by processing.iter_parse_file). The file is deleted if archive_folder
+    is empty. Catalog record follows the file. Raw file indexes are deleted: offsets of a plain file don't fit
+    its compressed copy, and the index of a file compressed by frames is rebuilt by raw_index.update_index().
+
+    Parameters:
+    - file_path (str) : path to data file.
+    - archive_folder (str) : root folder of the archive, or empty.
+
+    Return:
+    - str : path to archived file, empty if deleted.
+    - None : archiving failed, the file is untouched.
+    """
+    if not archive_folder or file_path.endswith(raw_index.INDEX_SUFFIX):
+        os.remove(file_path)
+        if CATALOG_FILE:
+            catalog.remove_file(CATALOG_FILE, file_path)
+        return ''
+
+    folder = os.path.join(archive_folder, os.path.basename(os.path.dirname(file_path)))
+    os.makedirs(folder, exist_ok=True)
+    compressed = bool(compression.get_codec(file_path))
+    output_file = os.path.join(folder, os.path.basename(file_path) + ('' if compressed else '.gz'))
+    temp_file = os.path.join(folder, '.' + os.path.basename(output_file))
+    try:
+        with open(file_path, 'rb') as source, \
+                open(temp_file, 'wb') if compressed else gzip.open(temp_file, 'wb') as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        os.replace(temp_file, output_file)
+        os.remove(file_path)
+    except Exception as e:
+        log(f"Error archiving {file_path}: {e}", "./logs/processing_log.txt", "ERROR")
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        return None
+
+    if CATALOG_FILE:
+        catalog.rename_file(CATALOG_FILE, file_path, output_file)
+    return output_file
+
+
+def archive_files(before, archive_folder):
+    """
+    Archive raw, csv and sidecar files of request dates before the date. Files of a request date
+    are kept together while its raw or csv file hasn't been transformed or loaded yet.
+
+    Parameters:
+    - before (datetime.date) : the first request date to keep.
+    - archive_folder (str) : root folder of the archive, files are deleted if empty.
+
+    Return:
+    - tuple : (number of archived files, bytes freed in the destination folder).
+    """
+    archived, freed = 0, 0
+    for direction in DIRECTIONS:
+        folder = os.path.join(DESTINATION_FOLDER, direction)
+        if not os.path.isdir(folder):
+            continue
+
+        # old data files by request date
+        files_by_date = {}
+        for file_name in sorted(os.listdir(folder)):
+            file_path = os.path.join(folder, file_name)
+            try:
+                file_date = parameters.split_file_name(file_name)[0]
+            except ValueError:
+                # not a data file
+                continue
+            if file_date < before and os.path.isfile(file_path):
+                files_by_date.setdefault(file_date, []).append(file_path)
+
+        for file_date, file_paths in sorted(files_by_date.items()):
+            if not all(is_processed(file_path) for file_path in file_paths):
+                log(f"{direction} files of {file_date} are kept, they haven't been processed yet",
+                    "./logs/processing_log.txt", "WARNING")
+                continue
+
+            for file_path in file_paths:
+                size = os.path.getsize(file_path)
+                output_file = archive_file(file_path, archive_folder)
+                if output_file is not None:
+                    archived += 1
+                    freed += size
+                    log(f"{file_path} has been " + (f"archived to {output_file}" if output_file else "deleted"),
+                        "./logs/processing_log.txt")
+    return archived, freed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Retention of history: old snapshots of direction tables are '
+                                                 'rolled up into <direction>_daily tables and removed, old data '
+                                                 'files are archived.')
+    parser.add_argument('--days', type=int, default=int(CONFIGS.get('RETENTION_DAYS', 90)),
+                        help=f"request dates to keep in direction tables (at least DAYS_FORWARD={DAYS_FORWARD})")
+    parser.add_argument('--files-days', type=int, default=int(CONFIGS.get('FILES_RETENTION_DAYS', 30)),
+                        help='request dates of raw and csv files to keep in the destination folder')
+    parser.add_argument('--partitions', choices=['drop', 'detach'],
+                        default=CONFIGS.get('RETENTION_PARTITIONS', '"drop"')[1:-1] or 'drop',
+                        help='drop old partitions or detach them and keep as standalone tables')
+    parser.add_argument('--archive-folder', default=ARCHIVE_FOLDER,
+                        help='folder for old data files, they are deleted if empty')
+    parser.add_argument('--db', action=argparse.BooleanOptionalAction, default=True,
+                        help='compact direction tables')
+    parser.add_argument('--files', action=argparse.BooleanOptionalAction, default=True,
+                        help='archive data files')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='vacuum plain tables right after deleting rows instead of waiting for autovacuum')
+    args = parser.parse_args()
+
+    today = datetime.date.today()
+    if args.db:
+        days = max(args.days, DAYS_FORWARD)
+        if days != args.days:
+            log(f"Retention of {args.days} days is shorter than DAYS_FORWARD, {days} days are kept",
+                './logs/db_log.txt', 'WARNING')
+        before = today - datetime.timedelta(days=days)
+
+        # make direction names compatible to postgres, or take the fact table of all the directions
+        table_names = [FACT_TABLE] if FACT_TABLE else [direction.replace(' ', '_').lower() for direction in DIRECTIONS]
+        for table_name in table_names:
+            # every table is compacted in its own transaction
+            compacted = psql.compact_history(table_name=table_name, before=before, partitions=args.partitions,
+                                             fact=bool(FACT_TABLE))
+            if compacted and compacted['removed'] and args.vacuum:
+                psql.vacuum_table(table_name=table_name)
+        psql.close_pool()
+
+    if args.files:
+        archived, freed = archive_files(today - datetime.timedelta(days=args.files_days), args.archive_folder)
+        log(f"{archived} data files have been archived, {freed / 1024 / 1024:.1f} MB freed",
+            "./logs/processing_log.txt")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import argparse
+from Utilities import psql
+from Utilities import parameters
+from Utilities import scheduler
+
+# get configs from config.txt
+CONFIGS = parameters.get_configs()
+
+# get days forward to request from configs
+DAYS_FORWARD = int(CONFIGS.get('DAYS_FORWARD', 45))
+
+# get plan file for extract.py --schedule from configs
+SCHEDULE_FILE = CONFIGS.get('SCHEDULE_FILE', '"./data/schedule.json"')[1:-1]
+
+# get unified fact table of all the directions from configs, empty if every direction has its own table
+FACT_TABLE = CONFIGS.get('FACT_TABLE', '""')[1:-1]
+
+# get directions from directions.txt
+DIRECTIONS = parameters.get_directions()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plan how often to request every departure date by the history '
+                                                 'of price and seats changes.')
+    parser.add_argument('--budget', type=float,
+                        default=float(CONFIGS.get('REQUEST_BUDGET', len(DIRECTIONS) * DAYS_FORWARD)),
+                        help='requests per day for all the directions')
+    parser.add_argument('--history', type=int, default=60, help='days of history to estimate changes from')
+    parser.add_argument('--dry-run', action='store_true', help='only report the plan, do not write it')
+    args = parser.parse_args()
+
+    # how often departure dates change by days until departure, for every direction
+    probabilities = {}
+    with psql.Session(pool_size=int(CONFIGS.get('DB_POOL_SIZE', psql.POOL_SIZE))) as session:
+        for direction in DIRECTIONS:
+            # make direction name compatible to postgres
+            table_name = direction.replace(' ', '_').lower()
+            if FACT_TABLE:
+                rates = psql.get_change_rates(table_name=FACT_TABLE, history_days=args.history, direction=direction,
+                                              session=session) or {}
+            else:
+                rates = psql.get_change_rates(table_name=table_name, history_days=args.history,
+                                              session=session) or {}
+            probabilities[direction] = scheduler.get_change_probabilities(rates, DAYS_FORWARD)
+    psql.close_pool()
+
+    plan = scheduler.plan_intervals(probabilities, args.budget)
+    for line in scheduler.report(plan, probabilities):
+        print(line)
+
+    if not args.dry_run:
+        scheduler.save_plan(plan, SCHEDULE_FILE, args.budget)
+        print(f"Plan has been written to {SCHEDULE_FILE}")
+
+
+if __name__ == "__main__":
+    main()
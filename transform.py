@@ -1,6 +1,14 @@
+import argparse
+import functools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from Utilities import catalog
+from Utilities import columnar
+from Utilities import metrics
 from Utilities import processing
 from Utilities import parameters
-from Utilities.log import log
+from Utilities.log import log, flush_logs
 
 # get configs from config.txt
 CONFIGS = parameters.get_configs()
@@ -8,39 +16,130 @@ CONFIGS = parameters.get_configs()
 # get destination (root) folder from configs
 DESTINATION_FOLDER = CONFIGS['DESTINATION_FOLDER'][1:-1]
 
+# get catalog file from configs, empty if the catalog is not in use
+CATALOG_FILE = CONFIGS.get('CATALOG_FILE', '""')[1:-1]
+
+# get unified fact table of all the directions from configs, empty if every direction has its own table
+FACT_TABLE = CONFIGS.get('FACT_TABLE', '""')[1:-1]
+
 # get directions from directions.txt
 DIRECTIONS = parameters.get_directions()
 
 
+def transform_file(file_path, profile_file=None, output_format='csv', fact=False):
+    """
+    Transform single raw file into csv (or parquet) file with the same name but another extension.
+
+    Parameters:
+    - file_path (str) : path to raw file.
+    - profile_file (str) : dump cProfile stats of the transformation to this file if given.
+    - output_format (str) : 'csv' or 'parquet'.
+    - fact (bool) : csv rows for the fact table (see FACT_TABLE): with direction and the computed columns.
+
+    Return:
+    - tuple : (output file path, number of rows or None if failed, unparsed line numbers, seconds spent,
+      metrics counters to merge in the parent process).
+    """
+    start_time = time.perf_counter()
+
+    with metrics.collect() as counters, metrics.stage('transform'), metrics.profile(profile_file):
+        # parse raw file with json responses lazily, one response at a time
+        failures = []
+        markers = []
+        parsed_file = processing.iter_parse_file(file_path=file_path, failures=failures, unchanged=markers)
+
+        # extract the necessary attributes and stream them to the file
+        # with the same name but .csv extension, file_name without extension is request date
+        request_date = parameters.get_request_date(file_path)
+        output_file = parameters.get_output_path(file_path, output_format)
+        if output_format == 'parquet':
+            rows = columnar.write_parquet(parsed_file=parsed_file,
+                                          request_date=request_date,
+                                          output_file=output_file)
+        else:
+            rows = processing.write_csv(parsed_file=parsed_file,
+                                        request_date=request_date,
+                                        output_file=output_file,
+                                        header=True,
+                                        direction=file_path.split('/')[-2] if fact else None)
+
+        # departure dates stored as unchanged go to the sidecar file, loading keeps their earlier rows
+        if rows is not None:
+            processing.write_unchanged(markers, request_date, parameters.get_output_path(file_path, 'unchanged'))
+
+    # pool workers exit without atexit handlers, buffered records would be lost
+    flush_logs()
+
+    return output_file, rows, failures, time.perf_counter() - start_time, counters
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Transform raw responses into csv files.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes to transform files in parallel (1 - serial)')
+    parser.add_argument('--sync', action='store_true',
+                        help='scan direction folders and register new or changed files in the catalog first')
+    parser.add_argument('--date', default='',
+                        help='the earliest request date of files to transform (yyyy-mm-dd), today by default '
+                             '(older files found by the scan are registered as processed before)')
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv',
+                        help='output format: csv to load to db or typed columnar parquet (needs pyarrow)')
+    parser.add_argument('--profile', metavar='FILE', default='',
+                        help='profile transformation with cProfile and write stats to FILE (.prof)')
+    args = parser.parse_args()
+
     # get 'todolist' of the files to process
-    # there are 2 funcs for this: get_files_todo_unpaired() or get_files_todo_from_date()
-    files_todo = parameters.get_files_todo_from_date(destination_folder=DESTINATION_FOLDER,
-                                                     directions=DIRECTIONS,
-                                                     extension='txt',
-                                                     date='')
+    # (catalog tracks csv files for loading, parquet files are made from today's raw files)
+    if CATALOG_FILE and args.format == 'csv':
+        # not transformed raw files from the catalog, the catalog is filled by scan on the first run
+        if args.sync or not os.path.exists(CATALOG_FILE):
+            catalog.sync(CATALOG_FILE, DESTINATION_FOLDER, DIRECTIONS, date=args.date)
+        files_todo = catalog.get_files_todo(CATALOG_FILE, directions=DIRECTIONS, extension='txt',
+                                            stage='transformed', date=args.date)
+    else:
+        # there are 2 funcs for this: get_files_todo_unpaired() or get_files_todo_from_date()
+        files_todo = parameters.get_files_todo_from_date(destination_folder=DESTINATION_FOLDER,
+                                                         directions=DIRECTIONS,
+                                                         extension='txt',
+                                                         date='')
 
     # make record of planned to process files to log file
     for file_path in files_todo:
         log(file_path + ' planned to be processed', "./logs/processing_log.txt")
 
-    # processing of all the files from todolist
-    for file_path in files_todo:
-        # parse raw file with json responses to the list of dictionaries
-        parsed_file = processing.read_parse_file(file_path=file_path)
+    # every worker profiles its files separately, the stats are merged at the end
+    profile_files = [f"{args.profile}.{i}" if args.profile else None for i in range(len(files_todo))]
+
+    # processing of all the files from todolist, serially or by the pool of processes
+    # results come in the order of todolist in both cases, so the log stays ordered
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    try:
+        transform = functools.partial(transform_file, output_format=args.format, fact=bool(FACT_TABLE))
+        if executor:
+            results = executor.map(transform, files_todo, profile_files)
+        else:
+            results = map(transform, files_todo, profile_files)
 
-        # extract the necessary attributes to csv table
-        # file_name without extension is request date
-        request_date = file_path[-14:-4]
-        processed_data = processing.process_data(parsed_file=parsed_file,
-                                                 request_date=request_date,
-                                                 header=True)
+        for file_path, (output_file, rows, failures, seconds, counters) in zip(files_todo, results):
+            metrics.merge(counters)
+            # make record to the logfile
+            if rows is not None:
+                log(f"{output_file} has been recorded: {rows} rows in {seconds:.2f} s "
+                    f"({rows / seconds if seconds else 0:.0f} rows/s)", "./logs/processing_log.txt")
 
-        # write to the file with the same name but .csv extension
-        processing.write_output(output_data=processed_data, output_file=file_path[:-3] + 'csv')
+                # csv is ready to be loaded, raw file is done
+                if CATALOG_FILE and args.format == 'csv':
+                    catalog.register_file(CATALOG_FILE, output_file)
+                    catalog.mark_done(CATALOG_FILE, file_path, 'transformed')
+            if failures:
+                log(f"{file_path}: lines {failures} couldn't be parsed", "./logs/processing_log.txt")
+    finally:
+        if executor:
+            executor.shutdown()
 
-        # make record to the logfile
-        log(file_path[:-3] + 'csv' + ' has been recorded', "./logs/processing_log.txt")
+    if args.profile:
+        metrics.merge_profiles(profile_files, args.profile)
+    metrics.export('transform')
 
 
 if __name__ == "__main__":
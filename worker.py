@@ -0,0 +1,380 @@
+import argparse
+import datetime
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from Utilities import catalog
+from Utilities import compression
+from Utilities import extractor
+from Utilities import metrics
+from Utilities import parameters
+from Utilities import processing
+from Utilities import psql
+from Utilities import raw_index
+from Utilities import work_queue
+from Utilities.log import log, flush_logs, start_flush_thread
+from transform import transform_file
+
+# get configs from config.txt
+CONFIGS = parameters.get_configs()
+
+# get destination (root) folder from configs
+DESTINATION_FOLDER = CONFIGS['DESTINATION_FOLDER'][1:-1]
+
+# get catalog file from configs, empty if the catalog is not in use
+CATALOG_FILE = CONFIGS.get('CATALOG_FILE', '""')[1:-1]
+
+# get partitioning of direction tables from configs: 'day', 'month' or empty
+PARTITION_BY = CONFIGS.get('PARTITION_BY', '""')[1:-1]
+
+# get load method from configs: 'copy' appends rows, 'upsert' merges them by (journey_id, request_date)
+LOAD_METHOD = CONFIGS.get('LOAD_METHOD', '"copy"')[1:-1] or 'copy'
+
+# get unified fact table of all the directions from configs, empty if every direction has its own table
+FACT_TABLE = CONFIGS.get('FACT_TABLE', '""')[1:-1]
+
+# get compression of raw files from configs
+RAW_COMPRESSION = CONFIGS.get('RAW_COMPRESSION', '""')[1:-1]
+
+# get work queue backend from configs: 'postgres' (shared by servers) or 'sqlite' (local stand-in)
+QUEUE_BACKEND = CONFIGS.get('QUEUE_BACKEND', '"sqlite"')[1:-1]
+QUEUE_FILE = CONFIGS.get('QUEUE_FILE', '"./data/queue.sqlite"')[1:-1]
+
+# get directions from directions.txt
+DIRECTIONS = parameters.get_directions()
+
+# the log file of the worker
+WORKER_LOG = './logs/worker_log.txt'
+
+
+def get_parts_folder(direction, request_date):
+    """
+    Folder for the responses of single extract tasks, one file per departure date. Responses of the direction
+    are joined into the raw file by the transform task, so workers on different servers never append
+    to the same file.
+
+    Return:
+    - str : destination_folder/.parts/direction/yyyy-mm-dd (date of request)
+    """
+    return os.path.join(DESTINATION_FOLDER, '.parts', direction, request_date)
+
+
+def extract_task(payload, pool, limiter, template):
+    """
+    Request the direction and departure date and write the response to its part file.
+    The part is replaced atomically, so a repeated task leaves a single response.
+
+    Return:
+    - list : tasks to queue next.
+    """
+    content = extractor.request_journeys(pool, limiter, template, payload['direction'], payload['dep_date'])
+    if not content:
+        raise RuntimeError('no response')
+
+    part_file = os.path.join(get_parts_folder(payload['direction'], payload['request_date']),
+                             payload['dep_date'] + '.txt')
+    os.makedirs(os.path.dirname(part_file), exist_ok=True)
+    with open(part_file + '.tmp', 'wb') as file:
+        file.write(content + b'\n')
+    os.replace(part_file + '.tmp', part_file)
+    metrics.increment('bytes_written', len(content) + 1)
+    return []
+
+
+def join_parts(direction, request_date, codec=''):
+    """
+    Join responses of the extract tasks into the raw file in order of departure dates, as extract.py writes it
+    (the raw file is replaced, so a repeated task doesn't duplicate responses). Without parts (joined by
+    a previous attempt) the raw file is kept.
+
+    Return:
+    - str : raw file path.
+    """
+    raw_file = extractor.get_raw_path(DESTINATION_FOLDER, direction, request_date, codec)
+    parts_folder = get_parts_folder(direction, request_date)
+    if not os.path.isdir(parts_folder):
+        return raw_file
+
+    part_files = sorted(file_name for file_name in os.listdir(parts_folder) if file_name.endswith('.txt'))
+    os.makedirs(os.path.dirname(raw_file), exist_ok=True)
+    index_file = raw_index.get_index_path(raw_file)
+    with open(raw_file + '.tmp', 'wb') as file, raw_index.open_index(index_file + '.tmp', new=True) as index:
+        for file_name in part_files:
+            part_file = os.path.join(parts_folder, file_name)
+            with open(part_file, 'rb') as part:
+                frame = compression.compress_frame(part.read(), codec)
+            # part file name is the departure date, it's written when the response comes
+            requested_at = datetime.datetime.fromtimestamp(os.path.getmtime(part_file)).isoformat(timespec='seconds')
+            raw_index.write_entry(index, file_name[:-4], requested_at, file.tell(), len(frame))
+            file.write(frame)
+
+    # the old index never points into the new raw file, even if it's interrupted in between
+    if os.path.exists(index_file):
+        os.remove(index_file)
+    os.replace(raw_file + '.tmp', raw_file)
+    os.replace(index_file + '.tmp', index_file)
+
+    # the raw file is complete, parts are not needed anymore
+    for file_name in os.listdir(parts_folder):
+        os.remove(os.path.join(parts_folder, file_name))
+    os.removedirs(parts_folder)
+    return raw_file
+
+
+def transform_task(payload):
+    """
+    Join the parts of the direction (if extracted by the workers) and transform the raw file into csv.
+
+    Return:
+    - list : tasks to queue next (load of the csv file).
+    """
+    if 'path' in payload:
+        raw_file = payload['path']
+    else:
+        raw_file = join_parts(payload['direction'], payload['request_date'], RAW_COMPRESSION)
+    if not os.path.exists(raw_file):
+        raise RuntimeError(f"{raw_file} not found")
+
+    output_file, rows, failures, seconds, counters = transform_file(raw_file, fact=bool(FACT_TABLE))
+    metrics.merge(counters)
+    if rows is None:
+        raise RuntimeError(f"{raw_file} couldn't be transformed")
+
+    log(f"{output_file} has been recorded: {rows} rows in {seconds:.2f} s", "./logs/processing_log.txt")
+    if failures:
+        log(f"{raw_file}: lines {failures} couldn't be parsed", "./logs/processing_log.txt")
+    if CATALOG_FILE:
+        catalog.register_file(CATALOG_FILE, raw_file)
+        catalog.register_file(CATALOG_FILE, output_file)
+        catalog.mark_done(CATALOG_FILE, raw_file, 'transformed')
+    return [work_queue.task('load', {'path': output_file})]
+
+
+def load_task(payload, queue, claimed_task, worker_id):
+    """
+    Load the csv file and complete the task. With the postgres queue both are committed in one transaction,
+    so the rows are never loaded twice, even if the lease has expired meanwhile. The sqlite queue can't share
+    the transaction, the rows are committed before the completion, so they are always merged by natural key
+    (upsert): the worker which takes over a task with expired lease loads the same rows again without
+    duplicating them. So are the rows of csv file regenerated after it was loaded (see catalog.register_file).
+
+    Return:
+    - bool: True if completed, False if the lease has been lost.
+    """
+    file_path = payload['path']
+    table_name = file_path.split('/')[-2].replace(' ', '_').lower()
+    request_date = parameters.get_request_date(file_path)
+
+    # rows of all the directions go to the fact table if it's in use
+    target_table = FACT_TABLE or table_name
+    columns = processing.FACT_HEADERS if FACT_TABLE else processing.HEADERS
+
+    # partition for the request date must exist before loading
+    if PARTITION_BY:
+        psql.create_partition(table_name=target_table, request_date=request_date, partition=PARTITION_BY)
+
+    shared_transaction = isinstance(queue, work_queue.PostgresQueue)
+    # csv file changed after it was loaded has some of its rows in the table already
+    merge = bool(CATALOG_FILE) and catalog.needs_merge(CATALOG_FILE, file_path)
+    upsert = LOAD_METHOD == 'upsert' or not shared_transaction or merge
+    with psql.Session(transaction=shared_transaction) as session:
+        if not psql.copy_csv(table_name=target_table, csv_file_path=file_path, headers=True,
+                             upsert=upsert, columns=columns, session=session):
+            session.failed = True
+            raise RuntimeError(f"{file_path} couldn't be loaded")
+        # unchanged departure dates of the snapshot for the views over the fact table
+        if FACT_TABLE:
+            unchanged = processing.read_unchanged(parameters.get_output_path(file_path, 'unchanged'))
+            if not psql.store_unchanged(fact_table=FACT_TABLE, direction=file_path.split('/')[-2],
+                                        request_date=request_date, unchanged=unchanged, session=session):
+                session.failed = True
+                raise RuntimeError(f"unchanged departure dates of {file_path} couldn't be stored")
+        completed = queue.complete(claimed_task, worker_id, session=session if shared_transaction else None)
+        if not completed:
+            # someone else holds the task now: the rows are rolled back with the postgres queue,
+            # with the sqlite one they are committed already and merged again by the new holder
+            session.failed = True
+            return False
+    metrics.increment('bytes_read', os.path.getsize(file_path))
+
+    # summaries keep the newest snapshot, an older one is skipped
+    # (views over the fact table are always up to date, only their readers are notified)
+    if FACT_TABLE:
+        psql.notify_refreshed(table_name=table_name)
+    else:
+        unchanged = processing.read_unchanged(parameters.get_output_path(file_path, 'unchanged'))
+        psql.refresh_summaries(table_name=table_name, request_date=request_date, unchanged=unchanged)
+    if CATALOG_FILE:
+        catalog.mark_done(CATALOG_FILE, file_path, 'loaded')
+    return True
+
+
+def run_task(queue, claimed_task, worker_id, extract_args):
+    """
+    Do the task and record the result in the queue: completed with the next tasks, or failed to be retried.
+
+    Return:
+    - bool: True if completed.
+    """
+    kind, payload = claimed_task['kind'], claimed_task['payload']
+    try:
+        if kind == 'load':
+            completed = load_task(payload, queue, claimed_task, worker_id)
+        else:
+            if kind == 'extract':
+                next_tasks = extract_task(payload, *extract_args)
+            else:
+                next_tasks = transform_task(payload)
+            completed = queue.complete(claimed_task, worker_id, next_tasks)
+    except Exception as e:
+        log(f"{kind} {payload} failed (attempt {claimed_task['attempts']}): {e}", WORKER_LOG, 'ERROR')
+        metrics.increment('tasks_failed')
+        queue.fail(claimed_task, worker_id, str(e))
+        return False
+
+    if completed:
+        metrics.increment('tasks_done')
+    else:
+        log(f"{kind} {payload}: lease has expired, the task is done by another worker", WORKER_LOG, 'WARNING')
+        metrics.increment('tasks_lost')
+    return completed
+
+
+def enqueue(queue, args):
+    """
+    Queue the extract of today (or files left to transform and load from the catalog with --files).
+    """
+    if args.files:
+        if not CATALOG_FILE:
+            print('--files needs CATALOG_FILE in config.txt')
+            return
+        catalog.sync(CATALOG_FILE, DESTINATION_FOLDER, DIRECTIONS, date=args.date)
+        tasks = [work_queue.task('transform', {'path': file_path})
+                 for file_path in catalog.get_files_todo(CATALOG_FILE, DIRECTIONS, extension='txt',
+                                                         stage='transformed', date=args.date)]
+        tasks += [work_queue.task('load', {'path': file_path})
+                  for file_path in catalog.get_files_todo(CATALOG_FILE, DIRECTIONS, extension='csv', stage='loaded',
+                                                          date=args.date)]
+    else:
+        tasks = work_queue.get_extract_tasks(DIRECTIONS, extractor.get_departure_dates(args.days))
+
+    queued = queue.enqueue(tasks)
+    purged = queue.purge(args.purge_days)
+    log(f"{queued} tasks of {len(tasks)} have been queued, {purged} old tasks purged", WORKER_LOG)
+    print(f"{queued} tasks of {len(tasks)} have been queued")
+
+
+def run(queue, args):
+    """
+    Claim and do tasks until stopped, or until there is nothing left to do with --exit-when-idle.
+    """
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    pool = extractor.ConnectionPool(args.url, size=args.threads)
+    extract_args = (pool, extractor.RateLimiter(args.rate), extractor.read_payload_template())
+    log(f"Worker {worker_id} started for {', '.join(args.kinds)} tasks", WORKER_LOG)
+    # records are written while the worker waits for tasks too
+    start_flush_thread()
+    # transform and load tasks are run by the main thread
+    file_kinds = [kind for kind in args.kinds if kind != 'extract']
+
+    try:
+        with metrics.stage('worker'), ThreadPoolExecutor(max_workers=args.threads) as executor:
+            while True:
+                # requests of a batch go in parallel, transform and load are run by the main thread one after
+                # another, so only one of them is claimed at a time: the lease of the next one would run out
+                # while it waits, and another worker would take it over and do it again
+                claimed = []
+                if 'extract' in args.kinds:
+                    claimed += queue.claim(worker_id, ['extract'], limit=args.threads, lease_seconds=args.lease)
+                if file_kinds:
+                    claimed += queue.claim(worker_id, file_kinds, limit=1, lease_seconds=args.lease)
+                if not claimed:
+                    if args.exit_when_idle and not work_queue.is_pending(queue.stats(), args.kinds):
+                        break
+                    flush_logs()
+                    time.sleep(args.poll)
+                    continue
+
+                # transform or load task is run by the main thread while the requests go
+                futures = [executor.submit(run_task, queue, claimed_task, worker_id, extract_args)
+                           for claimed_task in claimed if claimed_task['kind'] == 'extract']
+                for claimed_task in claimed:
+                    if claimed_task['kind'] != 'extract':
+                        run_task(queue, claimed_task, worker_id, extract_args)
+                for future in futures:
+                    future.result()
+    except KeyboardInterrupt:
+        # claimed tasks are taken by other workers when their leases expire
+        log(f"Worker {worker_id} interrupted", WORKER_LOG, 'WARNING')
+    finally:
+        pool.close()
+
+    log(f"Worker {worker_id} stopped", WORKER_LOG)
+
+
+def status(queue):
+    """
+    Print number of tasks by kind and status, and the failed tasks.
+    """
+    for (kind, task_status), count in sorted(queue.stats().items()):
+        print(f"{kind:<10} {task_status:<8} {count:>7}")
+    for kind, payload, error in queue.failures():
+        print(f"failed: {kind} {payload}: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Share extract, transform and load between any number of workers '
+                                                 'through a work queue.')
+    parser.add_argument('--backend', choices=['postgres', 'sqlite'], default=QUEUE_BACKEND,
+                        help='queue in the database from database.ini (for several servers) or in a local file')
+    parser.add_argument('--attempts', type=int,
+                        default=int(CONFIGS.get('QUEUE_MAX_ATTEMPTS', work_queue.MAX_ATTEMPTS)),
+                        help='attempts of a task before it is marked failed')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    enqueue_parser = subparsers.add_parser('enqueue', help="queue today's extract (it's followed by transform and "
+                                                           "load of every direction)")
+    enqueue_parser.add_argument('--days', type=int, default=int(CONFIGS.get('DAYS_FORWARD', 45)),
+                                help='days forward from today to request')
+    enqueue_parser.add_argument('--files', action='store_true',
+                                help='queue transform and load of the files left in the catalog instead')
+    enqueue_parser.add_argument('--date', default='',
+                                help='with --files, the earliest request date of files to queue (yyyy-mm-dd), '
+                                     'today by default (older files new to the catalog are registered as done)')
+    enqueue_parser.add_argument('--purge-days', type=int, default=7, help='remove tasks done before that many days')
+
+    run_parser = subparsers.add_parser('run', help='claim and do tasks')
+    run_parser.add_argument('--kinds', nargs='+', choices=['extract', 'transform', 'load'],
+                            default=['extract', 'transform', 'load'], help='kinds of tasks to take')
+    run_parser.add_argument('--threads', type=int, default=int(CONFIGS.get('CONCURRENCY', 8)),
+                            help='tasks claimed at once and requests in flight')
+    run_parser.add_argument('--rate', type=float, default=float(CONFIGS.get('REQUESTS_PER_SECOND', 5)),
+                            help='max requests per second of this worker, 0 for no limit')
+    run_parser.add_argument('--url', default=extractor.API_URL, help='API endpoint')
+    run_parser.add_argument('--lease', type=int, default=int(CONFIGS.get('QUEUE_LEASE', work_queue.LEASE_SECONDS)),
+                            help='seconds a claimed task is reserved for the worker')
+    run_parser.add_argument('--poll', type=float, default=5, help='seconds to wait when there is nothing to do')
+    run_parser.add_argument('--exit-when-idle', action='store_true',
+                            help='stop when no tasks of the kinds are left, instead of waiting for new ones')
+
+    subparsers.add_parser('status', help='print tasks by kind and status')
+    args = parser.parse_args()
+
+    queue = work_queue.get_queue(args.backend, QUEUE_FILE, max_attempts=args.attempts)
+    if not queue.create():
+        return
+
+    if args.command == 'enqueue':
+        enqueue(queue, args)
+    elif args.command == 'run':
+        run(queue, args)
+        metrics.export('worker')
+    else:
+        status(queue)
+
+    psql.close_pool()
+
+
+if __name__ == "__main__":
+    main()